@@ -9,7 +9,7 @@
 # This script identifies and downloads Level-2 data from the USGS Landsat 
 # Collection 2
 
-import os, sys, glob, datetime, argparse, requests #, ieo
+import os, sys, glob, datetime, argparse, requests, libraryindex, wrs2index, ieoprofile #, ieo
 from osgeo import ogr, osr
 
 try: # This is included as the module may not properly install in Anaconda.
@@ -46,14 +46,19 @@ parser.add_argument('-o', '--outdir', type = str, default = os.path.join(ieo.cat
 parser.add_argument('--ignorelocal', type = bool, default = False, help = 'Ignore presence of local scenes.')
 parser.add_argument('--srdir', type = str, default = ieo.srdir, help = 'Local SR scene directory')
 parser.add_argument('--usesrdir', type = bool, default = True, help = 'Use local index of scenes rather than shapefile stored data')
+parser.add_argument('--libraryindex', type = str, default = os.path.join(ieo.catdir, 'library_index.sqlite'), help = 'SQLite inventory of local library headers, shared with updatelandsat.py.')
+parser.add_argument('--wrs2index', type = str, default = os.path.join(ieo.catdir, 'WRS2_index.npz'), help = 'Cached WRS-2 Path/Row index, shared with updatelandsat.py.')
 parser.add_argument('--allinpath', type = bool, default = True, help = 'Include missing scenes in path, even if they are too cloudy.')
 parser.add_argument('--minsunel', type = float, default = 15.0, help = 'Sun elevation beneath which scenes will be ignored.')
 parser.add_argument('--separate', type = bool, default = False, help = 'Separate output files for Landsats 4-7 and 8.')
 parser.add_argument('--L1GS', type = bool, default = False, help = 'Also get L1GS and L1GT scenes.')
 parser.add_argument('--L1GT', type = bool, default = False, help = 'Also get L1GT scenes but exclude L1GS.')
 parser.add_argument('--ALL', type = bool, default = False, help = 'Get any scene regardless of processing level.')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('GetLandsatL2', args.profile) # does nothing unless --profile is set
+
 # type conversions of start and end dates to datetime.datetime objects
 args.startdate = datetime.datetime.strptime(args.startdate,'%Y/%m/%d')
 if args.enddate:
@@ -93,17 +98,18 @@ if args.startdoy or args.enddoy:
         print('Error: if used, both --startdoy and --enddoy must be defined. Exiting.')
         exit()
     
-if args.usesrdir:
+if args.usesrdir: # local scenes are read from the shared library index, which is first updated for any new or changed headers
+    library = libraryindex.LibraryIndex(args.libraryindex, ieo.readenvihdr)
     dirs = [args.srdir, os.path.join(args.srdir,'L1G')]
     for d in dirs:
-        flist = glob.glob(os.path.join(d,'L*.hdr'.format(ieo.projacronym)))
-        if len(flist) > 0:
-            for f in flist:
-                parentrasters = ieo.readenvihdr(f)['parent rasters']
-                for r in parentrasters:
-                    sceneid = os.path.basename(r)[:21]
+        library.refresh('Surface_reflectance_tiles', d)
+        parentscenes = library.parentscenes('Surface_reflectance_tiles', d)
+        for f in parentscenes.keys():
+            if os.path.basename(f).startswith('L'):
+                for sceneid in parentscenes[f]:
                     if not sceneid in localscenelist:
                         localscenelist.append(os.path.basename(f)[:16])
+    library.close()
                     
 
 proclevels = ['L1TP']
@@ -337,20 +343,7 @@ L7exclude.append('2017075')
 L7exclude.append('2017076')
 # Set various other variables
 
-pathrowdict = {}
-driver = ogr.GetDriverByName("GPKG")
-dataSource = driver.Open(ieo.ieogpkg, 0)
-layer = dataSource.GetLayer(ieo.WRS2)
-for feature in layer:
-    path = feature.GetField('Path')
-    row = feature.GetField('Row')
-    if not path in pathrowdict.keys():
-        pathrowdict[path] = []
-    if not row in pathrowdict[path]:
-        pathrowdict[path].append(row)
-dataSource = None
-for key in pathrowdict.keys():
-    pathrowdict[key].sort()
+pathrowdict = wrs2index.load(ieo.ieogpkg, ieo.WRS2, args.wrs2index).pathrowdict() # path: sorted list of rows
 
 print('Opening {}'.format(infile))
 if args.path and args.row:
@@ -360,7 +353,8 @@ dataSource = driver.Open(ieo.catgpkg, 0)
 layer = dataSource.GetLayer(ieo.landsatshp)
 layer_defn = layer.GetLayerDefn()
 field_names = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
-scenedata, localscenelist = getscenedata(layer, localscenelist)
+with profiler.phase('catalog'):
+    scenedata, localscenelist = getscenedata(layer, localscenelist)
     
 
 l8 = {}
@@ -368,11 +362,13 @@ l47 = {}
 l7slcoff = {}
 l5 = {}
 
-l8, l47, cctype = populatelists(l8, l47, scenedata, localscenelist)
+with profiler.phase('search'):
+    l8, l47, cctype = populatelists(l8, l47, scenedata, localscenelist)
 
 if args.allinpath:
     print('Now searching for missing scenes from same paths and dates of locally stored scenes.')
-    l8, l47 = findmissing(l8, l47, scenedata, localscenelist, cctype)
+    with profiler.phase('search'):
+        l8, l47 = findmissing(l8, l47, scenedata, localscenelist, cctype)
 
 
 if args.separate:
@@ -425,4 +421,5 @@ else:
 #            for scene in l5:
 #                output.write('%s\n'%scene)
 
+profiler.close()
 print('Processing complete.')
\ No newline at end of file
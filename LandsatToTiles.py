@@ -12,7 +12,7 @@
 # 4. Calculates NDVI and EVI for clear land pixels
 # 5. Archives tar.gz files after use
 
-import os, sys, glob, datetime, shutil, argparse#, ieo
+import os, sys, glob, datetime, shutil, argparse, ieometrics, ieoprofile #, ieo
 from osgeo import ogr
 
 try: # This is included as the module may not properly install in Anaconda.
@@ -41,8 +41,15 @@ parser.add_argument('-a', '--archdir', type = str, default = ieo.archdir, help =
 parser.add_argument('--overwrite', type = bool, default = False, help = 'Overwrite existing files.')
 parser.add_argument('-d', '--delay', type = int, default = 0, help = 'Delay execution of script in seconds.')
 parser.add_argument('-r','--remove', type = bool, default = False, help = 'Remove temporary files after ingest.')
+parser.add_argument('--metrics', type = str, default = os.path.join(ieo.logdir, 'LandsatToTiles_metrics.json'), help = 'JSON run report of stage timings and counts.')
+parser.add_argument('--promfile', type = str, default = None, help = 'Also write run metrics to this Prometheus textfile.')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('LandsatToTiles', args.profile) # does nothing unless --profile is set
+
+metrics = ieometrics.Metrics('LandsatToTiles', args.metrics, args.promfile)
+
 if args.delay > 0: # if we want to delay execution for whatever reason
     from time import sleep
     print('Delaying execution {} seconds.'.format(args.delay))
@@ -53,6 +60,7 @@ if args.delay > 0: # if we want to delay execution for whatever reason
 archdir = args.archdir
 fmaskdir = args.fmaskdir
 fmasklist = glob.glob(os.path.join(args.fmaskdir, '*.dat'))
+metrics.count('files_globbed', len(fmasklist), product = 'Fmask')
 
 reflist = []
 scenedict = {}
@@ -79,6 +87,7 @@ def sceneidfromfilename(filename):
 
 
 # Open up ieo.landsatshp and get the existing Product ID, Scene ID, and SR_path status
+span = metrics.span('catalog').start()
 driver = ogr.GetDriverByName("ESRI Shapefile")
 data_source = driver.Open(ieo.landsatshp, 0)
 layer = data_source.GetLayer()
@@ -86,15 +95,22 @@ for feature in layer:
     sceneID = feature.GetField('sceneID')
     scenedict[sceneID] = {'ProductID' : feature.GetField('LandsatPID'), 'sceneID' : sceneID, 'SR_path' : feature.GetField('SR_path')}
 data_source = None
+span.stop()
+metrics.count('scenes_read', len(scenedict))
 
 # This look finds any existing processed data 
+span = metrics.span('glob').start()
 for dir in [args.outdir, os.path.join(args.outdir, 'L1G')]:
     rlist = glob.glob(os.path.join(args.outdir, '*_ref_{}.dat'.format(ieo.projacronym)))
+    metrics.count('files_globbed', len(rlist), product = 'SR')
     for f in rlist:
         if not 'ESA' == os.path.basename(f)[16:19]:
             reflist.append(f)
+span.stop()
 
 # Now create the processing list
+span = metrics.span('scan').start()
+profiler.start('search')
 if args.infile: # This is in case a specific file has been selected for processing
     if os.access(args.infile, os.F_OK) and args.infile.endswith('.tar.gz'):
         print('File has been found, processing.')
@@ -116,6 +132,10 @@ else: # find and process what's in the ingest directory
                                 print('Found unprocessed SceneID {}, adding to processing list.'.format(sceneID))
                                 filelist.append(fname)
 
+profiler.stop()
+span.stop()
+metrics.count('archives_found', len(filelist))
+
 # Now process files that are in the list
 numfiles = len(filelist)
 print('There are {} reflectance files and {} scenes to be processed.'.format(len(reflist), numfiles))
@@ -126,13 +146,19 @@ for f in filelist:
     if args.overwrite or not any(scene in x for x in reflist):
         try:
             print('\nProcessing archive {}, file number {} of {}.\n'.format(f, filenum, numfiles))
-            ieo.importespa(f, remove = args.remove, overwrite = args.overwrite)
+            with metrics.span('import', archive = basename), profiler.phase('convert'):
+                ieo.importespa(f, remove = args.remove, overwrite = args.overwrite)
+            metrics.count('archives_converted', result = 'success')
         except Exception as e:
             print('There was a problem processing the scene. Adding to error list.')
             print(e)
             ieo.logerror(f, e)
+            metrics.count('archives_converted', result = 'error')
     else:
         print('Scene {} has already been processed, skipping file number {} of {}.'.format(scene, filenum, numfiles))
+        metrics.count('archives_converted', result = 'skipped')
     filenum += 1
 
+metrics.finish()
+profiler.close()
 print('Processing complete.')
\ No newline at end of file
@@ -7,7 +7,7 @@
 
 # This script creates Landsat scene processing lists for USGS/EROS/ESPA (https://espa.cr.usgs.gov)
 
-import os, sys, glob, datetime, argparse #, ieo
+import os, sys, glob, datetime, argparse, libraryindex, wrs2index, ieometrics, ieoprofile #, ieo
 from osgeo import ogr, osr
 
 try: # This is included as the module may not properly install in Anaconda.
@@ -44,14 +44,23 @@ parser.add_argument('-o', '--outdir', type = str, default = os.path.join(ieo.cat
 parser.add_argument('--ignorelocal', type = bool, default = False, help = 'Ignore presence of local scenes.')
 parser.add_argument('--srdir', type = str, default = ieo.srdir, help = 'Local SR scene directory')
 parser.add_argument('--usesrdir', type = bool, default = True, help = 'Use local index of scenes rather than shapefile stored data')
+parser.add_argument('--libraryindex', type = str, default = os.path.join(ieo.catdir, 'library_index.sqlite'), help = 'SQLite inventory of local library headers, shared with updatelandsat.py.')
+parser.add_argument('--wrs2index', type = str, default = os.path.join(ieo.catdir, 'WRS2_index.npz'), help = 'Cached WRS-2 Path/Row index, shared with updatelandsat.py.')
 parser.add_argument('--allinpath', type = bool, default = True, help = 'Include missing scenes in path, even if they are too cloudy.')
 parser.add_argument('--minsunel', type = float, default = 15.0, help = 'Sun elevation beneath which scenes will be ignored.')
 parser.add_argument('--separate', type = bool, default = False, help = 'Separate output files for Landsats 4-7 and 8.')
 parser.add_argument('--L1GS', type = bool, default = False, help = 'Also get L1GS and L1GT scenes.')
 parser.add_argument('--L1GT', type = bool, default = False, help = 'Also get L1GT scenes but exclude L1GS.')
 parser.add_argument('--ALL', type = bool, default = False, help = 'Get any scene regardless of processing level.')
+parser.add_argument('--metrics', type = str, default = os.path.join(ieo.logdir, 'MakeESPAproclist_metrics.json'), help = 'JSON run report of stage timings and counts.')
+parser.add_argument('--promfile', type = str, default = None, help = 'Also write run metrics to this Prometheus textfile.')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('MakeESPAproclist', args.profile) # does nothing unless --profile is set
+
+metrics = ieometrics.Metrics('MakeESPAproclist', args.metrics, args.promfile)
+
 # type conversions of start and end dates to datetime.datetime objects
 args.startdate = datetime.datetime.strptime(args.startdate,'%Y/%m/%d')
 if args.enddate:
@@ -91,17 +100,20 @@ if args.startdoy or args.enddoy:
         print('Error: if used, both --startdoy and --enddoy must be defined. Exiting.')
         exit()
     
-if args.usesrdir:
+if args.usesrdir: # local scenes are read from the shared library index, which is first updated for any new or changed headers
+    library = libraryindex.LibraryIndex(args.libraryindex, ieo.readenvihdr)
     dirs = [args.srdir, os.path.join(args.srdir,'L1G')]
-    for d in dirs:
-        flist = glob.glob(os.path.join(d,'L*.hdr'.format(ieo.projacronym)))
-        if len(flist) > 0:
-            for f in flist:
-                parentrasters = ieo.readenvihdr(f)['parent rasters']
-                for r in parentrasters:
-                    sceneid = os.path.basename(r)[:21]
-                    if not sceneid in localscenelist:
-                        localscenelist.append(os.path.basename(f)[:16])
+    with metrics.span('libraryindex'):
+        for d in dirs:
+            metrics.count('headers_read', library.refresh('Surface_reflectance_tiles', d))
+            parentscenes = library.parentscenes('Surface_reflectance_tiles', d)
+            metrics.count('files_indexed', len(parentscenes))
+            for f in parentscenes.keys():
+                if os.path.basename(f).startswith('L'):
+                    for sceneid in parentscenes[f]:
+                        if not sceneid in localscenelist:
+                            localscenelist.append(os.path.basename(f)[:16])
+    library.close()
                     
 
 proclevels = ['L1TP']
@@ -335,20 +347,9 @@ L7exclude.append('2017075')
 L7exclude.append('2017076')
 # Set various other variables
 
-pathrowdict = {}
-driver = ogr.GetDriverByName("GPKG")
-dataSource = driver.Open(ieo.ieogpkg, 0)
-layer = dataSource.GetLayer(ieo.WRS2)
-for feature in layer:
-    path = feature.GetField('Path')
-    row = feature.GetField('Row')
-    if not path in pathrowdict.keys():
-        pathrowdict[path] = []
-    if not row in pathrowdict[path]:
-        pathrowdict[path].append(row)
-dataSource = None
-for key in pathrowdict.keys():
-    pathrowdict[key].sort()
+span = metrics.span('wrs2').start()
+pathrowdict = wrs2index.load(ieo.ieogpkg, ieo.WRS2, args.wrs2index).pathrowdict() # path: sorted list of rows
+span.stop()
 
 print('Opening {}'.format(infile))
 if args.path and args.row:
@@ -358,7 +359,9 @@ dataSource = driver.Open(ieo.catgpkg, 0)
 layer = dataSource.GetLayer(ieo.landsatshp)
 layer_defn = layer.GetLayerDefn()
 field_names = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
-scenedata, localscenelist = getscenedata(layer, localscenelist)
+with metrics.span('catalog'), profiler.phase('catalog'):
+    scenedata, localscenelist = getscenedata(layer, localscenelist)
+metrics.count('scenes_read', len(scenedata))
     
 
 l8 = {}
@@ -366,11 +369,16 @@ l47 = {}
 l7slcoff = {}
 l5 = {}
 
-l8, l47, cctype = populatelists(l8, l47, scenedata, localscenelist)
+with metrics.span('populatelists'), profiler.phase('search'):
+    l8, l47, cctype = populatelists(l8, l47, scenedata, localscenelist)
 
 if args.allinpath:
     print('Now searching for missing scenes from same paths and dates of locally stored scenes.')
-    l8, l47 = findmissing(l8, l47, scenedata, localscenelist, cctype)
+    with metrics.span('findmissing'), profiler.phase('search'):
+        l8, l47 = findmissing(l8, l47, scenedata, localscenelist, cctype)
+
+span = metrics.span('write').start()
+profiler.start('write')
 
 
 if args.separate:
@@ -387,6 +395,7 @@ if args.separate:
                         output.write('{}\n'.format(scenedata[scene]['LANDSAT_PRODUCT_ID']))
                         i += 1
         print('{} scenes for ESPA to process.'.format(i))
+        metrics.count('scenes_listed', i, sensor = 'L8')
     
     if len(l47.keys()) > 0:
         i = 0
@@ -401,6 +410,7 @@ if args.separate:
                         output.write('{}\n'.format(scenedata[scene]['LANDSAT_PRODUCT_ID']))
                         i += 1
         print('{} scenes for ESPA to process.'.format(i))
+        metrics.count('scenes_listed', i, sensor = 'L47')
 else:
     i = 0
     outfile = os.path.join(outdir,'ESPA_list{}.txt'.format(todaystr))
@@ -415,6 +425,10 @@ else:
                         output.write('{}\n'.format(scenedata[scene]['LANDSAT_PRODUCT_ID']))
                         i += 1
     print('{} scenes for ESPA to process.'.format(i))
+    metrics.count('scenes_listed', i)
+span.stop()
+profiler.stop()
+metrics.finish()
                 
 #        if len(l7)>0:
 #            for scene in l7:
@@ -423,4 +437,5 @@ else:
 #            for scene in l5:
 #                output.write('%s\n'%scene)
 
+profiler.close()
 print('Processing complete.')
\ No newline at end of file
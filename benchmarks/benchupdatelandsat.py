@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This script benchmarks updatelandsat.py end to end against the local USGS stand-in in usgsstub.py. For each scale, a stub
+# serving that many synthetic scenes is started, and updatelandsat.py is run in a child process against a new, empty catalog
+# geopackage in a scratch directory. The IEO module is imported as installed, but its catalog, ingest, log, and library
+# directories are redirected to the scratch directory, so that the local library and catalog are never touched.
+# Reported per scale: scenes written, wall time, scenes/s, HTTP calls by endpoint, bytes transferred, GPKG write time, and peak RSS.
+# With --rerun, the earliest scene in the catalog is then invalidated, and updatelandsat.py run again with the same checkpoint, so that
+# it searches from that scene's date through years that are unchanged since their digests were recorded. The HTTP calls and bytes
+# transferred by that run are reported separately.
+
+import os, sys, re, json, time, shutil, sqlite3, tempfile, argparse, subprocess, resource, runpy
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+updater = os.path.join(os.path.dirname(benchdir), 'updatelandsat.py')
+sys.path.insert(0, benchdir)
+
+def runchild(workdir, pathrowvals, updaterargs):
+    # This runs updatelandsat.py in this process with the IEO directories redirected to workdir. It is invoked via --child.
+    import ieo
+    for attr in ['catdir', 'ingestdir', 'logdir', 'srdir', 'btdir', 'fmaskdir', 'pixelqadir', 'ndvidir', 'evidir']:
+        dirname = os.path.join(workdir, attr)
+        os.makedirs(dirname, exist_ok = True)
+        setattr(ieo, attr, dirname)
+    os.makedirs(os.path.join(ieo.catdir, 'Landsat', 'Thumbnails'), exist_ok = True)
+    ieo.catgpkg = os.path.join(ieo.catdir, 'ieo_catalog.gpkg')
+    ieo.config['Landsat']['useWRS2'] = 'No'
+    ieo.config['Landsat']['pathrowvals'] = pathrowvals
+    sys.argv = [updater] + updaterargs
+    runpy.run_path(updater, run_name = '__main__')
+
+def runupdater(workdir, pathrows, updaterargs, logfile):
+    # This runs updatelandsat.py in a child process with its output written to logfile, and returns [return code, seconds, log]
+    start = time.perf_counter()
+    with open(logfile, 'w') as output:
+        p = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', workdir, pathrows] + updaterargs, stdout = output, stderr = subprocess.STDOUT)
+    seconds = time.perf_counter() - start
+    with open(logfile, 'r') as infile:
+        log = infile.read()
+    if p.returncode != 0:
+        print('Error: updatelandsat.py exited with code {}, see {}.'.format(p.returncode, logfile))
+        print('\n'.join(log.splitlines()[-20:]))
+    return [p.returncode, seconds, log]
+
+def invalidateoldest(gpkg):
+    # This clears the sensor identifier of the earliest scene in the catalog geopackage, so that the next run deletes and reimports it.
+    # Returns its sceneID, or None if the catalog is empty.
+    conn = sqlite3.connect(gpkg)
+    try:
+        for tablename, in conn.execute("SELECT table_name FROM gpkg_contents WHERE data_type = 'features'").fetchall():
+            row = conn.execute('SELECT "sceneID" FROM "{}" ORDER BY substr("sceneID", 10, 7) LIMIT 1'.format(tablename)).fetchone()
+            if row:
+                conn.execute('UPDATE "{}" SET "SensorID" = NULL WHERE "sceneID" = ?'.format(tablename), (row[0],))
+                conn.commit()
+                return row[0]
+    finally:
+        conn.close()
+    return None
+
+def runscale(numscenes, args):
+    # This runs one benchmark scale, and returns its results
+    import usgsstub
+    workdir = tempfile.mkdtemp(prefix = 'benchupdatelandsat_{}_'.format(numscenes), dir = args.workdir)
+    server = usgsstub.StubServer(numscenes, usgsstub.parsepathrows(args.pathrows), args.enddate, latency = args.latency, errorrate = args.errorrate)
+    baseURL = server.start()
+    updaterargs = ['-u', 'benchmark', '-p', 'benchmark', '--baseURL', baseURL, '--MBR', args.MBR,
+                   '--startdate', args.startdate, '--enddate', args.enddate, '--thumbnails', '',
+                   '--workers', str(args.workers), '--writebatch', str(args.writebatch), '--ratelimit', str(args.ratelimit),
+                   '--checkpoint', os.path.join(workdir, 'updatelandsat_sync.sqlite')]
+    if args.arrow:
+        updaterargs.append('--arrow')
+    if args.fullmetadata:
+        updaterargs.append('--fullmetadata')
+    if args.extra:
+        updaterargs.extend(args.extra.split())
+    logfile = os.path.join(workdir, 'updatelandsat.log')
+    print('Running updatelandsat.py against {} synthetic scenes, logging to {}.'.format(server.numscenes, logfile))
+    returncode, seconds, log = runupdater(workdir, args.pathrows, updaterargs, logfile)
+    stats = server.getstats()
+    result = {'scale': numscenes,
+              'served': server.numscenes,
+              'returncode': returncode,
+              'seconds': seconds,
+              'calls': stats['calls'],
+              'httpcalls': stats['total'],
+              'bytesin': stats['bytesin'],
+              'bytesout': stats['bytesout'],
+              'maxrssMB': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0, # the largest child so far, in kB on Linux
+              'written': None,
+              'transactions': None,
+              'gpkgseconds': None}
+    m = re.search(r'Wrote (\d+) features to layer \S+ in (\d+) transactions, ([\d.]+) seconds', log)
+    if m:
+        result['written'] = int(m.group(1))
+        result['transactions'] = int(m.group(2))
+        result['gpkgseconds'] = float(m.group(3))
+    result['scenespersecond'] = (result['written'] or 0) / seconds
+    if args.rerun and returncode == 0:
+        sceneID = invalidateoldest(os.path.join(workdir, 'catdir', 'ieo_catalog.gpkg'))
+        logfile = os.path.join(workdir, 'updatelandsat_rerun.log')
+        print('Running updatelandsat.py again to reimport scene {}, logging to {}.'.format(sceneID, logfile))
+        server.resetstats()
+        rerun = runupdater(workdir, args.pathrows, updaterargs, logfile)
+        stats = server.getstats()
+        result['rerun'] = {'reimported': sceneID,
+                           'returncode': rerun[0],
+                           'seconds': rerun[1],
+                           'calls': stats['calls'],
+                           'httpcalls': stats['total'],
+                           'bytesin': stats['bytesin'],
+                           'bytesout': stats['bytesout'],
+                           'unchanged': len(re.findall(r'No changes found in collection', rerun[2]))}
+        returncode = max(returncode, rerun[0])
+    server.stop()
+    if args.keep or returncode != 0:
+        result['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir)
+    return result
+
+def printresults(results):
+    print('\n{:>8} {:>8} {:>9} {:>9} {:>7} {:>7} {:>9} {:>10} {:>10} {:>9}'.format('Scale', 'Written', 'Wall (s)', 'Scenes/s', 'Search', 'Meta', 'HTTP all', 'MB in/out', 'GPKG (s)', 'RSS (MB)'))
+    for result in results:
+        gpkgseconds = '-'
+        if result['gpkgseconds'] is not None:
+            gpkgseconds = '{:0.2f}'.format(result['gpkgseconds'])
+        print('{:>8} {:>8} {:>9.2f} {:>9.1f} {:>7} {:>7} {:>9} {:>10} {:>10} {:>9.0f}'.format(result['scale'], str(result['written']), result['seconds'],
+            result['scenespersecond'], result['calls'].get('search', 0), result['calls'].get('metadata', 0), result['httpcalls'],
+            '{:0.1f}/{:0.1f}'.format(result['bytesin'] / 1024 ** 2, result['bytesout'] / 1024 ** 2), gpkgseconds, result['maxrssMB']))
+    reruns = [result for result in results if 'rerun' in result]
+    if len(reruns) > 0:
+        print('\nRuns reimporting the earliest scene, with all other years unchanged:')
+        print('{:>8} {:>9} {:>9} {:>7} {:>7} {:>7} {:>9} {:>10}'.format('Scale', 'Wall (s)', 'Unchanged', 'Search', 'Hits', 'Meta', 'HTTP all', 'MB in/out'))
+        for result in reruns:
+            rerun = result['rerun']
+            print('{:>8} {:>9.2f} {:>9} {:>7} {:>7} {:>7} {:>9} {:>10}'.format(result['scale'], rerun['seconds'], rerun['unchanged'], rerun['calls'].get('search', 0),
+                rerun['calls'].get('hits', 0), rerun['calls'].get('metadata', 0), rerun['httpcalls'],
+                '{:0.2f}/{:0.2f}'.format(rerun['bytesin'] / 1024 ** 2, rerun['bytesout'] / 1024 ** 2)))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3 and sys.argv[1] == '--child': # --child workdir pathrowvals updatelandsat.py arguments...
+        runchild(sys.argv[2], sys.argv[3], sys.argv[4:])
+        sys.exit()
+
+    parser = argparse.ArgumentParser('This script benchmarks updatelandsat.py against a local stand-in for the USGS/EROS inventory JSON API.')
+    parser.add_argument('-s', '--scales', type = str, default = '1000,10000,100000', help = 'Comma-delimited numbers of synthetic scenes to benchmark (default = "1000,10000,100000").')
+    parser.add_argument('--pathrows', type = str, default = '201,210,20,29', help = 'WRS-2 Paths/ Rows of the synthetic scenes, in updateshp.ini pathrowvals format (default = "201,210,20,29").')
+    parser.add_argument('-m', '--MBR', type = str, default = '35.0,-30.0,62.0,10.0', help = 'MBR passed to updatelandsat.py, so that grid2ll is not queried (default = "35.0,-30.0,62.0,10.0").')
+    parser.add_argument('--startdate', type = str, default = '1982-07-16', help = 'Search start date passed to updatelandsat.py (default = 1982-07-16).')
+    parser.add_argument('--enddate', type = str, default = '2021-12-31', help = 'Search end date, and last synthetic acquisition date (default = 2021-12-31).')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'Seconds of latency added by the stub to each API call (default = 0).')
+    parser.add_argument('--errorrate', type = float, default = 0.0, help = 'Fraction of API calls that the stub fails with HTTP 503 (default = 0).')
+    parser.add_argument('-w', '--workers', type = int, default = 4, help = 'updatelandsat.py --workers (default = 4).')
+    parser.add_argument('--ratelimit', type = float, default = 0.0, help = 'updatelandsat.py --ratelimit, in requests per second (default = 0, unlimited).')
+    parser.add_argument('--writebatch', type = int, default = 1000, help = 'updatelandsat.py --writebatch (default = 1000).')
+    parser.add_argument('--arrow', action = 'store_true', help = 'Pass --arrow to updatelandsat.py.')
+    parser.add_argument('--fullmetadata', action = 'store_true', help = 'Pass --fullmetadata to updatelandsat.py, so that the stub returns metadata with search results.')
+    parser.add_argument('--extra', type = str, default = None, help = 'Additional arguments for updatelandsat.py, as a single quoted string.')
+    parser.add_argument('--workdir', type = str, default = None, help = 'Directory in which scratch directories are created (default = system temporary directory).')
+    parser.add_argument('--rerun', action = 'store_true', help = 'After each scale, invalidate the earliest scene in the catalog and run updatelandsat.py again with the same checkpoint, reporting the HTTP calls made for years that are unchanged.')
+    parser.add_argument('--keep', action = 'store_true', help = 'Keep scratch directories, including catalog geopackages and logs.')
+    parser.add_argument('-o', '--outfile', type = str, default = None, help = 'Write results to this JSON file.')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales.split(','):
+        results.append(runscale(int(scale), args))
+    printresults(results)
+    if args.outfile:
+        with open(args.outfile, 'w') as output:
+            json.dump(results, output, indent = 4)
+        print('Results written to: {}'.format(args.outfile))
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This is a local stand-in for the USGS/EROS inventory JSON API, so that updatelandsat.py can be run and benchmarked without
+# querying the live service. It serves the login, grid2ll, search, hits, and metadata requests with synthetic Landsat scenes that are
+# generated deterministically for the configured WRS-2 Paths/ Rows, and keeps counts of calls and bytes transferred.
+# Search requests with "metadataType": "full" return each scene's metadata fields with its search result.
+# Point updatelandsat.py at it with: --baseURL http://127.0.0.1:<port>/inventory/json/v/
+
+import json, gzip, time, random, bisect, datetime, threading, argparse, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# datasetName: [scene ID prefix, sensor identifier, spacecraft identifier, first acquisition date, last acquisition date]
+datasets = {'landsat_ot_c2_l2' : ['LC8', 'OLI_TIRS', 'LANDSAT_8', '2013-04-11', None],
+            'landsat_etm_c2_l2' : ['LE7', 'ETM', 'LANDSAT_7', '1999-05-28', None],
+            'landsat_tm_c2_l2' : ['LT5', 'TM', 'LANDSAT_5', '1984-03-01', '2013-06-05']}
+
+def parsepathrows(pathrowvals):
+    # This expands a pathrowvals string as used in updateshp.ini (start path, end path, start row, end row, ...) to a list of [path, row]
+    pathrowvals = [int(x) for x in pathrowvals.split(',')]
+    pathrows = []
+    for i in range(int(len(pathrowvals) / 4)):
+        for path in range(pathrowvals[i * 4], pathrowvals[i * 4 + 1] + 1):
+            for row in range(pathrowvals[i * 4 + 2], pathrowvals[i * 4 + 3] + 1):
+                pathrows.append([path, row])
+    return pathrows
+
+def pathrowtolatlon(path, row):
+    # This returns an approximate descending-pass scene centre for a WRS-2 Path/ Row, which is close enough for synthetic footprints
+    lat = (60 - row) * 1.45
+    lon = -64.6 - (path - 1) * 360.0 / 233 + (60 - row) * 0.12
+    while lon < -180:
+        lon += 360
+    return lat, lon
+
+class SceneGenerator(object):
+    # This generates numscenes synthetic scenes across the three Collection 2 datasets, in proportion to the length of each mission
+    # within the period, cycling through pathrows so that each Path/ Row is revisited at regular intervals.
+    def __init__(self, numscenes, pathrows, enddate):
+        self.pathrows = pathrows
+        self.enddate = datetime.datetime.strptime(enddate, '%Y-%m-%d')
+        self.scenes = {} # datasetName: list of [acquisition datetime, sceneID, path, row], sorted by date
+        self.dates = {} # datasetName: list of acquisition date ordinals, for bisection
+        self.index = {} # sceneID: [datasetName, acquisition datetime, path, row]
+        spans = {}
+        for datasetName in datasets.keys():
+            start = datetime.datetime.strptime(datasets[datasetName][3], '%Y-%m-%d')
+            end = self.enddate
+            if datasets[datasetName][4]:
+                end = min(end, datetime.datetime.strptime(datasets[datasetName][4], '%Y-%m-%d'))
+            spans[datasetName] = [start, max((end - start).days, 0)]
+        totaldays = sum(span[1] for span in spans.values())
+        remaining = numscenes
+        for n, datasetName in enumerate(datasets.keys()):
+            start, days = spans[datasetName]
+            if n == len(datasets) - 1:
+                count = remaining
+            else:
+                count = int(round(numscenes * days / max(totaldays, 1)))
+            remaining -= count
+            scenes = []
+            step = days * len(pathrows) / max(count, 1) # days between revisits of each Path/ Row
+            for k in range(count):
+                path, row = pathrows[k % len(pathrows)]
+                j = k // len(pathrows)
+                acqdate = start + datetime.timedelta(days = int(j * step))
+                sceneID = '{}{:03d}{:03d}{}LGN{:02d}'.format(datasets[datasetName][0], path, row, acqdate.strftime('%Y%j'), j % 100)
+                scenes.append([acqdate, sceneID, path, row])
+                self.index[sceneID] = [datasetName, acqdate, path, row]
+            scenes.sort()
+            self.scenes[datasetName] = scenes
+            self.dates[datasetName] = [scene[0].toordinal() for scene in scenes]
+
+    def search(self, datasetName, startdate, enddate):
+        # This returns the scenes of a dataset acquired within a temporal window, inclusive
+        if not datasetName in self.scenes:
+            return []
+        i = bisect.bisect_left(self.dates[datasetName], datetime.datetime.strptime(startdate[:10], '%Y-%m-%d').toordinal())
+        j = bisect.bisect_right(self.dates[datasetName], datetime.datetime.strptime(enddate[:10], '%Y-%m-%d').toordinal())
+        return self.scenes[datasetName][i:j]
+
+    def productid(self, sceneID):
+        datasetName, acqdate, path, row = self.index[sceneID]
+        processed = acqdate + datetime.timedelta(days = 30)
+        return '{}0{}_L2SP_{:03d}{:03d}_{}_{}_02_T1'.format(sceneID[:2], sceneID[2], path, row, acqdate.strftime('%Y%m%d'), processed.strftime('%Y%m%d'))
+
+    def footprint(self, path, row):
+        lat, lon = pathrowtolatlon(path, row)
+        ring = [[lon - 1.35, lat + 0.75], [lon + 0.95, lat + 0.95], [lon + 1.35, lat - 0.75], [lon - 0.95, lat - 0.95]]
+        ring.append(ring[0])
+        return {'type': 'Polygon', 'coordinates': [ring]}
+
+    def searchresult(self, baseURL, scene):
+        acqdate, sceneID, path, row = scene
+        productid = self.productid(sceneID)
+        return {'entityId': sceneID,
+                'displayId': productid,
+                'acquisitionDate': acqdate.strftime('%Y-%m-%d'),
+                'modifiedDate': (acqdate + datetime.timedelta(days = 30)).strftime('%Y-%m-%d'),
+                'browseUrl': '{}browse/{}.jpg'.format(baseURL, productid),
+                'dataAccessUrl': '{}access/{}'.format(baseURL, sceneID),
+                'downloadUrl': '{}download/{}'.format(baseURL, sceneID),
+                'metadataUrl': '{}metadata/{}.xml'.format(baseURL, sceneID),
+                'fgdcMetadataUrl': '{}fgdc/{}.xml'.format(baseURL, sceneID),
+                'orderUrl': '{}order/{}'.format(baseURL, sceneID),
+                'spatialFootprint': self.footprint(path, row)}
+
+    def metadata(self, baseURL, sceneID):
+        # This returns a metadata item for a scene, with the fields that updatelandsat.py stores in the catalog
+        datasetName, acqdate, path, row = self.index[sceneID]
+        prefix, sensor, spacecraft = datasets[datasetName][:3]
+        lat, lon = pathrowtolatlon(path, row)
+        r = random.Random(sceneID) # per-scene values are reproducible between runs and calls
+        cc = round(r.uniform(0, 100), 2)
+        start = acqdate.replace(hour = 11, minute = 20) + datetime.timedelta(seconds = r.uniform(0, 600))
+        fields = [['Landsat Product Identifier', self.productid(sceneID)],
+                ['Landsat Scene Identifier', sceneID],
+                ['Acquisition Date', acqdate.strftime('%Y/%m/%d')],
+                ['Collection Category', 'T1'],
+                ['Collection Number', '02'],
+                ['WRS Path', ' {:03d}'.format(path)],
+                ['WRS Row', ' {:03d}'.format(row)],
+                ['Target WRS Path', ' {:03d}'.format(path)],
+                ['Target WRS Row', ' {:03d}'.format(row)],
+                ['Center Latitude dec', '{:0.5f}'.format(lat)],
+                ['Center Longitude dec', '{:0.5f}'.format(lon)],
+                ['Scene Cloud Cover', '{:0.2f}'.format(cc)],
+                ['Land Cloud Cover', '{:0.2f}'.format(min(cc * 1.1, 100))],
+                ['Cloud Cover Truncated', '{:d}'.format(int(cc))],
+                ['Cloud Cover Quadrant Upper Left', '{:0.2f}'.format(r.uniform(0, 100))],
+                ['Cloud Cover Quadrant Upper Right', '{:0.2f}'.format(r.uniform(0, 100))],
+                ['Cloud Cover Quadrant Lower Left', '{:0.2f}'.format(r.uniform(0, 100))],
+                ['Cloud Cover Quadrant Lower Right', '{:0.2f}'.format(r.uniform(0, 100))],
+                ['Sensor Identifier', sensor],
+                ['Spacecraft Identifier', spacecraft],
+                ['Data Type Level-1', '{}_L1TP'.format(sensor)],
+                ['Image Quality', '9'],
+                ['Day/Night Indicator', 'DAY'],
+                ['Sun Elevation L1', '{:0.5f}'.format(r.uniform(10, 60))],
+                ['Sun Azimuth L1', '{:0.5f}'.format(r.uniform(120, 170))],
+                ['Start Time', start.strftime('%Y:%j:%H:%M:%S.%fZ')],
+                ['Stop Time', (start + datetime.timedelta(seconds = 24)).strftime('%Y:%j:%H:%M:%S.%fZ')],
+                ['UTM Zone', '{:d}'.format(int((lon + 180) / 6) + 1)],
+                ['Datum', 'WGS84'],
+                ['Ellipsoid', 'WGS84'],
+                ['Map Projection Level-1', 'UTM'],
+                ['Orientation', 'NORTH_UP'],
+                ['Ephemeris Type', 'DEFINITIVE'],
+                ['Ground Control Points Model', '{:d}'.format(r.randint(100, 900))],
+                ['Ground Control Points Version', '5'],
+                ['Geometric RMSE Model (meters)', '{:0.3f}'.format(r.uniform(3, 9))],
+                ['Geometric RMSE Model X', '{:0.3f}'.format(r.uniform(2, 6))],
+                ['Geometric RMSE Model Y', '{:0.3f}'.format(r.uniform(2, 6))],
+                ['Output Format', 'GEOTIFF'],
+                ['Resampling Option', 'CUBIC_CONVOLUTION'],
+                ['Reflective Lines', '7991'],
+                ['Reflective Samples', '7891'],
+                ['Thermal Lines', '7991'],
+                ['Thermal Samples', '7891'],
+                ['Grid Cell Size Reflective', '30'],
+                ['Grid Cell Size Thermal', '30'],
+                ['Processing Software Version', 'LPGS_15.3.1c'],
+                ['Date L-1 Generated', (acqdate + datetime.timedelta(days = 30)).strftime('%Y/%m/%d')],
+                ['Station Identifier', 'LGN'],
+                ['Browse Available', 'Y'],
+                ['Full Partial Scene', 'FULL'],
+                ['Nadir/Off Nadir', 'NADIR']]
+        return {'entityId': sceneID,
+                'displayId': self.productid(sceneID),
+                'acquisitionDate': acqdate.strftime('%Y-%m-%d'),
+                'modifiedDate': (acqdate + datetime.timedelta(days = 30)).strftime('%Y-%m-%d'),
+                'browseUrl': '{}browse/{}.jpg'.format(baseURL, self.productid(sceneID)),
+                'spatialFootprint': self.footprint(path, row),
+                'metadataFields': [{'fieldName': fieldname, 'value': value} for fieldname, value in fields]}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive, as the USGS servers do
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        url = urllib.parse.urlparse(self.path)
+        endpoint = url.path.rstrip('/').split('/')[-1]
+        if url.path.rstrip('/') == '/stats':
+            self.respond(200, self.server.getstats(), count = False)
+            return
+        params = {}
+        for source in [url.query, body.decode('utf-8')]:
+            fields = urllib.parse.parse_qs(source)
+            if 'jsonRequest' in fields:
+                params = json.loads(fields['jsonRequest'][0])
+        self.server.count(endpoint, len(self.requestline) + len(str(self.headers)) + len(body))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if self.server.errorrate > 0 and self.server.random() < self.server.errorrate:
+            self.respond(503, {'errorCode': 'UNKNOWN', 'error': 'Synthetic error', 'data': None})
+            return
+        if endpoint == 'login':
+            response = {'errorCode': None, 'error': '', 'data': 'stubapikey'}
+        elif endpoint == 'grid2ll':
+            lat, lon = pathrowtolatlon(int(params.get('path', 1)), int(params.get('row', 1)))
+            response = {'errorCode': None, 'error': '', 'data': {'coordinates': [{'latitude': lat, 'longitude': lon}]}}
+        elif endpoint == 'search':
+            response = self.search(params)
+        elif endpoint == 'hits':
+            temporalFilter = params.get('temporalFilter', {})
+            scenes = self.server.generator.search(params.get('datasetName'), temporalFilter.get('startDate', '1970-01-01'), temporalFilter.get('endDate', '2099-12-31'))
+            response = {'errorCode': None, 'error': '', 'data': len(scenes)}
+        elif endpoint == 'metadata':
+            sceneIDs = [sceneID for sceneID in params.get('entityIds', '').split(',') if sceneID in self.server.generator.index]
+            response = {'errorCode': None, 'error': '', 'data': [self.server.generator.metadata(self.server.baseURL, sceneID) for sceneID in sceneIDs]}
+        else:
+            self.respond(404, {'errorCode': 'NOT_FOUND', 'error': 'Unknown endpoint {}'.format(endpoint), 'data': None})
+            return
+        self.respond(200, response)
+
+    def search(self, params):
+        temporalFilter = params.get('temporalFilter', {})
+        scenes = self.server.generator.search(params.get('datasetName'), temporalFilter.get('startDate', '1970-01-01'), temporalFilter.get('endDate', '2099-12-31'))
+        first = max(int(params.get('startingNumber', 1)), 1)
+        maxResults = int(params.get('maxResults', 50000))
+        results = [self.server.generator.searchresult(self.server.baseURL, scene) for scene in scenes[first - 1: first - 1 + maxResults]]
+        if params.get('metadataType') == 'full': # as offered by the USGS machine-to-machine scene-search
+            for result in results:
+                result['metadataFields'] = self.server.generator.metadata(self.server.baseURL, result['entityId'])['metadataFields']
+        nextRecord = first + len(results)
+        if nextRecord > len(scenes):
+            nextRecord = len(scenes)
+        return {'errorCode': None, 'error': '', 'data': {'totalHits': len(scenes), 'firstRecord': first, 'lastRecord': first + len(results) - 1, 'nextRecord': nextRecord, 'numberReturned': len(results), 'results': results}}
+
+    def respond(self, status, response, count = True):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel = 5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if count:
+            self.server.sent(len(data))
+
+class StubServer(ThreadingHTTPServer):
+    # This serves the stand-in API from a background thread. Use port 0 to have a free port chosen.
+    daemon_threads = True
+
+    def __init__(self, numscenes, pathrows, enddate, host = '127.0.0.1', port = 0, latency = 0.0, errorrate = 0.0, compress = True, seed = 0, verbose = False):
+        ThreadingHTTPServer.__init__(self, (host, port), StubHandler)
+        self.generator = SceneGenerator(numscenes, pathrows, enddate)
+        self.numscenes = len(self.generator.index)
+        self.latency = latency
+        self.errorrate = errorrate
+        self.compress = compress
+        self.verbose = verbose
+        self.baseURL = 'http://{}:{}/inventory/json/v/'.format(host, self.server_address[1])
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.thread = None
+        self.resetstats()
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def count(self, endpoint, bytesin):
+        with self.lock:
+            self.stats['calls'][endpoint] = self.stats['calls'].get(endpoint, 0) + 1
+            self.stats['bytesin'] += bytesin
+
+    def sent(self, bytesout):
+        with self.lock:
+            self.stats['bytesout'] += bytesout
+
+    def resetstats(self):
+        self.stats = {'calls': {}, 'bytesin': 0, 'bytesout': 0}
+
+    def getstats(self):
+        with self.lock:
+            stats = json.loads(json.dumps(self.stats))
+        stats['total'] = sum(stats['calls'].values())
+        return stats
+
+    def start(self):
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self.thread.start()
+        return self.baseURL
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('This script runs a local stand-in for the USGS/EROS inventory JSON API, serving synthetic Landsat scenes.')
+    parser.add_argument('--host', type = str, default = '127.0.0.1', help = 'Address to listen on (default = 127.0.0.1).')
+    parser.add_argument('--port', type = int, default = 8765, help = 'Port to listen on (default = 8765).')
+    parser.add_argument('-n', '--scenes', type = int, default = 1000, help = 'Number of synthetic scenes to serve (default = 1000).')
+    parser.add_argument('--pathrows', type = str, default = '201,210,20,29', help = 'WRS-2 Paths/ Rows of the synthetic scenes, in updateshp.ini pathrowvals format (default = "201,210,20,29").')
+    parser.add_argument('--enddate', type = str, default = '2021-12-31', help = 'Latest acquisition date of the synthetic scenes in YYYY-MM-DD format (default = 2021-12-31).')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'Seconds of latency added to each API call (default = 0).')
+    parser.add_argument('--errorrate', type = float, default = 0.0, help = 'Fraction of API calls that fail with HTTP 503, to exercise retries (default = 0).')
+    parser.add_argument('--nogzip', action = 'store_true', help = 'Do not gzip-compress responses.')
+    parser.add_argument('--verbose', action = 'store_true', help = 'Log every request.')
+    args = parser.parse_args()
+
+    server = StubServer(args.scenes, parsepathrows(args.pathrows), args.enddate, host = args.host, port = args.port, latency = args.latency, errorrate = args.errorrate, compress = not args.nogzip, verbose = args.verbose)
+    print('Serving {} synthetic scenes at {} (statistics at http://{}:{}/stats).'.format(server.numscenes, server.baseURL, args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nStopping. {}'.format(json.dumps(server.getstats())))
+        server.server_close()
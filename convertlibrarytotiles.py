@@ -12,7 +12,7 @@
 # 4. Calculates NDVI and EVI for clear land pixels
 # 5. Archives tar.gz files after use
 
-import os, sys, glob, argparse#, ieo, datetime, shutil
+import os, sys, glob, argparse, ieoprofile #, ieo, datetime, shutil
 #from osgeo import ogr
 
 try: # This is included as the module may not properly install in Anaconda.
@@ -46,8 +46,11 @@ parser.add_argument('-o','--outdir', type = str, default = None, help = 'Output
 parser.add_argument('-v','--vrt', type = bool, default = False, help = 'Use VRTs rather than input files.')
 parser.add_argument('-k','--skipqa', action = 'store_true', help = 'Skip conversion of Pixel QA and Fmask files.')
 parser.add_argument('-nu','--noupdate', action = 'store_true', help = 'Do not update tiles with new data.')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('convertlibrarytotiles', args.profile) # does nothing unless --profile is set
+
 dirs = [args.pixelqadir, args.fmaskdir, args.srdir, args.btdir, args.ndvidir, args.evidir]
 
 if args.outdir:
@@ -85,7 +88,8 @@ for d in dirs:
             else:
                 pixelqa = True
             try:
-                ieo.converttotiles(f, outdir, rastertype, pixelqa = pixelqa, overwrite = args.overwrite, noupdate = args.noupdate)
+                with profiler.phase('convert'):
+                    ieo.converttotiles(f, outdir, rastertype, pixelqa = pixelqa, overwrite = args.overwrite, noupdate = args.noupdate)
             except Exception as e:
                 ieo.logerror(f, e)
                 print('ERROR with file {}:\n{}'.format(f,e))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module records where the IEOtools scripts spend their time, so that scheduled runs can be monitored. Scripts time their
+# stages with nested spans, and count events such as HTTP calls, bytes received, features written, files globbed, and rasters
+# converted. At the end of a run, or at exit if the run did not finish, a JSON run report is written, and optionally a Prometheus
+# textfile for the node_exporter textfile collector. Both files are written to temporary files and renamed into place.
+
+import os, json, time, socket, atexit, tempfile, datetime, threading
+
+defaultbuckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0) # seconds
+
+def writeatomic(filename, text):
+    # This writes text to a temporary file in the destination directory, and renames it into place
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(suffix = '.tmp', dir = dirname)
+    try:
+        with os.fdopen(fd, 'w') as output:
+            output.write(text)
+        os.replace(tmpname, filename)
+    except:
+        if os.path.isfile(tmpname):
+            os.remove(tmpname)
+        raise
+
+def promlabels(labels):
+    # This formats a dict of labels for a Prometheus sample, escaping values as required by the text format
+    if len(labels) == 0:
+        return ''
+    items = []
+    for key in sorted(labels.keys()):
+        value = str(labels[key]).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        items.append('{}="{}"'.format(key, value))
+    return '{' + ','.join(items) + '}'
+
+class Span(object):
+    # A timed stage of a run. Spans are used as context managers, or with start() and stop() in flat script code, and nest
+    # per thread: a span started while another is open on the same thread becomes its child. set() adds attributes.
+    def __init__(self, metrics, name, attrs):
+        self.metrics = metrics
+        self.name = name
+        self.attrs = attrs
+        self.id = None
+        self.parent = None
+        self.started = None
+        self.seconds = None
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def start(self):
+        self.metrics.startspan(self)
+        return self
+
+    def stop(self, error = None):
+        if self.seconds is None:
+            self.error = error
+            self.metrics.stopspan(self)
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.stop(error = '{}: {}'.format(exc_type.__name__, exc_value))
+        else:
+            self.stop()
+        return False
+
+class Metrics(object):
+    # Stage totals are kept per span name, counters and histograms per (name, labels). Only the first maxspans spans are kept
+    # individually in the JSON report; the rest are still included in the stage totals. All methods are thread safe.
+    def __init__(self, script, jsonfile = None, promfile = None, maxspans = 10000, verbose = False):
+        self.script = script
+        self.jsonfile = jsonfile
+        self.promfile = promfile
+        self.maxspans = maxspans
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        self.stages = {} # name: [calls, seconds, errors]
+        self.counters = {} # (name, labels): value
+        self.histograms = {} # (name, labels): [buckets, bucket counts, sum, count]
+        self.spans = []
+        self.droppedspans = 0
+        self.nextid = 1
+        self.status = None
+        atexit.register(self.atexit)
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def startspan(self, span):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = []
+            self.local.stack = stack
+        with self.lock:
+            span.id = self.nextid
+            self.nextid += 1
+        if len(stack) > 0:
+            span.parent = stack[-1].id
+        span.started = time.perf_counter()
+        stack.append(span)
+
+    def stopspan(self, span):
+        span.seconds = time.perf_counter() - span.started
+        stack = getattr(self.local, 'stack', [])
+        if span in stack:
+            stack.remove(span)
+        with self.lock:
+            stage = self.stages.setdefault(span.name, [0, 0.0, 0])
+            stage[0] += 1
+            stage[1] += span.seconds
+            if span.error:
+                stage[2] += 1
+            if len(self.spans) < self.maxspans:
+                record = {'id': span.id, 'parent': span.parent, 'name': span.name, 'thread': threading.current_thread().name,
+                          'start': round(span.started - self.clock, 6), 'seconds': round(span.seconds, 6)}
+                if len(span.attrs) > 0:
+                    record['attrs'] = span.attrs
+                if span.error:
+                    record['error'] = span.error
+                self.spans.append(record)
+            else:
+                self.droppedspans += 1
+
+    def count(self, name, value = 1, **labels):
+        # This adds value to a counter, e.g. count('files_globbed', len(flist), dir = 'SR')
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets = defaultbuckets, **labels):
+        # This adds an observation, e.g. a request latency in seconds, to a histogram
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [tuple(buckets), [0] * len(buckets), 0.0, 0]
+                self.histograms[key] = histogram
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def report(self):
+        # This returns the run report as a dict
+        with self.lock:
+            stages = {}
+            for name, (calls, seconds, errors) in self.stages.items():
+                stages[name] = {'calls': calls, 'seconds': round(seconds, 6), 'errors': errors}
+            counters = []
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.append({'name': name, 'labels': dict(labels), 'value': value})
+            histograms = []
+            for (name, labels), (buckets, bucketcounts, total, count) in sorted(self.histograms.items()):
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': dict(zip([str(bound) for bound in buckets], bucketcounts)),
+                                   'sum': round(total, 6), 'count': count})
+            spans = list(self.spans)
+            droppedspans = self.droppedspans
+        return {'script': self.script,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'started': datetime.datetime.fromtimestamp(self.started).strftime('%Y-%m-%d %H:%M:%S'),
+                'seconds': round(time.perf_counter() - self.clock, 6),
+                'status': self.status,
+                'stages': stages,
+                'counters': counters,
+                'histograms': histograms,
+                'spans': spans,
+                'droppedspans': droppedspans}
+
+    def prometheus(self, report):
+        # This formats the run report in the Prometheus text exposition format. Metric names are prefixed with "ieotools_",
+        # and every sample is labelled with the script name.
+        script = {'script': self.script}
+        lines = ['# HELP ieotools_last_run_timestamp_seconds Start time of the last run.',
+                 '# TYPE ieotools_last_run_timestamp_seconds gauge',
+                 'ieotools_last_run_timestamp_seconds{} {}'.format(promlabels(script), self.started),
+                 '# HELP ieotools_run_duration_seconds Duration of the last run.',
+                 '# TYPE ieotools_run_duration_seconds gauge',
+                 'ieotools_run_duration_seconds{} {}'.format(promlabels(script), report['seconds']),
+                 '# HELP ieotools_run_success Whether the last run completed.',
+                 '# TYPE ieotools_run_success gauge',
+                 'ieotools_run_success{} {}'.format(promlabels(script), int(report['status'] == 'complete'))]
+        if len(report['stages']) > 0:
+            lines.extend(['# HELP ieotools_stage_seconds Time spent in each stage of the last run.', '# TYPE ieotools_stage_seconds gauge'])
+            for name in sorted(report['stages'].keys()):
+                lines.append('ieotools_stage_seconds{} {}'.format(promlabels(dict(script, stage = name)), report['stages'][name]['seconds']))
+            lines.extend(['# HELP ieotools_stage_calls Number of times each stage ran in the last run.', '# TYPE ieotools_stage_calls gauge'])
+            for name in sorted(report['stages'].keys()):
+                lines.append('ieotools_stage_calls{} {}'.format(promlabels(dict(script, stage = name)), report['stages'][name]['calls']))
+        typed = set()
+        for counter in report['counters']:
+            metric = 'ieotools_{}'.format(counter['name'])
+            if not metric in typed:
+                lines.append('# TYPE {} gauge'.format(metric))
+                typed.add(metric)
+            lines.append('{}{} {}'.format(metric, promlabels(dict(script, **counter['labels'])), counter['value']))
+        for histogram in report['histograms']:
+            metric = 'ieotools_{}'.format(histogram['name'])
+            if not metric in typed:
+                lines.append('# TYPE {} histogram'.format(metric))
+                typed.add(metric)
+            labels = dict(script, **histogram['labels'])
+            for bound, value in histogram['buckets'].items():
+                lines.append('{}_bucket{} {}'.format(metric, promlabels(dict(labels, le = bound)), value))
+            lines.append('{}_bucket{} {}'.format(metric, promlabels(dict(labels, le = '+Inf')), histogram['count']))
+            lines.append('{}_sum{} {}'.format(metric, promlabels(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(metric, promlabels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        # This writes the JSON run report and the Prometheus textfile, if either has been set
+        report = self.report()
+        try:
+            if self.jsonfile:
+                writeatomic(self.jsonfile, json.dumps(report, indent = 1))
+                if self.verbose:
+                    print('Run report written to: {}'.format(self.jsonfile))
+            if self.promfile:
+                writeatomic(self.promfile, self.prometheus(report))
+        except OSError as e:
+            print('Error writing run metrics: {}'.format(e))
+        return report
+
+    def finish(self, status = 'complete'):
+        # This records the final status of the run, and writes its report
+        self.status = status
+        return self.write()
+
+    def atexit(self):
+        # A run that exits without calling finish(), e.g. after an error, is reported as failed
+        if self.status is None:
+            self.finish('failed')
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module implements the --profile option of the IEOtools scripts. When enabled, each phase of a run (e.g. setup, search,
+# parse, write, thumbnails, convert) is profiled with its own cProfile.Profile, and memory allocations are traced with tracemalloc.
+# At the end of the run, each phase's statistics are written to a .pstats file, and a text summary of the slowest functions per
+# phase and the top allocation sites is written alongside them, all named by script and start time. When disabled, phase()
+# returns a shared no-op context manager, and neither cProfile nor tracemalloc is started.
+
+import os, io, time, atexit, pstats, cProfile, datetime, threading, contextlib, tracemalloc
+
+nullphase = contextlib.nullcontext()
+
+class Profiler(object):
+    # Only the thread that creates the Profiler, normally the main thread, is profiled; work done in worker pools appears as time
+    # spent waiting on their results. Phases nest: the enclosing phase is paused while a nested one runs. Time outside any named
+    # phase is attributed to "setup" until the first phase is entered, and to "other" after that.
+    def __init__(self, script, outdir = None, topn = 25, frames = 1):
+        self.script = script
+        self.outdir = outdir
+        self.enabled = outdir is not None
+        self.topn = topn
+        if not self.enabled:
+            return
+        self.stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.thread = threading.get_ident()
+        self.profiles = {} # phase name: cProfile.Profile
+        self.seconds = {} # phase name: wall time in seconds
+        self.stack = []
+        self.closed = False
+        tracemalloc.start(frames)
+        self.push('setup')
+        atexit.register(self.close)
+
+    def push(self, name):
+        if len(self.stack) > 0:
+            self.pause(self.stack[-1])
+        if not name in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+            self.seconds[name] = 0.0
+        self.stack.append([name, time.perf_counter()])
+        self.profiles[name].enable()
+
+    def pause(self, entry):
+        self.profiles[entry[0]].disable()
+        self.seconds[entry[0]] += time.perf_counter() - entry[1]
+
+    def pop(self):
+        self.pause(self.stack.pop())
+        if len(self.stack) == 1 and self.stack[0][0] == 'setup': # the rest of the run outside named phases
+            self.stack[0][0] = 'other'
+            if not 'other' in self.profiles:
+                self.profiles['other'] = cProfile.Profile()
+                self.seconds['other'] = 0.0
+        if len(self.stack) > 0:
+            self.stack[-1][1] = time.perf_counter()
+            self.profiles[self.stack[-1][0]].enable()
+
+    @contextlib.contextmanager
+    def profiledphase(self, name):
+        self.push(name)
+        try:
+            yield
+        finally:
+            self.pop()
+
+    def phase(self, name):
+        # This returns a context manager that profiles its block as the named phase
+        if not self.enabled or self.closed or threading.get_ident() != self.thread:
+            return nullphase
+        return self.profiledphase(name)
+
+    def start(self, name):
+        # This starts a named phase in flat script code, to be ended with stop()
+        if self.enabled and not self.closed and threading.get_ident() == self.thread:
+            self.push(name)
+
+    def stop(self):
+        if self.enabled and not self.closed and threading.get_ident() == self.thread and len(self.stack) > 1:
+            self.pop()
+
+    def close(self):
+        # This stops profiling, and writes each phase's statistics and the summary. It is also called at exit.
+        if not self.enabled or self.closed:
+            return
+        while len(self.stack) > 0:
+            self.pause(self.stack.pop())
+        self.closed = True
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        basename = os.path.join(self.outdir, '{}_{}'.format(self.script, self.stamp))
+        summary = io.StringIO()
+        summary.write('Profile of {} started {}\n\n'.format(self.script, self.stamp))
+        for name, profile in self.profiles.items():
+            try:
+                stats = pstats.Stats(profile, stream = summary)
+            except TypeError: # a phase in which no functions were called
+                continue
+            stats.dump_stats('{}_{}.pstats'.format(basename, name))
+            summary.write('## Phase: {}, {:0.3f} seconds\n'.format(name, self.seconds[name]))
+            stats.sort_stats('cumulative').print_stats(self.topn)
+        summary.write('## Memory: {:0.1f} MB traced at exit, {:0.1f} MB peak. Top {} allocation sites:\n\n'.format(current / 1024 ** 2, peak / 1024 ** 2, self.topn))
+        for stat in snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('lineno')[:self.topn]:
+            summary.write('{}\n'.format(stat))
+        with open('{}_profile.txt'.format(basename), 'w') as output:
+            output.write(summary.getvalue())
+        print('Profile written to: {}_profile.txt'.format(basename))
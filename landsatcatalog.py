@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module contains functions shared by the IEOtools scripts for reading and writing the Landsat catalog layer in ieo.catgpkg.
+
+import csv, gzip, time, datetime, struct
+import numpy as np
+from osgeo import ogr
+
+## SceneID index functions
+
+def createsceneidindex(data_source, layername):
+    # This creates a persistent SQLite index on the sceneID column of the catalog layer, if it does not already exist
+    data_source.ExecuteSQL('CREATE INDEX IF NOT EXISTS "idx_{0}_sceneID" ON "{0}" ("sceneID")'.format(layername))
+
+def loadsceneidindex(data_source, layer, layername):
+    # This returns a dict of sceneID: FID for every feature in the catalog layer, read with a single query on the indexed column
+    fidcolumn = layer.GetFIDColumn()
+    if not fidcolumn:
+        fidcolumn = 'fid'
+    sceneidindex = {}
+    result = data_source.ExecuteSQL('SELECT CAST("{}" AS INTEGER) AS scenefid, "sceneID" FROM "{}" WHERE "sceneID" IS NOT NULL'.format(fidcolumn, layername))
+    if result:
+        for feature in result:
+            sceneidindex[feature.GetField('sceneID')] = feature.GetField('scenefid')
+        data_source.ReleaseResultSet(result)
+    return sceneidindex
+
+def getscenefeature(layer, sceneidindex, sceneID):
+    # This fetches the catalog feature for a sceneID directly by FID, or returns None if the scene is not in the layer
+    fid = sceneidindex.get(sceneID)
+    if fid is None:
+        return None
+    return layer.GetFeature(fid)
+
+## Validation functions
+
+def sqlrows(data_source, sql):
+    # This runs a query on the data source and returns its rows as lists of field values
+    rows = []
+    result = data_source.ExecuteSQL(sql)
+    if result:
+        for feature in result:
+            rows.append([feature.GetField(i) for i in range(feature.GetFieldCount())])
+        data_source.ReleaseResultSet(result)
+    return rows
+
+def validatecatalog(data_source, layer, layername, sensors):
+    # This runs the catalog validation checks as SQL on the geopackage, rather than reading every feature, and returns a dict of:
+    # 'invalid': [FID, sceneID] of features with no sceneID or a sensor identifier not in sensors, which need to be reimported
+    # 'lastmodified': the latest dateUpdated of the remaining features, as 'YYYY-MM-DD', or None if there are none
+    # 'updatemissing': sceneIDs of the remaining features with a missing or malformed dateUpdated
+    # 'badgeom': sceneIDs of the remaining features with missing, empty, or degenerate (zero width or height) geometries
+    fidcolumn = layer.GetFIDColumn()
+    if not fidcolumn:
+        fidcolumn = 'fid'
+    geometrycolumn = layer.GetGeometryColumn()
+    if not geometrycolumn:
+        geometrycolumn = 'geom'
+    sensorlist = ','.join("'{}'".format(sensor.replace("'", "''")) for sensor in sensors)
+    valid = "\"sceneID\" IS NOT NULL AND COALESCE(\"SensorID\", '') IN ({})".format(sensorlist)
+    dateUpdated = "substr(replace(\"dateUpdated\", '/', '-'), 1, 10)" # dates written by older versions may use slashes
+    validation = {}
+    validation['invalid'] = sqlrows(data_source, 'SELECT CAST("{}" AS INTEGER) AS scenefid, "sceneID" FROM "{}" WHERE NOT ({})'.format(fidcolumn, layername, valid))
+    rows = sqlrows(data_source, "SELECT MAX({0}) AS lastmodified FROM \"{1}\" WHERE {2} AND {0} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'".format(dateUpdated, layername, valid))
+    validation['lastmodified'] = None
+    if len(rows) > 0 and rows[0][0]:
+        validation['lastmodified'] = str(rows[0][0]).replace('/', '-')[:10]
+    validation['updatemissing'] = [row[0] for row in sqlrows(data_source, "SELECT \"sceneID\" FROM \"{}\" WHERE {} AND (\"dateUpdated\" IS NULL OR NOT {} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]')".format(layername, valid, dateUpdated))]
+    validation['badgeom'] = [row[0] for row in sqlrows(data_source, 'SELECT "sceneID" FROM "{0}" WHERE {1} AND ("{2}" IS NULL OR ST_IsEmpty("{2}") OR ST_MinX("{2}") = ST_MaxX("{2}") OR ST_MinY("{2}") = ST_MaxY("{2}"))'.format(layername, valid, geometrycolumn))]
+    return validation
+
+## Feature writing functions
+
+def arrowsupported(layer):
+    # This checks whether GDAL (3.8 or later) and pyarrow are available for columnar writes to the layer
+    if not hasattr(layer, 'WritePyArrow'):
+        return False
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return bool(layer.TestCapability('FastWriteArrowBatch'))
+
+class CatalogWriter(object):
+    # This adds new features to the catalog layer in transactions of up to batchsize features, rather than one autocommit
+    # per feature. If arrow is True and supported, each batch is written as a single Arrow record batch instead.
+    # If a sceneidindex dict is supplied, it is updated with the FIDs of the new features.
+    def __init__(self, data_source, layer, layername, batchsize = 1000, arrow = False, sceneidindex = None, verbose = False):
+        self.data_source = data_source
+        self.layer = layer
+        self.layername = layername
+        self.batchsize = max(batchsize, 1)
+        self.sceneidindex = sceneidindex
+        self.verbose = verbose
+        self.arrow = arrow and arrowsupported(layer)
+        if arrow and not self.arrow:
+            print('Warning: Arrow batch writes are not supported by this GDAL/ pyarrow installation, writing features individually.')
+        self.pending = []
+        self.count = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def add(self, feature):
+        self.pending.append(feature)
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        # This writes all pending features in one transaction
+        if len(self.pending) == 0:
+            return
+        start = time.perf_counter()
+        written = False
+        if self.arrow:
+            self.layer.StartTransaction()
+            try:
+                self.layer.WritePyArrow(self.arrowbatch(self.pending))
+                self.layer.CommitTransaction()
+                written = True
+                if self.sceneidindex is not None:
+                    self.indexfids([feature.GetField('sceneID') for feature in self.pending])
+            except Exception as e:
+                self.layer.RollbackTransaction()
+                print('Error writing Arrow batch ({}), falling back to writing features individually.'.format(e))
+                self.arrow = False
+        if not written:
+            self.layer.StartTransaction()
+            try:
+                for feature in self.pending:
+                    self.layer.CreateFeature(feature)
+                    if self.sceneidindex is not None:
+                        self.sceneidindex[feature.GetField('sceneID')] = feature.GetFID()
+                self.layer.CommitTransaction()
+            except Exception:
+                self.layer.RollbackTransaction() # none of the batch was written, so it is dropped, and its FIDs from the index
+                for feature in self.pending:
+                    if self.sceneidindex is not None and self.sceneidindex.get(feature.GetField('sceneID')) == feature.GetFID():
+                        del self.sceneidindex[feature.GetField('sceneID')]
+                    feature.Destroy()
+                self.pending = []
+                raise
+        self.seconds += time.perf_counter() - start
+        self.count += len(self.pending)
+        self.batches += 1
+        if self.verbose:
+            print('Committed {} features to geopackage layer ({} total).'.format(len(self.pending), self.count))
+        for feature in self.pending:
+            feature.Destroy()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        return self.report()
+
+    def report(self):
+        rate = 0.0
+        if self.seconds > 0:
+            rate = self.count / self.seconds
+        print('Wrote {} features to layer {} in {} transactions, {:0.2f} seconds ({:0.1f} features/s).'.format(self.count, self.layername, self.batches, self.seconds, rate))
+        return {'features': self.count, 'transactions': self.batches, 'seconds': self.seconds, 'rate': rate}
+
+    def indexfids(self, sceneIDs):
+        # Arrow writes do not hand back FIDs, so these are read back for the batch from the sceneID index
+        fidcolumn = self.layer.GetFIDColumn()
+        if not fidcolumn:
+            fidcolumn = 'fid'
+        idlist = ','.join("'{}'".format(sceneID.replace("'", "''")) for sceneID in sceneIDs)
+        result = self.data_source.ExecuteSQL('SELECT CAST("{}" AS INTEGER) AS scenefid, "sceneID" FROM "{}" WHERE "sceneID" IN ({})'.format(fidcolumn, self.layername, idlist))
+        if result:
+            for feature in result:
+                self.sceneidindex[feature.GetField('sceneID')] = feature.GetField('scenefid')
+            self.data_source.ReleaseResultSet(result)
+
+    def arrowbatch(self, features):
+        # This converts a list of OGR features to a pyarrow RecordBatch matching the layer definition, with WKB geometries
+        import pyarrow as pa
+        layerDefinition = self.layer.GetLayerDefn()
+        fields = []
+        arrays = []
+        for i in range(layerDefinition.GetFieldCount()):
+            fieldDefn = layerDefinition.GetFieldDefn(i)
+            fieldtype = fieldDefn.GetType()
+            values = []
+            for feature in features:
+                if not feature.IsFieldSetAndNotNull(i):
+                    values.append(None)
+                elif fieldtype == ogr.OFTInteger:
+                    values.append(feature.GetFieldAsInteger(i))
+                elif fieldtype == ogr.OFTInteger64:
+                    values.append(feature.GetFieldAsInteger64(i))
+                elif fieldtype == ogr.OFTReal:
+                    values.append(feature.GetFieldAsDouble(i))
+                elif fieldtype == ogr.OFTDate:
+                    values.append(datetime.date(*feature.GetFieldAsDateTime(i)[:3]))
+                elif fieldtype == ogr.OFTDateTime:
+                    dt = feature.GetFieldAsDateTime(i)
+                    values.append(datetime.datetime(dt[0], dt[1], dt[2], dt[3], dt[4], int(dt[5])))
+                else:
+                    values.append(feature.GetFieldAsString(i))
+            if fieldtype == ogr.OFTInteger:
+                arrowtype = pa.int32()
+            elif fieldtype == ogr.OFTInteger64:
+                arrowtype = pa.int64()
+            elif fieldtype == ogr.OFTReal:
+                arrowtype = pa.float64()
+            elif fieldtype == ogr.OFTDate:
+                arrowtype = pa.date32()
+            elif fieldtype == ogr.OFTDateTime:
+                arrowtype = pa.timestamp('ms')
+            else:
+                arrowtype = pa.string()
+            fields.append(pa.field(fieldDefn.GetName(), arrowtype))
+            arrays.append(pa.array(values, type = arrowtype))
+        geometrycolumn = self.layer.GetGeometryColumn()
+        if not geometrycolumn:
+            geometrycolumn = 'geom'
+        geometries = []
+        for feature in features:
+            geom = feature.GetGeometryRef()
+            if geom:
+                geometries.append(bytes(geom.ExportToIsoWkb()))
+            else:
+                geometries.append(None)
+        fields.append(pa.field(geometrycolumn, pa.binary(), metadata = {b'ARROW:extension:name': b'ogc.wkb'}))
+        arrays.append(pa.array(geometries, type = pa.binary()))
+        return pa.RecordBatch.from_arrays(arrays, schema = pa.schema(fields))
+
+class AOILayer(object):
+    # This holds an additional catalog layer synced in the same pass as the configured one, for an area of interest given as a set
+    # of WRS-2 Path/Row strings. Its features are populated through a FieldCodec bound to its own layer definition, so that field
+    # order may differ from that of the configured layer, and new features are written through its own CatalogWriter.
+    def __init__(self, name, pathrowstrs, gpkg, data_source, layer, fieldcodec, writer, sceneidindex, lastmodified = None, created = False):
+        self.name = name
+        self.pathrowstrs = pathrowstrs
+        self.gpkg = gpkg
+        self.data_source = data_source
+        self.layer = layer
+        self.fieldcodec = fieldcodec
+        self.writer = writer
+        self.sceneidindex = sceneidindex
+        self.lastmodified = lastmodified # the latest dateUpdated in the layer, as 'YYYY-MM-DD', or None if it is empty
+        self.created = created
+
+    def covers(self, sceneID):
+        return sceneID[3:9] in self.pathrowstrs
+
+    def needs(self, sceneID):
+        # This returns True if a scene is within the area of interest but not yet in the layer
+        return sceneID[3:9] in self.pathrowstrs and not sceneID in self.sceneidindex
+
+    def close(self):
+        report = self.writer.close()
+        self.layer = None
+        self.data_source = None
+        return report
+
+## Footprint functions
+
+def buildfootprints(coorddict, transform, srs = None):
+    # This builds the local projection footprint polygons for a batch of scenes, with a single TransformPoints call for all of their
+    # vertices. coorddict is sceneID: USGS spatialFootprint ring, as [longitude, latitude] pairs. Each ring is closed if need be,
+    # and its points are passed to the transformation as latitude, longitude, per EPSG:4326 axis order. Returns a dict of
+    # sceneID: ogr.Geometry, from which scenes with malformed footprints or points that could not be transformed are omitted.
+    sceneIDs = []
+    counts = []
+    rings = []
+    for sceneID, coords in coorddict.items():
+        try:
+            ring = np.asarray(coords, dtype = np.float64)
+        except (TypeError, ValueError):
+            continue
+        if ring.ndim != 2 or ring.shape[0] < 3 or ring.shape[1] < 2:
+            continue
+        ring = ring[:, 1::-1]
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        sceneIDs.append(sceneID)
+        counts.append(ring.shape[0])
+        rings.append(ring)
+    footprints = {}
+    if len(rings) == 0:
+        return footprints
+    points = np.ascontiguousarray(np.concatenate(rings))
+    transformed = np.asarray(transform.TransformPoints(points), dtype = np.float64)[:, :2]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    for i in range(len(sceneIDs)):
+        xy = transformed[offsets[i]:offsets[i + 1]]
+        if not np.all(np.isfinite(xy)):
+            continue
+        wkb = struct.pack('<BIII', 1, ogr.wkbPolygon, 1, counts[i]) + xy.astype('<f8').tobytes() # little-endian polygon with one ring
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        if srs:
+            geom.AssignSpatialReference(srs)
+        footprints[sceneIDs[i]] = geom
+    return footprints
+
+## Metadata field codec functions
+
+def parsedate(value):
+    # This parses 'YYYY-MM-DD' or 'YYYY/MM/DD' dates, ignoring any trailing time, without going through strptime
+    try:
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    except ValueError:
+        if '/' in value:
+            return datetime.datetime.strptime(value, '%Y/%m/%d')
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+def parsedoytime(value):
+    # This parses USGS 'YYYY:DDD:HH:MM:SS.ffffffZ' scene start/ stop times
+    try:
+        seconds = float(value[15:].rstrip('Z'))
+        return datetime.datetime(int(value[0:4]), 1, 1, int(value[9:11]), int(value[12:14])) + datetime.timedelta(days = int(value[5:8]) - 1, seconds = seconds)
+    except ValueError:
+        if value[4:5] == '-': # 'YYYY-MM-DD HH:MM:SS.ffffff', as in USGS bulk metadata files
+            value = value.replace('T', ' ').rstrip('Z')
+            if '.' in value:
+                return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+            return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        return datetime.datetime.strptime(value[:-1], '%Y:%j:%H:%M:%S.%f')
+
+def normalisefieldname(fieldname):
+    # USGS metadata field names are matched against fieldvaluelist after this clean-up
+    return fieldname.strip().replace('L-1', 'L1')
+
+class FieldCodec(object):
+    # This is compiled once from fieldvaluelist, and maps each USGS metadata field name to its catalog column, OGR type, and a
+    # converter specialised for that field, so that metadata parsing and feature writing need only dict lookups per field.
+    # fieldvaluelist element format: [shapefile fieldname, geopackage fieldname, USGS fieldname, OGR type, field length]
+    def __init__(self, fieldvaluelist):
+        self.fields = {}
+        self.rawnames = {}
+        self.fieldindices = {}
+        self.slots = {} # field name: index of its value in SceneRecord.values
+        self.names = []
+        for element in fieldvaluelist:
+            fieldname = normalisefieldname(element[2])
+            if fieldname in self.fields: # the first definition of a duplicated USGS field name is used
+                continue
+            self.fields[fieldname] = (element[1], element[3], self.makeconverter(fieldname, element[3]))
+            self.slots[fieldname] = len(self.names)
+            self.names.append(fieldname)
+
+    def makeconverter(self, fieldname, fieldtype):
+        if fieldtype == ogr.OFTDate or fieldname.endswith('Date'):
+            if 'Time' in fieldname:
+                return parsedoytime
+            return parsedate
+        elif fieldtype == ogr.OFTReal:
+            return float
+        elif fieldtype == ogr.OFTInteger:
+            def toint(value):
+                try:
+                    return int(value)
+                except (TypeError, ValueError):
+                    print('Error: fieldname {} has a value of {}, changing to -9999.'.format(fieldname, value))
+                    return -9999
+            return toint
+        elif fieldname == 'Data Type Level-1':
+            return lambda value: value[value.rfind('_') + 1:]
+        return None
+
+    def get(self, fieldname):
+        # This returns (column, OGR type, converter) for an already normalised USGS field name, or None
+        return self.fields.get(fieldname)
+
+    def getraw(self, rawname):
+        # This returns the normalised field name and its codec entry for a field name as returned by the USGS, caching the result
+        try:
+            return self.rawnames[rawname]
+        except KeyError:
+            fieldname = normalisefieldname(rawname)
+            self.rawnames[rawname] = (fieldname, self.fields.get(fieldname))
+            return self.rawnames[rawname]
+
+    def convert(self, fieldname, value):
+        # This converts a raw USGS value for a known field
+        converter = self.fields[fieldname][2]
+        if converter:
+            return converter(value)
+        return value
+
+    def newrecord(self, sceneID):
+        return SceneRecord(sceneID, len(self.names))
+
+    def getvalue(self, record, fieldname):
+        # This returns a field value from a SceneRecord, or None if it is unset or not a known field
+        i = self.slots.get(fieldname)
+        if i is None:
+            return None
+        return record.values[i]
+
+    def setvalue(self, record, fieldname, value):
+        # This sets a field value in a SceneRecord. Values for fields not in fieldvaluelist are discarded, as they are never written.
+        i = self.slots.get(fieldname)
+        if i is not None:
+            record.values[i] = value
+
+    def items(self, record):
+        # This yields (field name, value) for each field set in a SceneRecord
+        for fieldname, value in zip(self.names, record.values):
+            if value is not None:
+                yield fieldname, value
+
+    def bind(self, layerDefinition):
+        # This caches the layer field index of each column, so that features can be populated by index rather than by name
+        self.fieldindices = {}
+        for fieldname in self.fields.keys():
+            self.fieldindices[fieldname] = layerDefinition.GetFieldIndex(self.fields[fieldname][0])
+
+    def setfield(self, feature, fieldname, value):
+        # This sets a catalog feature field from a converted value
+        column, fieldtype, converter = self.fields[fieldname]
+        i = self.fieldindices.get(fieldname, -1)
+        if i < 0:
+            i = column
+        if fieldtype == ogr.OFTDate:
+            if isinstance(value, str):
+                value = parsedate(value)
+            feature.SetField(i, value.year, value.month, value.day, value.hour, value.minute, value.second, 100)
+        else:
+            feature.SetField(i, value)
+
+class SceneRecord(object):
+    # This holds a scene while it passes through a catalog sync. Field values are kept in a list indexed by FieldCodec slot
+    # rather than in a dict keyed by USGS field name, and attributes are slotted, so that each record is two small objects.
+    # tiles is None, or a dict of catalog column: value for local tiles and the mask type found in the library.
+    __slots__ = ('sceneID', 'values', 'coords', 'updatemodifiedDate', 'updategeom', 'tiles')
+
+    def __init__(self, sceneID, numfields):
+        self.sceneID = sceneID
+        self.values = [None] * numfields
+        self.coords = None
+        self.updatemodifiedDate = False
+        self.updategeom = False
+        self.tiles = None
+
+## Bulk metadata functions
+
+# USGS bulk metadata file columns whose names differ from those of the same fields in metadata query responses
+bulkaliases = {'Landsat Product Identifier L2': 'Landsat Product Identifier',
+               'Display ID': 'Landsat Product Identifier',
+               'Date Acquired': 'Acquisition Date',
+               'Date Product Generated L2': 'modifiedDate',
+               'Scene Cloud Cover L1': 'Scene Cloud Cover',
+               'Sun Elevation L0RA': 'Sun Elevation L1',
+               'Sun Azimuth L0RA': 'Sun Azimuth L1',
+               'Geometric RMSE Model': 'Geometric RMSE Model (meters)',
+               'Browse Link': 'browseUrl'}
+
+# Footprint corner columns, in ring order, with the column names used by Collection 2 and by older bulk metadata files
+bulkcorners = [['Upper Left', 'UL'], ['Upper Right', 'UR'], ['Lower Right', 'LR'], ['Lower Left', 'LL']]
+
+def openbulkfile(filename):
+    # This opens a USGS bulk metadata CSV file, decompressing it as it is read if it is gzipped
+    if filename.lower().endswith('.gz'):
+        return gzip.open(filename, 'rt', newline = '', encoding = 'utf-8')
+    return open(filename, 'r', newline = '', encoding = 'utf-8')
+
+class BulkReader(object):
+    # This reads a USGS bulk metadata CSV file row by row into SceneRecords. Columns are matched to FieldCodec fields once, from the
+    # header, so that each row needs only a list lookup and conversion per mapped column. Values that cannot be converted are
+    # skipped and counted in errors. The footprint is built from the decimal corner coordinates, if the file has them.
+    def __init__(self, filename, fieldcodec):
+        self.filename = filename
+        self.fieldcodec = fieldcodec
+        self.file = openbulkfile(filename)
+        self.reader = csv.reader(self.file)
+        header = [column.strip() for column in next(self.reader)]
+        self.columns = [] # [column index, field name, converter]
+        mapped = set()
+        for i, column in enumerate(header):
+            fieldname, codec = fieldcodec.getraw(bulkaliases.get(column, column))
+            if codec and not fieldname in mapped and fieldname != 'Landsat Scene Identifier': # the first column for a field is used
+                self.columns.append([i, fieldname, codec[2]])
+                mapped.add(fieldname)
+        self.sceneindex = None
+        for column in ['Landsat Scene Identifier', 'Entity ID']:
+            if column in header:
+                self.sceneindex = header.index(column)
+                break
+        if self.sceneindex is None:
+            self.file.close()
+            raise ValueError('No Landsat Scene Identifier column found in bulk metadata file: {}'.format(filename))
+        self.corners = [] # [latitude column index, longitude column index] per corner
+        for name, abbreviation in bulkcorners:
+            for latitude, longitude in [['Corner {} Latitude dec'.format(name), 'Corner {} Longitude dec'.format(name)],
+                                        ['{} Corner Lat dec'.format(abbreviation), '{} Corner Long dec'.format(abbreviation)]]:
+                if latitude in header and longitude in header:
+                    self.corners.append([header.index(latitude), header.index(longitude)])
+                    break
+        if len(self.corners) < len(bulkcorners):
+            self.corners = None
+        self.rows = 0
+        self.errors = 0
+
+    def footprint(self, row):
+        # This returns the footprint ring of a row as [longitude, latitude] pairs, or None if the file has no corner columns or the
+        # row's corners are missing or malformed
+        if self.corners is None:
+            return None
+        try:
+            ring = [[float(row[longitude]), float(row[latitude])] for latitude, longitude in self.corners]
+        except (IndexError, ValueError):
+            return None
+        ring.append(ring[0])
+        return ring
+
+    def records(self, keep = None):
+        # This yields a SceneRecord for each row whose scene ID is accepted by keep(sceneID), or for every row if keep is None.
+        # Rows are converted only once accepted, so that rows outside the catalog's Path/Rows cost little more than being read.
+        fieldcodec = self.fieldcodec
+        for row in self.reader:
+            self.rows += 1
+            if len(row) <= self.sceneindex:
+                continue
+            sceneID = row[self.sceneindex].strip()
+            if not sceneID or (keep and not keep(sceneID)):
+                continue
+            scene = fieldcodec.newrecord(sceneID)
+            for i, fieldname, converter in self.columns:
+                if i >= len(row):
+                    continue
+                value = row[i].strip()
+                if value:
+                    if converter:
+                        try:
+                            value = converter(value)
+                        except (TypeError, ValueError):
+                            self.errors += 1
+                            continue
+                    fieldcodec.setvalue(scene, fieldname, value)
+            scene.coords = self.footprint(row)
+            yield scene
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module maintains a persistent inventory of the ENVI headers in the local image library, so that scripts need not glob
+# the library directories and re-read every header on each run. Each header is recorded in a SQLite file by path, with its
+# modification time and size, product type, tile filename base, tile ID, and its parsed "parent rasters". Directories are
+# rescanned with os.scandir, and only new or changed headers are read again.
+
+import os, re, sqlite3
+
+tilebasepattern = re.compile(r'^L[CEMOT]\d_\d{7}') # e.g., LC8_2019123, per sceneID[:3] + '_' + sceneID[9:16]
+
+def parsetilename(basename):
+    # This returns the tile filename base and tile ID encoded in a tile filename, or None for either if it does not follow the convention
+    tilebase = None
+    m = tilebasepattern.match(basename)
+    if m:
+        tilebase = m.group(0)
+    i = basename.rfind('_') + 1
+    j = basename.find('.')
+    tileid = None
+    if i > 0 and j > i:
+        tileid = basename[i:j]
+    return tilebase, tileid
+
+class LibraryIndex(object):
+    # readhdr is the function used to parse headers, normally ieo.readenvihdr, which returns a dict including 'parent rasters'.
+    def __init__(self, dbpath, readhdr, verbose = False):
+        dirname = os.path.dirname(dbpath)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.dbpath = dbpath
+        self.readhdr = readhdr
+        self.verbose = verbose
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (path TEXT, dirname TEXT, basename TEXT, mtime REAL, size INTEGER,
+                producttype TEXT, tilebase TEXT, tileid TEXT, PRIMARY KEY (path, producttype));
+            CREATE TABLE IF NOT EXISTS parents (path TEXT, parentraster TEXT, sceneID TEXT);
+            CREATE INDEX IF NOT EXISTS idx_files_dirname ON files (dirname);
+            CREATE INDEX IF NOT EXISTS idx_files_producttype_tilebase ON files (producttype, tilebase);
+            CREATE INDEX IF NOT EXISTS idx_parents_path ON parents (path);
+            CREATE INDEX IF NOT EXISTS idx_parents_sceneID ON parents (sceneID);
+            ''')
+        self.conn.commit()
+        self.refreshed = set()
+
+    def refresh(self, producttype, dirname):
+        # This brings the index of producttype up to date for the headers in dirname, re-reading only those whose mtime or size have
+        # changed. Each product type and directory is refreshed at most once per LibraryIndex instance, and product types sharing a
+        # directory are indexed separately. Returns the number of headers (re)read.
+        dirname = os.path.abspath(dirname)
+        if (producttype, dirname) in self.refreshed:
+            return 0
+        known = {}
+        for path, mtime, size in self.conn.execute('SELECT path, mtime, size FROM files WHERE dirname = ? AND producttype = ?', (dirname, producttype)):
+            known[path] = (mtime, size)
+        seen = set()
+        numread = 0
+        if os.path.isdir(dirname):
+            with os.scandir(dirname) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.hdr') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    seen.add(entry.path)
+                    if known.get(entry.path) == (stat.st_mtime, stat.st_size):
+                        continue
+                    try:
+                        parentrasters = self.readhdr(entry.path).get('parent rasters', [])
+                    except Exception as e:
+                        print('Error reading header {}: {}'.format(entry.path, e))
+                        continue # not recorded, so that it is retried on the next refresh
+                    if isinstance(parentrasters, str):
+                        parentrasters = [parentrasters]
+                    tilebase, tileid = parsetilename(entry.name)
+                    self.conn.execute('DELETE FROM parents WHERE path = ?', (entry.path,))
+                    self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (entry.path, dirname, entry.name, stat.st_mtime, stat.st_size, producttype, tilebase, tileid))
+                    self.conn.executemany('INSERT INTO parents VALUES (?, ?, ?)', [(entry.path, parentraster, os.path.basename(parentraster.strip())[:21]) for parentraster in parentrasters])
+                    numread += 1
+        removed = [(path,) for path in known.keys() if not path in seen]
+        if len(removed) > 0:
+            self.conn.executemany('DELETE FROM parents WHERE path = ?', removed)
+            self.conn.executemany('DELETE FROM files WHERE path = ? AND producttype = ?', [(path, producttype) for path, in removed])
+        self.conn.commit()
+        self.refreshed.add((producttype, dirname))
+        if self.verbose:
+            print('Library index: {} headers in {}, {} read, {} removed.'.format(len(seen), dirname, numread, len(removed)))
+        return numread
+
+    def expire(self):
+        # This allows every product type and directory to be refreshed again, e.g. between the polls of a long-running process
+        self.refreshed = set()
+
+    def findtiles(self, producttype, tilebase, sceneID):
+        # This returns the tile IDs of a product with the given tilebase that have sceneID among their parent rasters
+        return [row[0] for row in self.conn.execute('''SELECT DISTINCT files.tileid FROM files JOIN parents ON parents.path = files.path
+            WHERE files.producttype = ? AND files.tilebase = ? AND parents.parentraster = ? AND files.tileid IS NOT NULL
+            ORDER BY files.basename''', (producttype, tilebase, sceneID))]
+
+    def files(self, producttype, dirname = None, suffix = None):
+        # This returns the header paths of a product, optionally restricted to a directory and to filenames ending with suffix (e.g. '_ref_ITM.hdr')
+        sql = 'SELECT path FROM files WHERE producttype = ?'
+        params = [producttype]
+        if dirname:
+            sql += ' AND dirname = ?'
+            params.append(os.path.abspath(dirname))
+        if suffix:
+            sql += " AND basename LIKE ? ESCAPE '\\'"
+            params.append('%' + suffix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        return [row[0] for row in self.conn.execute(sql + ' ORDER BY path', params)]
+
+    def parentscenes(self, producttype, dirname = None):
+        # This returns a dict of header path: list of parent raster scene IDs (the first 21 characters of their basenames)
+        sql = 'SELECT files.path, parents.sceneID FROM files LEFT JOIN parents ON parents.path = files.path WHERE files.producttype = ?'
+        params = [producttype]
+        if dirname:
+            sql += ' AND files.dirname = ?'
+            params.append(os.path.abspath(dirname))
+        parentscenes = {}
+        for path, sceneID in self.conn.execute(sql + ' ORDER BY files.path', params):
+            if not path in parentscenes:
+                parentscenes[path] = []
+            if sceneID:
+                parentscenes[path].append(sceneID)
+        return parentscenes
+
+    def close(self):
+        self.conn.close()
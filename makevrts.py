@@ -8,7 +8,7 @@
 
 # This script creates VRTs from ingested Landsat data and catalogue files
 
-import os, sys, glob, datetime, argparse#, ieo
+import os, sys, glob, datetime, argparse, wrs2index, ieometrics, ieoprofile #, ieo
 from subprocess import Popen
 from osgeo import ogr
 
@@ -33,8 +33,16 @@ parser.add_argument('--overwrite', action = "store_true", help = 'Overwrite exis
 parser.add_argument('--nodataval', type = int, default = None, help = 'No data value. This must be set if --indir is also set.')
 #parser.add_argument('--minrow', type = int, default = 21, help = 'Lowest WRS-2 Row number.')
 parser.add_argument('--rowspath', type = int, default = 4, help = 'Max WRS-2 Rows per Path.')
+parser.add_argument('--wrs2index', type = str, default = os.path.join(ieo.catdir, 'WRS2_index.npz'), help = 'Cached WRS-2 Path/Row index, shared with updatelandsat.py.')
+parser.add_argument('--metrics', type = str, default = os.path.join(ieo.logdir, 'makevrts_metrics.json'), help = 'JSON run report of stage timings and counts.')
+parser.add_argument('--promfile', type = str, default = None, help = 'Also write run metrics to this Prometheus textfile.')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('makevrts', args.profile) # does nothing unless --profile is set
+
+metrics = ieometrics.Metrics('makevrts', args.metrics, args.promfile)
+
 nodatavals = {'SR': '-9999', 'Fmask': '255', 'BT': '-9999', 'NDVI': '0', 'EVI': '0', 'pixel_qa': '1'}
 
 if args.indir and args.nodataval:
@@ -53,6 +61,7 @@ def makefiledict(dirname, year):
         flist = glob.glob(os.path.join(dirname, 'L*{}*.dat'.format(args.year)))
     else:
         flist = glob.glob(os.path.join(dirname, 'L*.dat'))
+    metrics.count('files_globbed', len(flist), product = os.path.basename(dirname))
     filedict = {}
     if len(flist) >= 2:
         if os.path.basename(flist[0]).find('_') == 3:
@@ -73,25 +82,9 @@ def makefiledict(dirname, year):
     return filedict
 
 def getpathrows():
-    pathrowdict = {'paths': {}, 'rows': []}
-    driver = ogr.GetDriverByName("GPKG")
-    data_source = driver.Open(ieo.ieogpkg, 0)
-    layer = data_source.GetLayer(ieo.WRS2)
-    for feature in layer:
-        path = feature.GetField('PATH')
-        row = feature.GetField('ROW')
-        if not path in pathrowdict['paths']:
-            pathrowdict['paths'][path] = [row]
-        elif not row in pathrowdict['paths'][path]:
-            pathrowdict['paths'][path].append(row)
-        if not row in pathrowdict['rows']:
-            pathrowdict['rows'].append(row)
-        
-    data_source = None
-    for path in pathrowdict['paths'].keys():
-        sorted(pathrowdict['paths'][path])
-    sorted(pathrowdict['rows'])
-    
+    # This returns the WRS-2 Paths with their sorted Rows, and all Rows in order, from the cached WRS-2 index
+    wrs2 = wrs2index.load(ieo.ieogpkg, ieo.WRS2, args.wrs2index)
+    pathrowdict = {'paths': wrs2.pathrowdict(), 'rows': wrs2.rowlist()}
     return pathrowdict
 
 def makevrtfilename(outdir, filelist):
@@ -155,15 +148,20 @@ def makevrt(filelist, catfile, vrt, d, pathrowdict):
         if f:
             proclist.append(f)
 #    print(proclist)
-    p = Popen(proclist)
-    print(p.communicate())
+    with metrics.span('gdalbuildvrt', vrt = basename, files = len(filelist)) as span, profiler.phase('convert'):
+        p = Popen(proclist)
+        print(p.communicate())
+        span.set(returncode = p.returncode)
+    metrics.count('vrts_built', product = os.path.basename(os.path.dirname(filelist[0])), returncode = p.returncode)
     writetocsv(catfile, vrt, filelist, d, pathrowdict)
 
 today = datetime.datetime.today()
 catdir = os.path.join(ieo.catdir, 'Landsat')
-pathrowdict = getpathrows()
+with metrics.span('wrs2'):
+    pathrowdict = getpathrows()
 
 for indir in indirs:
+    span = metrics.span('indir', dir = os.path.basename(indir)).start()
     print('Now processing files in subdir {}, number {} of {}.'.format(os.path.basename(indir), indirs.index(indir) + 1, len(indirs)))
     if args.outdir:
         vrtdir = args.outdir
@@ -176,7 +174,8 @@ for indir in indirs:
     catfile = os.path.join(catdir, '{}_vrt.csv'.format(os.path.basename(indir)))
     print('New VRTs created will be logged in: {}'.format(catfile))
         
-    filedict = makefiledict(indir, args.year)
+    with profiler.phase('search'):
+        filedict = makefiledict(indir, args.year)
     keylist = sorted(filedict.keys())
     if len(keylist) > 0:
         for key in keylist:
@@ -190,5 +189,8 @@ for indir in indirs:
                     print('{} exists and no overwrite set, skipping.'.format(os.path.basename(vrt)))
             else:
                 print('An insufficient number of scenes for dat {} exist, skipping.'.format(key))
-        
+    span.stop()
+
+metrics.finish()
+profiler.close()
 print('Processing complete.')
\ No newline at end of file
@@ -12,7 +12,7 @@
 # 4. Calculates NDVI and EVI for clear land pixels
 # 5. Archives tar.gz files after use
 
-import os, sys, glob, datetime, argparse#, ieo, shutil
+import os, sys, glob, datetime, argparse, libraryindex, ieoprofile #, ieo, shutil
 from osgeo import ogr
 
 try: # This is included as the module may not properly install in Anaconda.
@@ -41,8 +41,12 @@ parser.add_argument('-a', '--archdir', type = str, default = ieo.archdir, help =
 parser.add_argument('--overwrite', type = bool, default = False, help = 'Overwrite existing files.')
 parser.add_argument('-d', '--delay', type = int, default = 0, help = 'Delay execution of script in seconds.')
 parser.add_argument('-r','--remove', type = bool, default = False, help = 'Remove temporary files after ingest.')
+parser.add_argument('--libraryindex', type = str, default = os.path.join(ieo.catdir, 'library_index.sqlite'), help = 'SQLite inventory of local library headers, shared with updatelandsat.py.')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('newespaimport', args.profile) # does nothing unless --profile is set
+
 if args.delay > 0: # if we want to delay execution for whatever reason
     from time import sleep
     print('Delaying execution {} seconds.'.format(args.delay))
@@ -87,14 +91,17 @@ for feature in layer:
     scenedict[sceneID] = {'ProductID' : feature.GetField('Landsat_Product_ID'), 'sceneID' : sceneID, 'SR_path' : feature.GetField('Surface_Reflectance_tiles')}
 data_source = None
 
-# This look finds any existing processed data 
+# This look finds any existing processed data, from the shared library index after it has been updated for any new or changed headers
+library = libraryindex.LibraryIndex(args.libraryindex, ieo.readenvihdr)
 for dir in [args.outdir, os.path.join(args.outdir, 'L1G')]:
-    rlist = glob.glob(os.path.join(args.outdir, '*_ref_{}.dat'.format(ieo.projacronym)))
-    for f in rlist:
+    library.refresh('Surface_reflectance_tiles', dir)
+    for f in library.files('Surface_reflectance_tiles', dirname = dir, suffix = '_ref_{}.hdr'.format(ieo.projacronym)):
         if not 'ESA' == os.path.basename(f)[16:19]:
-            reflist.append(f)
+            reflist.append(f.replace('.hdr', '.dat'))
+library.close()
 
 # Now create the processing list
+profiler.start('search')
 if args.infile: # This is in case a specific file has been selected for processing
     if os.access(args.infile, os.F_OK) and args.infile.endswith('.tar.gz'):
         print('File has been found, processing.')
@@ -116,6 +123,8 @@ else: # find and process what's in the ingest directory
                                 print('Found unprocessed SceneID {}, adding to processing list.'.format(sceneID))
                                 filelist.append(fname)
 
+profiler.stop()
+
 # Now process files that are in the list
 numfiles = len(filelist)
 print('There are {} reflectance files and {} scenes to be processed.'.format(len(reflist), numfiles))
@@ -126,7 +135,8 @@ for f in filelist:
     if args.overwrite or not any(scene in x for x in reflist):
 #        try:
         print('\nProcessing archive {}, file number {} of {}.\n'.format(f, filenum, numfiles))
-        ieo.importespatotiles(f, remove = args.remove, overwrite = args.overwrite)
+        with profiler.phase('convert'):
+            ieo.importespatotiles(f, remove = args.remove, overwrite = args.overwrite)
 #        except Exception as e:
 #            print('There was a problem processing the scene. Adding to error list.')
 #            exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -138,4 +148,5 @@ for f in filelist:
         print('Scene {} has already been processed, skipping file number {} of {}.'.format(scene, filenum, numfiles))
     filenum += 1
 
+profiler.close()
 print('Processing complete.')
\ No newline at end of file
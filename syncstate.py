@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module keeps the progress of a Landsat catalog sync in a small SQLite sidecar file, so that an interrupted run of
+# updatelandsat.py can be resumed with --resume from the last completed search window and metadata batch. The total number of
+# hits returned by each search is also kept between runs, as an estimate of scene density for planning search windows, and a
+# digest of the results of each completed calendar year, so that later runs can skip years in which nothing has changed. Digests are only
+# valid for the search area and Path/Rows they were recorded with, identified by a scope hash.
+
+import os, sqlite3, hashlib, datetime
+
+def digestresults(results):
+    # This returns a hash of the entity IDs and modification dates of a period's search results, independent of their order
+    digest = hashlib.sha256()
+    for line in sorted('{}|{}'.format(result.get('entityId'), result.get('modifiedDate')) for result in results):
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def digestscope(mbr, pathrowstrs):
+    # This returns a hash of a search MBR and set of Path/Row strings, which identifies the results a digest was made from
+    scope = hashlib.sha256()
+    scope.update(','.join('{:0.6f}'.format(float(x)) for x in mbr).encode('utf-8'))
+    scope.update(b'|')
+    scope.update(','.join(sorted(pathrowstrs)).encode('utf-8'))
+    return scope.hexdigest()
+
+class SyncState(object):
+    # Progress is recorded per run: the start and end dates searched, each completed (collection, window), each completed
+    # metadata batch, and the scene IDs fetched in those batches. All writes are committed immediately.
+    def __init__(self, dbpath):
+        dirname = os.path.dirname(dbpath)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.dbpath = dbpath
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (runid INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT, finished TEXT, startdate TEXT, enddate TEXT, status TEXT);
+            CREATE TABLE IF NOT EXISTS windows (runid INTEGER, dataset TEXT, startdate TEXT, enddate TEXT, numscenes INTEGER, completed TEXT,
+                PRIMARY KEY (runid, dataset, startdate, enddate));
+            CREATE TABLE IF NOT EXISTS batches (runid INTEGER, dataset TEXT, startdate TEXT, enddate TEXT, batch INTEGER, numscenes INTEGER, completed TEXT,
+                PRIMARY KEY (runid, dataset, startdate, enddate, batch));
+            CREATE TABLE IF NOT EXISTS scenes (runid INTEGER, sceneID TEXT, dataset TEXT, startdate TEXT, enddate TEXT,
+                PRIMARY KEY (runid, sceneID));
+            CREATE TABLE IF NOT EXISTS densities (dataset TEXT, startdate TEXT, enddate TEXT, totalhits INTEGER, updated TEXT,
+                PRIMARY KEY (dataset, startdate, enddate));
+            CREATE TABLE IF NOT EXISTS digests (dataset TEXT, startdate TEXT, enddate TEXT, totalhits INTEGER, digest TEXT, updated TEXT, scope TEXT,
+                PRIMARY KEY (dataset, startdate, enddate));
+            ''')
+        self.conn.commit()
+        self.runid = None
+        self.startdate = None
+        self.enddate = None
+        self.donewindows = set()
+        self.failedwindows = set()
+
+    def now(self):
+        return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def startrun(self, startdate, enddate):
+        # This starts a new run, abandoning any earlier run that did not complete
+        self.conn.execute("UPDATE runs SET status = 'abandoned' WHERE status = 'running'")
+        cursor = self.conn.execute("INSERT INTO runs (started, startdate, enddate, status) VALUES (?, ?, ?, 'running')", (self.now(), startdate, enddate))
+        self.conn.commit()
+        self.runid = cursor.lastrowid
+        self.startdate = startdate
+        self.enddate = enddate
+        self.donewindows = set()
+        self.failedwindows = set()
+        return self.runid
+
+    def resumerun(self):
+        # This reopens the most recent incomplete run, and returns True if there was one to resume
+        row = self.conn.execute("SELECT runid, startdate, enddate FROM runs WHERE status = 'running' ORDER BY runid DESC LIMIT 1").fetchone()
+        if not row:
+            return False
+        self.runid, self.startdate, self.enddate = row
+        self.donewindows = set()
+        self.failedwindows = set()
+        for dataset, startdate, enddate in self.conn.execute('SELECT dataset, startdate, enddate FROM windows WHERE runid = ?', (self.runid,)):
+            self.donewindows.add((dataset, startdate, enddate))
+        return True
+
+    def iswindowdone(self, dataset, startdate, enddate):
+        return (dataset, startdate, enddate) in self.donewindows
+
+    def uncovered(self, dataset, startdate, enddate):
+        # This returns the [startdate, enddate] periods within the given one that are not covered by windows completed in this run
+        start = datetime.datetime.strptime(startdate, '%Y-%m-%d')
+        end = datetime.datetime.strptime(enddate, '%Y-%m-%d')
+        done = []
+        for windowdataset, windowstart, windowend in self.donewindows:
+            if windowdataset == dataset:
+                try:
+                    done.append([datetime.datetime.strptime(windowstart, '%Y-%m-%d'), datetime.datetime.strptime(windowend, '%Y-%m-%d')])
+                except ValueError:
+                    continue
+        gaps = []
+        cursor = start
+        for windowstart, windowend in sorted(done):
+            if windowend < cursor:
+                continue
+            if windowstart > end:
+                break
+            if windowstart > cursor:
+                gaps.append([cursor, windowstart - datetime.timedelta(days = 1)])
+            cursor = windowend + datetime.timedelta(days = 1)
+            if cursor > end:
+                break
+        if cursor <= end:
+            gaps.append([cursor, end])
+        return [[gapstart.strftime('%Y-%m-%d'), gapend.strftime('%Y-%m-%d')] for gapstart, gapend in gaps]
+
+    def recordhits(self, dataset, startdate, enddate, totalhits):
+        # This records the total number of scenes found by a search, for use in density estimates by later runs
+        self.conn.execute('INSERT OR REPLACE INTO densities VALUES (?, ?, ?, ?, ?)', (dataset, startdate, enddate, totalhits, self.now()))
+        self.conn.commit()
+
+    def density(self, dataset, startdate, enddate):
+        # This returns the estimated number of scenes per day for a period, from recorded searches overlapping it, or None if there are none
+        hits = 0
+        days = 0
+        for windowstart, windowend, totalhits in self.conn.execute('SELECT startdate, enddate, totalhits FROM densities WHERE dataset = ? AND startdate <= ? AND enddate >= ?', (dataset, enddate, startdate)):
+            try:
+                days += (datetime.datetime.strptime(windowend, '%Y-%m-%d') - datetime.datetime.strptime(windowstart, '%Y-%m-%d')).days + 1
+            except ValueError:
+                continue
+            hits += totalhits
+        if days == 0:
+            return None
+        return hits / days
+
+    def getdigest(self, dataset, startdate, enddate, scope):
+        # This returns [totalhits, digest, age in days] for a period completed by an earlier run with the same scope, or None
+        row = self.conn.execute('SELECT totalhits, digest, updated FROM digests WHERE dataset = ? AND startdate = ? AND enddate = ? AND scope = ?', (dataset, startdate, enddate, scope)).fetchone()
+        if not row:
+            return None
+        age = (datetime.datetime.now() - datetime.datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S')).total_seconds() / 86400
+        return [row[0], row[1], age]
+
+    def setdigest(self, dataset, startdate, enddate, totalhits, digest, scope):
+        # This records the digest of a period once all of its scenes have been committed to the catalog
+        self.conn.execute('INSERT OR REPLACE INTO digests (dataset, startdate, enddate, totalhits, digest, updated, scope) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (dataset, startdate, enddate, totalhits, digest, self.now(), scope))
+        self.conn.commit()
+
+    def cleardigests(self, date = None):
+        # This forgets the digests of all periods, or of those including date (YYYY-MM-DD), so that they are searched again
+        if date:
+            self.conn.execute('DELETE FROM digests WHERE startdate <= ? AND enddate >= ?', (date, date))
+        else:
+            self.conn.execute('DELETE FROM digests')
+        self.conn.commit()
+
+    def batchdone(self, dataset, startdate, enddate, batch, sceneIDs):
+        # This records a metadata batch and its scene IDs once its features have been committed to the catalog
+        self.conn.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, ?, ?, ?)', (self.runid, dataset, startdate, enddate, batch, len(sceneIDs), self.now()))
+        self.conn.executemany('INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?)', [(self.runid, sceneID, dataset, startdate, enddate) for sceneID in sceneIDs])
+        self.conn.commit()
+
+    def windowdone(self, dataset, startdate, enddate, numscenes):
+        self.conn.execute('INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?)', (self.runid, dataset, startdate, enddate, numscenes, self.now()))
+        self.conn.commit()
+        self.donewindows.add((dataset, startdate, enddate))
+
+    def windowfailed(self, dataset, startdate, enddate):
+        # This records a window with metadata batches that could not be fetched. It is not checkpointed as completed, and the run is
+        # left open by finishrun(), so that --resume searches the window again for the scenes not yet fetched.
+        self.failedwindows.add((dataset, startdate, enddate))
+
+    def fetchedscenes(self):
+        # This returns the set of scene IDs already fetched and committed during the current run
+        return set(row[0] for row in self.conn.execute('SELECT sceneID FROM scenes WHERE runid = ?', (self.runid,)))
+
+    def lastenddate(self):
+        # This returns the end date of the most recent completed run, from which the next poll of a daemon continues, or None
+        row = self.conn.execute("SELECT enddate FROM runs WHERE status = 'complete' ORDER BY runid DESC LIMIT 1").fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def finishrun(self):
+        # This marks the run as complete, unless any of its windows failed, and returns whether it was
+        if len(self.failedwindows) > 0:
+            return False
+        self.conn.execute("UPDATE runs SET status = 'complete', finished = ? WHERE runid = ?", (self.now(), self.runid))
+        self.conn.commit()
+        return True
+
+    def close(self):
+        self.conn.close()
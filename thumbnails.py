@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module downloads Landsat browse thumbnails and writes their world (.jpw) and projection (.prj) files in the background,
+# so that catalog writes do not wait on thumbnail downloads. Thumbnails are streamed to temporary files and renamed into place,
+# and existing ones are only downloaded again if the server reports that they have changed.
+
+import os, shutil, tempfile, datetime, threading, email.utils, concurrent.futures
+from PIL import Image
+
+def makeworldfile(jpg, geom): # This attempts to make a worldfile for thumbnails so they can be displayed in a GIS
+    img = Image.open(jpg)
+    basename = os.path.basename(jpg)
+    width, height = img.size
+    width = float(width)
+    height = float(height)
+    minX, maxX, minY, maxY = geom.GetEnvelope()
+    if basename[:3] == 'LE7':
+        wkt = geom.ExportToWkt()
+        start = wkt.find('(') + 2
+        end = wkt.find(')')
+        vals = wkt[start:end]
+        vals = vals.split(',')
+        corners = []
+        for val in vals:
+            val = val.split()
+            for v in val:
+                corners.append(float(v))
+        A = (maxX - corners[0]) / width
+        B = (corners[0] - minX) / height
+        C = corners[0]
+        D = (maxY - corners[3]) / width
+        E = (corners[3] - minY) / height
+        F = corners[1]
+    else:
+        A = (maxX - minX) / width
+        B = 0.0
+        C = minX
+        D = (maxY - minY) / height
+        E = 0.0
+        F = maxY
+    jpw = jpg.replace('.jpg', '.jpw')
+    if os.access(jpw, os.F_OK):
+        bak = jpw.replace('.jpw', '.jpw.{}.bak'.format(datetime.datetime.today().strftime('%Y%m%d-%H%M%S')))
+        shutil.move(jpw, bak)
+    with open(jpw, 'w') as file:
+        file.write('{}\n-{}\n-{}\n-{}\n{}\n{}\n'.format(A, D, B, E, C, F))
+    del img
+
+def makeprjfile(jpg, wkt):
+    # This writes the projection file for a thumbnail
+    with open(jpg.replace('.jpg', '.prj'), 'w') as output:
+        output.write(wkt)
+
+def download(session, url, jpg, chunksize = 65536):
+    # This downloads a thumbnail to a temporary file in its destination directory and renames it into place. If the thumbnail
+    # already exists, the request is made conditional on it having changed. Returns True if downloaded, False if unchanged.
+    headers = {}
+    if os.path.isfile(jpg):
+        headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(jpg), usegmt = True)
+    response = session.get(url, endpoint = 'thumbnail', headers = headers, stream = True, allow_redirects = True)
+    try:
+        if response.status_code == 304:
+            return False
+        fd, tmpname = tempfile.mkstemp(suffix = '.part', dir = os.path.dirname(jpg))
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                for chunk in response.iter_content(chunk_size = chunksize):
+                    output.write(chunk)
+            os.replace(tmpname, jpg)
+        except:
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+            raise
+        lastmodified = response.headers.get('Last-Modified')
+        if lastmodified:
+            try: # the server's modification time is kept, so that it can be used in the next conditional request
+                mtime = email.utils.parsedate_to_datetime(lastmodified).timestamp()
+                os.utime(jpg, (mtime, mtime))
+            except (TypeError, ValueError):
+                pass
+        return True
+    finally:
+        response.close()
+
+class ThumbnailPipeline(object):
+    # Thumbnails are downloaded by a pool of workers threads using the shared USGS session, and their world and projection files are
+    # written by a separate pool of worldfileworkers threads once each download completes. Results are collected with completed()
+    # as the pipeline runs, or with close() at the end, as lists of (sceneID, jpg) for thumbnails now present and (sceneID, error).
+    def __init__(self, session, prjwkt, workers = 4, worldfileworkers = 2, verbose = False):
+        self.session = session
+        self.prjwkt = prjwkt
+        self.verbose = verbose
+        self.downloads = concurrent.futures.ThreadPoolExecutor(max_workers = max(workers, 1))
+        self.worldfiles = concurrent.futures.ThreadPoolExecutor(max_workers = max(worldfileworkers, 1))
+        self.lock = threading.Lock()
+        self.pending = []
+        self.counts = {'downloaded': 0, 'unchanged': 0, 'errors': 0}
+
+    def submit(self, sceneID, url, jpg, geom):
+        # geom is the footprint in the local projection. It is cloned, as the caller's feature may be destroyed before it is used.
+        with self.lock:
+            self.pending.append(self.downloads.submit(self.fetch, sceneID, url, jpg, geom.Clone()))
+
+    def fetch(self, sceneID, url, jpg, geom):
+        try:
+            downloaded = download(self.session, url, jpg)
+        except Exception as e:
+            with self.lock:
+                self.counts['errors'] += 1
+            return [sceneID, jpg, e]
+        with self.lock:
+            if downloaded:
+                self.counts['downloaded'] += 1
+            else:
+                self.counts['unchanged'] += 1
+            if downloaded or not os.path.isfile(jpg.replace('.jpg', '.jpw')):
+                self.pending.append(self.worldfiles.submit(self.writeworldfiles, sceneID, jpg, geom))
+                return None
+        return [sceneID, jpg, None]
+
+    def writeworldfiles(self, sceneID, jpg, geom):
+        try:
+            if self.verbose:
+                print('Creating world and projection files for {}.'.format(os.path.basename(jpg)))
+            makeworldfile(jpg, geom)
+            makeprjfile(jpg, self.prjwkt)
+        except Exception as e:
+            with self.lock:
+                self.counts['errors'] += 1
+            return [sceneID, jpg, e]
+        return [sceneID, jpg, None]
+
+    def collect(self, wait):
+        # This removes finished tasks from the pending list, and returns their results
+        if wait:
+            while True: # world file tasks are queued by download tasks, so wait until no more are added
+                with self.lock:
+                    pending = list(self.pending)
+                concurrent.futures.wait(pending)
+                with self.lock:
+                    if all(future.done() for future in self.pending):
+                        break
+        thumbnails = []
+        errors = []
+        with self.lock:
+            stillpending = []
+            for future in self.pending:
+                if not future.done():
+                    stillpending.append(future)
+                    continue
+                result = future.result()
+                if result is None: # handed on to a world file task
+                    continue
+                sceneID, jpg, e = result
+                if e is None:
+                    thumbnails.append([sceneID, jpg])
+                else:
+                    errors.append([sceneID, '{}: {}'.format(os.path.basename(jpg), e)])
+            self.pending = stillpending
+        return thumbnails, errors
+
+    def completed(self):
+        return self.collect(False)
+
+    def close(self):
+        results = self.collect(True)
+        self.downloads.shutdown()
+        self.worldfiles.shutdown()
+        print('Thumbnails: {} downloaded, {} unchanged, {} errors.'.format(self.counts['downloaded'], self.counts['unchanged'], self.counts['errors']))
+        return results
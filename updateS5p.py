@@ -10,7 +10,7 @@
 # 23 May 2018: XML functionality deprecated in favor of JSON queries, as the former is no longer available or efficient
 # 25 March 2019: This script will now read configuration data from ieo.ini
 
-import os, sys, urllib.error, datetime, shutil, glob, argparse, json, getpass, requests, math #, ieo
+import os, sys, urllib.error, datetime, shutil, glob, argparse, json, getpass, requests, math, ieoprofile #, ieo
 from osgeo import ogr, osr
 import xml.etree.ElementTree as ET
 from PIL import Image
@@ -65,9 +65,12 @@ parser.add_argument('--loclatlonshp', type = str, default = config['VECTOR']['la
 parser.add_argument('--locshp', type = str, default = config['VECTOR']['locshp'], help = 'Shapefile of area of interest in default local projection. Default value should be in IEO configuration.)
 parser.add_argument('--S5platlon', type = str, default = config['VECTOR']['S5platlon'], help = 'Shapefile of available S5p scenes in Lat/Lon, EPSG:4326. Default value should be in IEO configuration.)
 parser.add_argument('--S5plocal', type = str, default = config['VECTOR']['S5plocal'], help = 'Shapefile of available S5p scenes in default local projection. Default value should be in IEO configuration.)
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('updateS5p', args.profile) # does nothing unless --profile is set
+
 if not (args.username and args.password):
     if not args.username:
         args.username = input('S5phub username: ')
@@ -848,6 +851,7 @@ data_source = None
 if errorsfound:
     print('Errors were found during script execution. please see the error log file for details: {}'.format(errorfile))
 
+profiler.close()
 print('Processing complete.')
 
 '''
@@ -11,11 +11,38 @@
 # 25 March 2019: This script will now read configuration data from ieo.ini
 # 14 August 2019: This now creates and updates a layer within a geopackage, and will migrate data from an old shapefile to a new one
 # 12 January 2021: Modified to support Landsat Collection 2
+# 16 October 2026: Scene searches and metadata queries are now run concurrently by a pool of --workers threads
+# 16 October 2026: All USGS requests now go through a shared pooled session (usgsapi.py) with retries and backoff
+# 16 October 2026: Existing features are now looked up through an indexed sceneID: FID map rather than by scanning the layer
+# 16 October 2026: New features are now written in batched transactions (--writebatch), optionally as Arrow record batches (--arrow)
+# 16 October 2026: Metadata parsing and feature writing now use a field codec compiled once from fieldvaluelist
+# 16 October 2026: Features are now committed after each metadata batch, and progress is checkpointed so that syncs can be resumed (--resume)
+# 16 October 2026: --savequeries and --usesaved now save to and read from a compressed response cache with expiry and size limits
+# 16 October 2026: Local tiles are now found through the shared library index (libraryindex.py) rather than by globbing and reading headers
+# 16 October 2026: Footprints are now reprojected per metadata batch in one TransformPoints call, and rings closed correctly on insert and update
+# 16 October 2026: Thumbnails are now downloaded and georeferenced concurrently in the background (thumbnails.py), with conditional requests
+# 16 October 2026: Existing features are now validated with SQL run on the geopackage, rather than by reading each feature
+# 16 October 2026: Features needing repair are re-fetched by entity ID, and no longer force a search of the whole archive
+# 16 October 2026: Search windows are now planned from recorded scene densities, and split when truncated at --maxResults
+# 16 October 2026: Scenes are now held as compact slotted records, and only a few metadata batches are queried ahead of writing
+# 16 October 2026: Stage timings, HTTP calls, and features written are recorded in a JSON run report (--metrics, --promfile)
+# 16 October 2026: Added --profile, which writes cProfile statistics per phase and the top memory allocation sites
+# 16 October 2026: Metadata batch sizes now adapt to server latency and errors, the last ID of each batch is no longer dropped,
+#                  and USGS API calls are rate limited by a token bucket shared between workers and concurrent runs
+# 16 October 2026: Added --daemon, which keeps the session, apiKey, catalog and indexes open and polls for new scenes every --pollinterval minutes
+# 16 October 2026: WRS-2 Path/Rows and the MBR now come from a cached local index (wrs2index.py), rather than the layer and grid2ll
+# 16 October 2026: Added --fullmetadata, which parses metadata returned inline with search results in one pass instead of querying it
+# 16 October 2026: Search results are filtered by Path/Row and stripped to the fields used as they are decoded, streamed with ijson if installed
+# 16 October 2026: Search windows now follow calendar years, and years whose hit count is unchanged since their digest of results
+#                  was recorded are skipped after a hits request, checked in groups of consecutive years (--digestage, --ignoredigests)
+# 16 October 2026: Added --bootstrap, which adds the scenes in USGS bulk metadata files to the catalog before syncing, so that only
+#                  scenes added since need to be fetched from the USGS API
+# 16 October 2026: Added --aoi, which syncs further catalog layers for other Path/Row sets in the same search pass, querying the
+#                  metadata of each scene once and routing its features to every layer whose Path/Rows include it
 
-import os, sys, urllib.error, datetime, shutil, glob, argparse, json, getpass, requests, math #, ieo
+import os, sys, time, signal, threading, urllib.error, datetime, shutil, glob, argparse, json, getpass, math, collections, concurrent.futures, usgsapi, wrs2index, landsatcatalog, syncstate, libraryindex, thumbnails, ieometrics, ieoprofile #, ieo
 from osgeo import ogr, osr
 #import xml.etree.ElementTree as ET
-from PIL import Image
 
 try: # This is included as the module may not properly install in Anaconda.
     import ieo
@@ -53,12 +80,45 @@ parser.add_argument('--enddate', type = str, default = None, help = "End date fo
 parser.add_argument('-m', '--MBR', type = str, default = None, help = 'Minimum Bounding Rectangle (MBR) coordinates in decimal degrees in the following format (comma delimited, no spaces): lower left latitude, lower left longitude, upper right latitude, upper right longitude. If not supplied, these will be determined from WRS-2 Paths and Rows in updateshp.ini.')
 parser.add_argument('-b', '--baseURL', type = str, default = 'https://earthexplorer.usgs.gov/inventory/json/v/', help = 'Base URL to use excluding JSON version (Default = "https://earthexplorer.usgs.gov/inventory/json/v/").')
 parser.add_argument('--maxResults', type = int, default = 50000, help = 'Maximum number of results to return (1 - 50000, default = 50000).')
+parser.add_argument('--windowfill', type = float, default = 0.5, help = 'Search windows are planned to return about this fraction of --maxResults, from scene densities found by earlier searches (default = 0.5).')
+parser.add_argument('--fullmetadata', action = 'store_true', help = 'Request full metadata with search results (metadataType "full"), so that new scenes need no separate metadata query. Scenes returned without metadata are still queried.')
+parser.add_argument('--digestage', type = float, default = 30.0, help = 'Days for which a year whose hit count is unchanged since its digest of results was recorded is skipped, before it is searched in full again (default = 30).')
+parser.add_argument('--ignoredigests', action = 'store_true', help = 'Search every year in full, rather than skipping those whose hit count is unchanged since their digest of results was recorded.')
 parser.add_argument('--overwrite', type = bool, default = False, help = 'Overwrite existing files.')
 parser.add_argument('--thumbnails', type = bool, default = True, help = 'Download thumbnails (default = True).')
-parser.add_argument('--savequeries', action = 'store_true', help = 'Save queries.')
-parser.add_argument('--usesaved', action = 'store_true', help = 'Use any saved queries on disk, rather than online.')
+parser.add_argument('--savequeries', action = 'store_true', help = 'Save search and metadata query responses to the response cache.')
+parser.add_argument('--usesaved', action = 'store_true', help = 'Use any saved queries in the response cache, rather than online. New responses are also saved.')
+parser.add_argument('--cachedir', type = str, default = None, help = 'Response cache directory. Default is a "usgscache" subdirectory of the ingest directory.')
+parser.add_argument('--cachettl', type = float, default = 168.0, help = 'Hours for which cached responses remain valid.')
+parser.add_argument('--cachesize', type = float, default = 1024.0, help = 'Maximum response cache size in MB, beyond which the least recently used responses are deleted.')
 parser.add_argument('--migrate', type = bool, default = False, help = 'Force migration of Landsat shapefile data to catalog geopackage.')
 parser.add_argument('--verbose', type = bool, default = False, help = 'Display more messages during migration..')
+parser.add_argument('-w', '--workers', type = int, default = 4, help = 'Number of USGS search and metadata requests to keep in flight at once (default = 4).')
+parser.add_argument('--retries', type = int, default = 5, help = 'Number of times a failed USGS request will be retried, with exponential backoff (default = 5).')
+parser.add_argument('--ratelimit', type = float, default = 5.0, help = 'Maximum USGS API requests per second, shared by all workers and by concurrent runs using the same --ratestate file. Set to 0 to disable (default = 5).')
+parser.add_argument('--rateburst', type = int, default = 10, help = 'Number of USGS API requests that may be sent at once before --ratelimit applies (default = 10).')
+parser.add_argument('--ratestate', type = str, default = os.path.join(ieo.catdir, 'Landsat', 'usgs_ratelimit.sqlite'), help = 'SQLite file holding the shared rate limit token bucket. Set to "" to limit this run only.')
+parser.add_argument('--batchsize', type = int, default = 100, help = 'Initial number of scenes per metadata request (default = 100).')
+parser.add_argument('--maxbatch', type = int, default = 500, help = 'Maximum number of scenes per metadata request, up to the limit of the USGS API (default = 500).')
+parser.add_argument('--batchlatency', type = float, default = 10.0, help = 'Target seconds per metadata request: batches grow while requests are faster than half of this, and shrink when slower or failing (default = 10).')
+parser.add_argument('--keylifetime', type = float, default = 120.0, help = 'Minutes for which a USGS apiKey is valid. A new key is requested ten minutes before this, or when the key is rejected (default = 120).')
+parser.add_argument('--jsonparser', type = str, default = 'auto', choices = ['auto', 'ijson', 'orjson', 'json'], help = 'JSON parser for USGS responses: search results are streamed and filtered with ijson, or decoded faster with orjson, when installed. "auto" uses either if available, "json" neither (default = auto).')
+parser.add_argument('--timeout', type = int, default = 300, help = 'Timeout in seconds for individual USGS requests (default = 300).')
+parser.add_argument('--thumbworkers', type = int, default = 4, help = 'Number of thumbnails to download at once, in the background (default = 4).')
+parser.add_argument('--writebatch', type = int, default = 1000, help = 'Number of new features to write to the geopackage per transaction (default = 1000).')
+parser.add_argument('--arrow', action = 'store_true', help = 'Write new features to the geopackage as Arrow record batches (requires GDAL >= 3.8 and pyarrow).')
+parser.add_argument('--aoi', type = str, nargs = '+', action = 'append', default = None, metavar = 'LAYER PATHROWVALS [GEOPACKAGE]', help = 'Also sync another catalog layer, for an area of interest given as pathrowvals in the same format as the INI file (e.g. 205,209,21,25), in the catalog geopackage or the one given. May be repeated. All layers share one search pass and one metadata query per scene.')
+parser.add_argument('--bootstrap', type = str, nargs = '+', default = None, help = 'Before syncing, add the scenes within the configured Path/Rows and MBR from these USGS bulk metadata CSV files (.csv or .csv.gz, e.g. LANDSAT_OT_C2_L2.csv.gz) to the catalog, so that only newer scenes need to be fetched from the USGS API.')
+parser.add_argument('--resume', action = 'store_true', help = 'Resume an interrupted catalog sync from its last completed search window and metadata batch.')
+parser.add_argument('--checkpoint', type = str, default = os.path.join(ieo.catdir, 'Landsat', 'updatelandsat_sync.sqlite'), help = 'SQLite file in which catalog sync progress is checkpointed.')
+parser.add_argument('--libraryindex', type = str, default = os.path.join(ieo.catdir, 'library_index.sqlite'), help = 'SQLite inventory of local library headers, shared with MakeESPAproclist.py, GetLandsatL2.py, and newespaimport.py.')
+parser.add_argument('--daemon', action = 'store_true', help = 'After the initial sync, keep running and poll the USGS for new scenes every --pollinterval minutes, until stopped with SIGINT or SIGTERM.')
+parser.add_argument('--pollinterval', type = float, default = 15.0, help = 'Minutes between polls in --daemon mode (default = 15).')
+parser.add_argument('--lookback', type = int, default = 30, help = 'Each --daemon poll searches from this many days before the end of the previous one, and a catalog created with --bootstrap is synced from this many days before its last acquisition, for scenes processed after acquisition (default = 30).')
+parser.add_argument('--wrs2index', type = str, default = os.path.join(ieo.catdir, 'WRS2_index.npz'), help = 'Cached WRS-2 Path/Row index of the ieo.WRS2 layer, shared with MakeESPAproclist.py, GetLandsatL2.py, and makevrts.py.')
+parser.add_argument('--metrics', type = str, default = os.path.join(ieo.logdir, 'updatelandsat_metrics.json'), help = 'JSON run report of stage timings and counts.')
+parser.add_argument('--promfile', type = str, default = None, help = 'Also write run metrics to this Prometheus textfile, e.g. in the node_exporter textfile collector directory.')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 parser.add_argument('-t', '--tiledir', type = str, default = os.path.dirname(ieo.srdir), help = 'Directory path for tile subdirectories.')
 
 args = parser.parse_args()
@@ -69,6 +129,30 @@ if not (args.username and args.password):
     if not args.password:
         args.password = getpass.getpass('USGS/ERS password: ')
 
+# With --profile, each phase of the run is profiled until the end of the run; otherwise profiler.phase() does nothing
+profiler = ieoprofile.Profiler('updatelandsat', args.profile)
+
+# Stage timings and counts for this run are written to a JSON report, and optionally to a Prometheus textfile, when it ends
+metrics = ieometrics.Metrics('updatelandsat', args.metrics, args.promfile, verbose = args.verbose)
+
+# Search and metadata responses are kept in a compressed on-disk cache if either --savequeries or --usesaved is set
+cache = None
+if args.savequeries or args.usesaved:
+    if not args.cachedir:
+        args.cachedir = os.path.join(ieo.ingestdir, 'usgscache')
+    cache = usgsapi.ResponseCache(args.cachedir, ttl = args.cachettl * 3600, maxsize = int(args.cachesize * 1024 ** 2), read = args.usesaved, verbose = args.verbose)
+
+# USGS API calls from all workers, and from other runs sharing args.ratestate, take their turn from one token bucket
+ratelimiter = None
+if args.ratelimit > 0:
+    ratelimiter = usgsapi.RateLimiter(args.ratelimit, burst = args.rateburst, statefile = args.ratestate or None)
+
+# Metadata batch sizes are adapted to the latency and errors of the requests made so far
+batchsizer = usgsapi.BatchSizer(initial = args.batchsize, maximum = args.maxbatch, target = args.batchlatency)
+
+# All requests to the USGS/EROS servers share this session, so connections are reused and failed requests are retried
+session = usgsapi.USGSSession(poolsize = max(args.workers, 1) + max(args.thumbworkers, 1) + 2, retries = args.retries, timeout = args.timeout, verbose = args.verbose, cache = cache, metrics = metrics, ratelimiter = ratelimiter, parser = args.jsonparser)
+
 subpathrow = []
 
 ingestdir = os.path.join(ieo.ingestdir, 'Metadata')
@@ -88,52 +172,84 @@ if not args.enddate:
 errorfile = os.path.join(logdir, 'Landsat_inventory_download_errors.csv')
 errorsfound = False
 
-pathrowstrs = [] # list of strings containing WRS-2 Path/ Row combinations
-paths = [] # list containing WRS-2 Paths
-rows = [] # List containing WRS-2 Rows
-
-if useWRS2.lower() == 'yes':
-    print('Getting WRS-2 Path/Row combinations from geopackage: {}'.format(ieo.WRS2))
-    driver = ogr.GetDriverByName("GPKG")
-    print('WRS-2 = {}'.format(ieo.WRS2))
-    ds = driver.Open(ieo.ieogpkg, 0)
-    layer = ds.GetLayer(ieo.WRS2)
-    for feature in layer:
-        path = feature.GetField('PATH')
-        if not path in paths:
-            paths.append(path)
-        row = feature.GetField('ROW')
-        if not row in rows:
-            rows.append(row)
-        pathrowstrs.append('{:03d}{:03d}'.format(path, row))
-    ds = None
-else:
-    print('Using WRS-2 Path/Row combinations from INI file.')
+pathrowstrs = set() # set of strings containing WRS-2 Path/ Row combinations
+paths = set() # set containing WRS-2 Paths
+rows = set() # set containing WRS-2 Rows
+
+# WRS-2 Paths, Rows and footprints are read from a local index, rebuilt from the layer only when the geopackage has changed
+try:
+    wrs2 = wrs2index.load(ieo.ieogpkg, ieo.WRS2, args.wrs2index, verbose = args.verbose)
+except Exception as e:
+    print('Error loading WRS-2 index, scene centres will be requested from the USGS: {}'.format(e))
+    ieo.logerror(ieo.WRS2, e, errorfile = errorfile)
+    wrs2 = None
+
+def parsepathrowvals(pathrowvals):
+    # This returns the set of Path/Row strings for a comma-delimited string of multiples of start path, end path, start row, end row,
+    # as in the INI file, and adds its Paths and Rows to paths and rows
+    pathrowset = set()
     pathrowvals = pathrowvals.split(',')
     iterations = int(len(pathrowvals) / 4)
     for i in range(iterations):
         for j in range(int(pathrowvals[i * 4]), int(pathrowvals[i * 4 + 1]) + 1):
-            if not j in paths:
-                paths.append(j)
+            paths.add(j)
             for k in range(int(pathrowvals[i * 4 + 2]), int(pathrowvals[i * 4 + 3]) + 1):
-                pathrowstrs.append('{:03d}{:03d}'.format(j, k))
-                if not k in rows:
-                    rows.append(k)
+                pathrowset.add('{:03d}{:03d}'.format(j, k))
+                rows.add(k)
+    return pathrowset
+
+if useWRS2.lower() == 'yes' and wrs2:
+    print('Getting WRS-2 Path/Row combinations from WRS-2 index of: {}'.format(ieo.WRS2))
+    pathrowstrs = wrs2.pathrowstrs()
+    paths = set(wrs2.pathlist())
+    rows = set(wrs2.rowlist())
+else:
+    print('Using WRS-2 Path/Row combinations from INI file.')
+    pathrowstrs = parsepathrowvals(pathrowvals)
+
+# Further areas of interest are synced in the same pass, so searches cover the union of all of their Path/Rows
+catalogpathrowstrs = set(pathrowstrs) # Path/Rows of the configured catalog layer
+aoilist = [] # [layer name, set of Path/Row strings, geopackage] per --aoi
+if args.aoi:
+    for aoi in args.aoi:
+        if len(aoi) < 2 or len(aoi) > 3:
+            ieo.logerror('--aoi', 'Wrong number of values: {}'.format(' '.join(aoi)), errorfile = errorfile)
+            print('Error: --aoi requires a layer name, pathrowvals, and optionally a geopackage ({} given). Exiting.'.format(' '.join(aoi)))
+            sys.exit()
+        if len(aoi) == 3:
+            aoigpkg = aoi[2]
+        else:
+            aoigpkg = ieo.catgpkg
+        if aoi[0] == ieo.landsatshp and os.path.abspath(aoigpkg) == os.path.abspath(ieo.catgpkg):
+            print('Error: --aoi layer {} is the configured catalog layer. Exiting.'.format(aoi[0]))
+            sys.exit()
+        try:
+            aoipathrowstrs = parsepathrowvals(aoi[1])
+        except (IndexError, ValueError) as e:
+            ieo.logerror('--aoi', e, errorfile = errorfile)
+            print('Error: bad pathrowvals for --aoi layer {}: {}. Exiting.'.format(aoi[0], aoi[1]))
+            sys.exit()
+        aoilist.append([aoi[0], aoipathrowstrs, aoigpkg])
+        pathrowstrs = pathrowstrs | aoipathrowstrs
+    print('Searching {} Path/Rows for the catalog layer and {} areas of interest.'.format(len(pathrowstrs), len(aoilist)))
 
 ## JSON functions
 
+# Search result fields used by scenesearch(), including inline metadata and footprints returned with --fullmetadata
+resultkeys = ['entityId', 'displayId', 'acquisitionDate', 'modifiedDate', 'browseUrl', 'dataAccessUrl', 'downloadUrl', 'metadataUrl',
+              'fgdcMetadataUrl', 'orderUrl', 'metadataFields', 'metadata', 'spatialFootprint', 'spatialCoverage']
+
 def getapiKey():
     # This function gets the apiKey used for all queries to the USGS/EROS servers
     URL = '{}{}/login'.format(args.baseURL, args.version)
     print('Logging in to: {}'.format(URL))
-    data = json.dumps({'username': args.username, 'password': args.password, 'catalog_ID': args.catalogID})
-    response = requests.post(URL, data = {'jsonRequest':data}) #
-    json_data = json.loads(response.text)
+    json_data = session.postjson(URL, {'username': args.username, 'password': args.password, 'catalog_ID': args.catalogID})
     apiKey = json_data['data']
+    metrics.count('logins')
     return apiKey
 
 def getMBR():
-    # This creates the Minimum Bounding Rectangle (MBR) for JSON queries
+    # This creates the Minimum Bounding Rectangle (MBR) for JSON queries from the USGS grid2ll service, if the WRS-2 index cannot be used
     URL = '{}{}/grid2ll'.format(args.baseURL, args.version)
     prs = [[min(paths), min(rows)], [min(paths), max(rows)], [max(paths), max(rows)], [max(paths), min(rows)]]
     Xcoords = []
@@ -142,204 +258,521 @@ def getMBR():
         print('Requesting coordinates for WRS-2 Path {} Row {}.'.format(pr[0], pr[1]))
         jsonRequest = json.dumps({"gridType" : "WRS2", "responseShape" : "point", "path" : str(pr[0]), "row" : str(pr[1])}).replace(' ','')
         requestURL = '{}?jsonRequest={}'.format(URL, jsonRequest)
-        response = requests.post(requestURL) # URL, data = {'jsonRequest': jsonRequest}
+        response = session.post(requestURL) # URL, data = {'jsonRequest': jsonRequest}
         json_data = json.loads(response.text)
         # print(response.text)
         Xcoords.append(float(json_data["data"]["coordinates"][0]["longitude"]))
         Ycoords.append(float(json_data["data"]["coordinates"][0]["latitude"]))
     return [min(Ycoords), min(Xcoords), max(Ycoords), max(Xcoords)]
 
-def scenesearch(apiKey, scenelist, updatemissing, badgeom, lastmodifiedDate):
-    # This searches the USGS archive for scene metadata, and checks it against local metadata. New scenes will be queried for metadata.
+def yearchunks(datasetName, startdate, sensorstartdate, state):
+    # This divides the period to search for a collection, restricted to times from which the sensor was in orbit, into calendar-year
+    # chunks, so that windows and digests are the same from run to run. Periods already completed in a resumed sync are skipped.
+    # Returns [start, end, whole] for each chunk, where whole is True if it covers all of the year in which the sensor was in orbit.
+    if '/' in startdate:
+        startdate = startdate.replace('/', '-')
+    datetuple = datetime.datetime.strptime(startdate, '%Y-%m-%d')
+    sensorstarttuple = datetime.datetime.strptime(sensorstartdate, '%Y-%m-%d') # restrict searches to times from which sensor was in orbit
+    if datetuple < sensorstarttuple:
+        datetuple = sensorstarttuple
+    enddatetuple = datetime.datetime.strptime(args.enddate, '%Y-%m-%d')
+    missionendtuple = None
+    if datasetName == 'landsat_tm_c2_l2':
+        missionendtuple = datetime.datetime.strptime('2013-06-05', '%Y-%m-%d') # end of Landsat 5 mission
+        if missionendtuple < enddatetuple:
+            enddatetuple = missionendtuple
+    if datetuple > enddatetuple:
+        return []
+    oneday = datetime.timedelta(days = 1)
+    chunks = []
+    for gapstart, gapend in state.uncovered(datasetName, datetuple.strftime('%Y-%m-%d'), enddatetuple.strftime('%Y-%m-%d')):
+        cursor = datetime.datetime.strptime(gapstart, '%Y-%m-%d')
+        gapendtuple = datetime.datetime.strptime(gapend, '%Y-%m-%d')
+        while cursor <= gapendtuple:
+            yearend = datetime.datetime(cursor.year, 12, 31)
+            if missionendtuple and missionendtuple < yearend:
+                yearend = missionendtuple
+            chunkend = min(yearend, gapendtuple)
+            whole = cursor == max(datetime.datetime(cursor.year, 1, 1), sensorstarttuple) and chunkend == yearend
+            chunks.append([cursor.strftime('%Y-%m-%d'), chunkend.strftime('%Y-%m-%d'), whole])
+            cursor = chunkend + oneday
+    return chunks
+
+def planwindows(datasetName, chunks, state):
+    # This plans the search windows for the yearly chunks of a collection that are to be searched. The number of scenes expected in each
+    # chunk is estimated from the densities recorded by earlier searches. Chunks expected to hold more than args.windowfill of args.maxResults
+    # scenes are split, and consecutive sparse chunks merged, so that each window is expected to return about that many. Chunks with no
+    # estimate are searched on their own, as yearly windows.
+    target = max(args.maxResults * args.windowfill, 1)
+    oneday = datetime.timedelta(days = 1)
+    parts = [] # [start, end, expected scenes]
+    for chunkstart, chunkend, whole in chunks:
+        cursor = datetime.datetime.strptime(chunkstart, '%Y-%m-%d')
+        chunkendtuple = datetime.datetime.strptime(chunkend, '%Y-%m-%d')
+        days = (chunkendtuple - cursor).days + 1
+        density = state.density(datasetName, chunkstart, chunkend)
+        if density is None:
+            parts.append([cursor, chunkendtuple, target])
+        else:
+            expected = density * days
+            numparts = min(max(math.ceil(expected / target), 1), days)
+            length = math.ceil(days / numparts)
+            while cursor <= chunkendtuple:
+                partend = min(cursor + datetime.timedelta(days = length - 1), chunkendtuple)
+                parts.append([cursor, partend, expected * ((partend - cursor).days + 1) / days])
+                cursor = partend + oneday
+    windows = []
+    for partstart, partend, expected in parts:
+        if len(windows) > 0 and windows[-1][1] + oneday == partstart and windows[-1][2] + expected <= target:
+            windows[-1][1] = partend
+            windows[-1][2] += expected
+        else:
+            windows.append([partstart, partend, expected])
+    return [[window[0].strftime('%Y-%m-%d'), window[1].strftime('%Y-%m-%d')] for window in windows]
+
+def windowparams(datasetName, startdate, enddate):
+    # This returns the spatial and temporal filters of a search or hits request for a single collection and temporal window
+    return {"datasetName": datasetName,
+                    "spatialFilter":{"filterType": "mbr",
+                                     "lowerLeft":{"latitude": args.MBR[0],
+                                                  "longitude": args.MBR[1]},
+                                     "upperRight":{"latitude": args.MBR[2],
+                                                   "longitude": args.MBR[3]}},
+                    "temporalFilter":{"startDate": startdate,
+                                      "endDate": enddate},
+                    "includeUnknownCloudCover":False,
+                    "maxCloudCover": 100}
+
+def searchwindow(datasetName, startdate, enddate, startingNumber = 1):
+    # This sends the search request for a single collection and temporal window. It is run from the worker pool in scenesearch().
+    # Results are counted by year of acquisition as they are decoded, before those outside pathrowstrs are dropped, and the counts
+    # added to the response as 'yearhits', so that the hits of each yearly chunk a window covers can be recorded with its digest.
     RequestURL = '{}{}/search'.format(args.baseURL, args.version)
+    searchparams = windowparams(datasetName, startdate, enddate)
+    searchparams["maxResults"] = args.maxResults
+    searchparams["sortOrder"] = "ASC"
+    if startingNumber > 1:
+        searchparams["startingNumber"] = startingNumber
+    if args.fullmetadata:
+        searchparams["metadataType"] = "full"
+    yearhits = {}
+    def keep(result):
+        year = str(result.get('acquisitionDate'))[:4]
+        yearhits[year] = yearhits.get(year, 0) + 1
+        return keepresult(result)
+    json_data = session.postjson(RequestURL, searchparams, cached = True, apikey = apikey, keep = keep)
+    json_data['data']['yearhits'] = yearhits
+    return json_data
+
+def counthits(datasetName, startdate, enddate):
+    # This returns the number of scenes a search of a window would find, from a hits request, or None if the request fails
+    HitsURL = '{}{}/hits'.format(args.baseURL, args.version)
+    try:
+        hits = session.postjson(HitsURL, windowparams(datasetName, startdate, enddate), apikey = apikey)['data']
+    except Exception as e:
+        print('Error counting scenes in collection {} from {} through {}, they will be searched instead: {}'.format(datasetName, startdate, enddate, e))
+        return None
+    if isinstance(hits, dict):
+        hits = hits.get('totalHits')
+    return hits
+
+def unchangedchunks(datasetName, known):
+    # This checks the yearly chunks of a collection with recent digests, given in known as {(start, end): total hits}, and returns those
+    # whose hit counts are unchanged. Consecutive chunks are checked together, with a single hits request against the sum of their
+    # counts, and a group whose count differs is halved and checked again, so that unchanged years cost only a few calls.
+    # It is run from the worker pool in scenesearch().
+    oneday = datetime.timedelta(days = 1)
+    groups = []
+    for chunk in sorted(known.keys()):
+        if len(groups) > 0 and datetime.datetime.strptime(groups[-1][-1][1], '%Y-%m-%d') + oneday == datetime.datetime.strptime(chunk[0], '%Y-%m-%d'):
+            groups[-1].append(chunk)
+        else:
+            groups.append([chunk])
+    unchanged = []
+    while len(groups) > 0:
+        group = groups.pop()
+        hits = counthits(datasetName, group[0][0], group[-1][1])
+        if hits == sum(known[chunk] for chunk in group):
+            unchanged.extend(group)
+        elif hits is not None and len(group) > 1:
+            middle = len(group) // 2
+            groups.append(group[middle:])
+            groups.append(group[:middle])
+    return sorted(unchanged)
+
+def recorddigests(chunkdigests, datasetName, startdate, enddate, yearhits, results, complete, state):
+    # This adds the hits and results of a finished window to the whole yearly chunks it covers, held in chunkdigests as [days remaining,
+    # total hits, results, complete] by (collection, start, end), since windows may be split or merged. Once every window covering a
+    # chunk has finished, its digest is recorded, if all of them were complete.
+    start = datetime.datetime.strptime(startdate, '%Y-%m-%d')
+    end = datetime.datetime.strptime(enddate, '%Y-%m-%d')
+    for key in sorted(chunkdigests.keys()):
+        chunkdataset, chunkstart, chunkend = key
+        if chunkdataset != datasetName or chunkstart > enddate or chunkend < startdate:
+            continue
+        chunk = chunkdigests[key]
+        chunk[0] -= (min(end, datetime.datetime.strptime(chunkend, '%Y-%m-%d')) - max(start, datetime.datetime.strptime(chunkstart, '%Y-%m-%d'))).days + 1
+        chunk[1] += yearhits.get(chunkstart[:4], 0)
+        chunk[2].extend(result for result in results if chunkstart <= str(result.get('acquisitionDate'))[:10] <= chunkend)
+        chunk[3] = chunk[3] and complete
+        if chunk[0] > 0:
+            continue
+        del chunkdigests[key]
+        if chunk[3]:
+            digest = syncstate.digestresults(chunk[2])
+            previous = state.getdigest(datasetName, chunkstart, chunkend, digestscope)
+            if previous and previous[1] != digest:
+                metrics.count('digests_changed', dataset = datasetName)
+            state.setdigest(datasetName, chunkstart, chunkend, chunk[1], digest, digestscope)
+
+def keepresult(result):
+    # This is applied to each search result as it is decoded. Results outside pathrowstrs are dropped, and only the fields used by
+    # scenesearch() are kept of the rest.
+    if not str(result.get('entityId'))[3:9] in pathrowstrs:
+        return None
+    return dict((key, result[key]) for key in resultkeys if key in result)
+
+def catalogued(sceneID, sceneidindex):
+    # This returns True if a scene is already in the catalog layer, if within its Path/Rows, and in every --aoi layer whose Path/Rows include it
+    if sceneID[3:9] in catalogpathrowstrs and not sceneID in sceneidindex:
+        return False
+    for aoi in aois:
+        if aoi.needs(sceneID):
+            return False
+    return True
+
+def querymetadata(datasetName, sceneIDs):
+    # This requests metadata for a batch of scenes, and reports its latency to batchsizer. It is run from the worker pool in scenesearch().
+    QueryURL = '{}{}/metadata'.format(args.baseURL, args.version)
+    queryparams = {"datasetName":datasetName,
+                'entityIds': ','.join(sceneIDs)}
+    start = time.perf_counter()
+    try:
+        json_data = session.postjson(QueryURL, queryparams, cached = True, apikey = apikey)
+    except Exception:
+        batchsizer.record(len(sceneIDs), time.perf_counter() - start, ok = False)
+        raise
+    batchsizer.record(len(sceneIDs), time.perf_counter() - start)
+    metrics.observe('metadata_batch_size', len(sceneIDs), buckets = (10, 25, 50, 100, 200, 500, 1000, 2000, 5000))
+    return json_data
+
+def itemfields(item):
+    # This returns the metadata fields of a metadata response item or of a search result with full metadata, whose key depends on the API
+    if 'metadataFields' in item:
+        return item['metadataFields']
+    return item.get('metadata') or []
+
+def parseitem(item, scene, updatemissing, badgeom):
+    # This parses the metadata fields and footprint of one item into a scene record, in a single pass over its fields.
+    # Values already set from search results are kept.
+    sceneID = scene.sceneID
+    for subitem in itemfields(item):
+        fieldname, codec = fieldcodec.getraw(subitem['fieldName'])
+        if codec and fieldname != 'Landsat Scene Identifier' and fieldcodec.getvalue(scene, fieldname) is None:
+            value = subitem['value']
+            if value:
+                if codec[2]:
+                    value = codec[2](value)
+                fieldcodec.setvalue(scene, fieldname, value)
+    scene.updatemodifiedDate = sceneID in badgeom or sceneID in updatemissing
+    scene.updategeom = sceneID in badgeom
+    if 'spatialFootprint' in item:
+        scene.coords = item['spatialFootprint']['coordinates'][0]
+    else:
+        scene.coords = item['spatialCoverage']['coordinates'][0]
+    if 'modifiedDate' in item:
+        fieldcodec.setvalue(scene, 'modifiedDate', item['modifiedDate'])
+    return scene
+
+def parsemetadata(querydict, scenedict, updatemissing, badgeom):
+    # This parses a metadata query response into the scene records in scenedict. Items are matched to scenes by entity ID, and
+    # only by their Landsat Scene Identifier field if that is missing or unknown.
+    for item in querydict['data']:
+        fields = itemfields(item)
+        if len(fields) > 0:
+            sceneID = item.get('entityId')
+            if not sceneID in scenedict:
+                for subitem in fields:
+                    if subitem['fieldName'] == 'Landsat Scene Identifier':
+                        sceneID = subitem['value']
+                        break
+            parseitem(item, scenedict[sceneID], updatemissing, badgeom)
+    return scenedict
+
+def scenesearch(scenelist, updatemissing, badgeom, state):
+    # This searches the USGS archive for scene metadata, and checks it against local metadata. New scenes will be queried for metadata.
+    # Searches and metadata queries are run concurrently by a pool of args.workers threads, but responses are parsed in collection,
+    # window, and batch order so that runs remain reproducible. Each parsed metadata batch is written to the geopackage layer and
+    # checkpointed in state before the next one, and each window once all of its batches are in. Only args.workers searches and
+    # metadata queries are held at a time, and scenes are kept as SceneRecords only until their batch has been written, so that
+    # memory use is bounded by the window and batch sizes rather than the length of the archive. Returns the number of scenes written.
+    global errorsfound
     QueryURL = '{}{}/metadata'.format(args.baseURL, args.version)
     datasetNames = {'landsat_ot_c2_l2' : '2013-02-11', 'landsat_etm_c2_l2' : '1999-04-15', 'landsat_tm_c2_l2' : '1982-07-16'}
-    scenedict = {}
-#    js = {'LL': 0, 'UL': 1, 'UR': 2, 'LR': 3}
-    for datasetName in datasetNames.keys():
-        print('Querying collection: {}'.format(datasetName))
-        if lastmodifiedDate and not (len(updatemissing) > 0 or len(badgeom) > 0):
-            startdate = lastmodifiedDate
-        else:
-            startdate = args.startdate
-        if '/' in startdate:
-            startdate = startdate.replace('/', '-')
-        datetuple = datetime.datetime.strptime(startdate, '%Y-%m-%d')
-        sensorstarttuple = datetime.datetime.strptime(datasetNames[datasetName], '%Y-%m-%d') # restrict searches to times from which sensor was in orbit
-        if datetuple < sensorstarttuple:
-            datetuple = sensorstarttuple
-        enddatetuple = datetime.datetime.strptime(args.enddate, '%Y-%m-%d')
-        if datasetName == 'landsat_tm_c2_l2':
-            l5enddatetuple = datetime.datetime.strptime('2013-06-05', '%Y-%m-%d') # end of Landsat 5 mission
-            if l5enddatetuple < enddatetuple:
-                enddatetuple = l5enddatetuple
-        while datetuple < enddatetuple:
-            edatetuple = datetuple + datetime.timedelta(days = 365) # iterate by year
-            if edatetuple > enddatetuple:
-                edatetuple = enddatetuple
-            startdate = datetuple.strftime('%Y-%m-%d')
-            enddate = edatetuple.strftime('%Y-%m-%d')
+    fetched = state.fetchedscenes() # scenes already committed earlier in a resumed sync
+    numscenes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(args.workers, 1)) as executor:
+        # Whole years with digests recorded by a recent run with the same MBR and Path/Rows are only searched if their hit counts have changed
+        checks = []
+        for datasetName in datasetNames.keys():
+            chunks = yearchunks(datasetName, state.startdate, datasetNames[datasetName], state)
+            known = {}
+            if not args.ignoredigests:
+                for chunkstart, chunkend, whole in chunks:
+                    digest = state.getdigest(datasetName, chunkstart, chunkend, digestscope) if whole else None
+                    if digest and digest[2] < args.digestage:
+                        known[(chunkstart, chunkend)] = digest[0]
+            checks.append([datasetName, chunks, executor.submit(unchangedchunks, datasetName, known)])
+        windows = []
+        chunkdigests = {} # whole years being searched, whose digests are recorded once all of their windows have finished
+        for datasetName, chunks, checkfuture in checks:
+            with profiler.phase('search'):
+                unchanged = checkfuture.result()
+            for chunkstart, chunkend in unchanged:
+                print('No changes found in collection {} from {} through {} since it was last searched, skipping.'.format(datasetName, chunkstart, chunkend))
+                metrics.count('windows_unchanged', dataset = datasetName)
+                state.windowdone(datasetName, chunkstart, chunkend, 0)
+            chunks = [chunk for chunk in chunks if not (chunk[0], chunk[1]) in unchanged]
+            for chunkstart, chunkend, whole in chunks:
+                if whole:
+                    chunkdigests[(datasetName, chunkstart, chunkend)] = [(datetime.datetime.strptime(chunkend, '%Y-%m-%d') - datetime.datetime.strptime(chunkstart, '%Y-%m-%d')).days + 1, 0, [], True]
+            for window in planwindows(datasetName, chunks, state):
+                windows.append([datasetName, window[0], window[1]])
+        print('{} search windows planned.'.format(len(windows)))
+        searches = collections.deque()
+        nextwindow = 0
+        while len(searches) > 0 or nextwindow < len(windows):
+            while nextwindow < len(windows) and len(searches) < max(args.workers, 1): # keep the searches for the next few windows in flight
+                datasetName, startdate, enddate = windows[nextwindow]
+                searches.append([datasetName, startdate, enddate, executor.submit(searchwindow, datasetName, startdate, enddate)])
+                nextwindow += 1
+            datasetName, startdate, enddate, searchfuture = searches.popleft()
             print('Now searching for scene data from collection {} from {} through {}.'.format(datasetName, startdate, enddate))
-            searchparams = json.dumps({"apiKey": apiKey,
-                            "datasetName": datasetName,
-                            "spatialFilter":{"filterType": "mbr",
-                                             "lowerLeft":{"latitude": args.MBR[0],
-                                                          "longitude": args.MBR[1]},
-                                             "upperRight":{"latitude": args.MBR[2],
-                                                           "longitude": args.MBR[3]}},
-                            "temporalFilter":{"startDate": startdate,
-                                              "endDate": enddate},
-                            "includeUnknownCloudCover":False,
-                            "maxCloudCover": 100,
-                            "maxResults": args.maxResults,
-                            "sortOrder": "ASC"})
-            response = requests.post(RequestURL, data = {'jsonRequest': searchparams})
-            json_data = json.loads(response.text)
+            with metrics.span('search', dataset = datasetName, startdate = startdate, enddate = enddate) as span, profiler.phase('search'):
+                json_data = searchfuture.result()
+                results = json_data['data']['results']
+                yearhits = json_data['data'].get('yearhits', {})
+                returned = json_data['data'].get('returned', len(results)) # before results outside pathrowstrs were dropped
+                totalHits = json_data['data'].get('totalHits', returned)
+                span.set(totalhits = totalHits, returned = returned, kept = len(results))
+            state.recordhits(datasetName, startdate, enddate, totalHits)
+            json_data = None
+            if totalHits > returned: # the window was truncated at maxResults
+                startdatetuple = datetime.datetime.strptime(startdate, '%Y-%m-%d')
+                days = (datetime.datetime.strptime(enddate, '%Y-%m-%d') - startdatetuple).days + 1
+                if days > 1:
+                    middate = (startdatetuple + datetime.timedelta(days = days // 2 - 1)).strftime('%Y-%m-%d')
+                    nextdate = (startdatetuple + datetime.timedelta(days = days // 2)).strftime('%Y-%m-%d')
+                    print('Only {} of {} scenes were returned, splitting window at {}.'.format(returned, totalHits, middate))
+                    metrics.count('windows_split', dataset = datasetName)
+                    searches.appendleft([datasetName, nextdate, enddate, executor.submit(searchwindow, datasetName, nextdate, enddate)])
+                    searches.appendleft([datasetName, startdate, middate, executor.submit(searchwindow, datasetName, startdate, middate)])
+                    continue
+                while returned < totalHits: # a single day cannot be split further, so the rest of its results are paged through
+                    metrics.count('search_pages', dataset = datasetName)
+                    with profiler.phase('search'):
+                        pagedata = searchwindow(datasetName, startdate, enddate, startingNumber = returned + 1)['data']
+                    pagereturned = pagedata.get('returned', len(pagedata['results']))
+                    if pagereturned == 0:
+                        break
+                    returned += pagereturned
+                    results.extend(pagedata['results'])
+                    for year in pagedata.get('yearhits', {}).keys():
+                        yearhits[year] = yearhits.get(year, 0) + pagedata['yearhits'][year]
+            digestkeys = [dict((key, result.get(key)) for key in ['entityId', 'modifiedDate', 'acquisitionDate']) for result in results]
+            complete = True # whether every new scene in the window was committed, so that the digests of its years can be recorded
+            scenedict = {}
             querylist = []
-            # print(response.text)
-            for i in range(len(json_data['data']['results'])):
-                sceneID = json_data['data']['results'][i]['entityId']
-                if sceneID[3:9] in pathrowstrs and (not sceneID in scenelist or sceneID in updatemissing or sceneID in badgeom):
-                    querylist.append(sceneID)
-                    scenedict[sceneID] = {'Landsat Product Identifier': json_data['data']['results'][i]["displayId"],
-                             "browseUrl": json_data['data']['results'][i]["browseUrl"],
-                             "dataAccessUrl": json_data['data']['results'][i]["dataAccessUrl"],
-                             "downloadUrl": json_data['data']['results'][i]["downloadUrl"],
-                             "metadataUrl": json_data['data']['results'][i]["metadataUrl"],
-                             "fgdcMetadataUrl": json_data['data']['results'][i]["fgdcMetadataUrl"],
-                             # 'modifiedDate': datetime.datetime.strptime(json_data['data']['results'][i]["modifiedDate"], '%Y-%m-%d'),
-                             "orderUrl": json_data['data']['results'][i]["orderUrl"],
-                             'Dataset Identifier': datasetName,
-                             'updatemodifiedDate': False,
-                             'updategeom': False}
-                    if json_data['data']['results'][i]["modifiedDate"] == 'Unknown':
-                        scenedict[sceneID]['modifiedDate'] = datetime.datetime.strptime(json_data['data']['results'][i]["acquisitionDate"], '%Y-%m-%d')
-                    elif ' ' in json_data['data']['results'][i]["modifiedDate"]:
-                        print(json_data['data']['results'][i]["modifiedDate"])
-                        space = json_data['data']['results'][i]["modifiedDate"].find(' ')
-                        scenedict[sceneID]['modifiedDate'] = datetime.datetime.strptime(json_data['data']['results'][i]["modifiedDate"][:space], '%Y-%m-%d')
+            ready = [] # scenes returned with full metadata, which need no metadata query
+            for i in range(len(results)):
+                sceneID = results[i]['entityId']
+                if sceneID[3:9] in pathrowstrs and not catalogued(sceneID, scenelist) and not sceneID in fetched: # existing features needing repair are handled by repairscenes()
+                    scene = fieldcodec.newrecord(sceneID)
+                    fieldcodec.setvalue(scene, 'Landsat Product Identifier', results[i]["displayId"])
+                    for key in ["browseUrl", "dataAccessUrl", "downloadUrl", "metadataUrl", "fgdcMetadataUrl", "orderUrl"]:
+                        fieldcodec.setvalue(scene, key, results[i][key])
+                    fieldcodec.setvalue(scene, 'Dataset Identifier', datasetName)
+                    if results[i]["modifiedDate"] == 'Unknown':
+                        fieldcodec.setvalue(scene, 'modifiedDate', datetime.datetime.strptime(results[i]["acquisitionDate"], '%Y-%m-%d'))
+                    elif ' ' in results[i]["modifiedDate"]:
+                        print(results[i]["modifiedDate"])
+                        space = results[i]["modifiedDate"].find(' ')
+                        fieldcodec.setvalue(scene, 'modifiedDate', datetime.datetime.strptime(results[i]["modifiedDate"][:space], '%Y-%m-%d'))
                     else:
-                        scenedict[sceneID]['modifiedDate'] = datetime.datetime.strptime(json_data['data']['results'][i]["modifiedDate"], '%Y-%m-%d')
+                        fieldcodec.setvalue(scene, 'modifiedDate', datetime.datetime.strptime(results[i]["modifiedDate"], '%Y-%m-%d'))
+                    scenedict[sceneID] = scene
+                    if args.fullmetadata and len(itemfields(results[i])) > 0:
+                        parseitem(results[i], scene, updatemissing, badgeom)
+                        ready.append(sceneID)
+                    else:
+                        querylist.append(sceneID)
+            results = None
+            metrics.count('scenes_queued', len(querylist), dataset = datasetName)
+            metrics.count('scenes_inline', len(ready), dataset = datasetName)
     
+            numbatches = 0
+            if len(ready) > 0: # these are written in batches as if they had been queried
+                print('{} new scenes have been returned with full metadata, writing them to the geopackage layer.'.format(len(ready)))
+                for nextval in range(0, len(ready), max(args.writebatch, 1)):
+                    numbatches += 1
+                    numscenes += commitbatch(scenedict, ready[nextval: nextval + max(args.writebatch, 1)], state, datasetName, startdate, enddate, numbatches)
+            ready = None
+
             if len(querylist) > 0:
-                print('{} new scenes have been found or require updating, querying metadata.'.format(len(querylist)))
-                iterations = math.ceil(len(querylist) / 100) # break up queries into blocks of 100 or less scenes
-                total = 0
-    #            iterations = 1 # temporary limitation
-                for iteration in range(iterations):
-                    startval = iteration * 100
-                    if iteration * 100 > len(querylist):
-                        endval = len(querylist) - startval - 1
-                    else:
-                        endval = startval + 99
-                    total += endval + 1
-                    print('Now querying {} scenes, query {}/{}.'.format((endval - startval + 1), iteration + 1, iterations))
-                    querystr = ''
+                print('{} new scenes have been found or require updating, queueing metadata queries.'.format(len(querylist)))
     
-                    for sceneID in querylist[startval: endval]:
-                        querystr += ',{}'.format(sceneID)
-                    querystr = querystr[1:]
-                    queryparams = json.dumps({"apiKey":apiKey,
-                                "datasetName":datasetName,
-                                'entityIds': querystr})
+            failed = []
+            pending = collections.deque()
+            nextval = 0
+            while len(pending) > 0 or nextval < len(querylist):
+                while nextval < len(querylist) and len(pending) < max(args.workers, 1): # only the next few batches are queried ahead of parsing
+                    sceneIDs = querylist[nextval: nextval + batchsizer.size()] # each batch is cut at the current adaptive size
+                    nextval += len(sceneIDs)
+                    numbatches += 1
+                    pending.append([numbatches, '{}/{} scenes'.format(nextval, len(querylist)), sceneIDs, executor.submit(querymetadata, datasetName, sceneIDs)])
+                iteration, progress, sceneIDs, batchfuture = pending.popleft()
+                print('Now parsing metadata for {} scenes from collection {}, query {} ({}).'.format(len(sceneIDs), datasetName, iteration, progress))
+                try:
+                    with metrics.span('metadata', dataset = datasetName, scenes = len(sceneIDs)), profiler.phase('parse'):
+                        scenedict = parsemetadata(batchfuture.result(), scenedict, updatemissing, badgeom)
+                except Exception as e:
+                    print('ERROR: metadata query {} ({}) for collection {} failed, it will be retried: {}'.format(iteration, progress, datasetName, e))
+                    metrics.count('metadata_failures', dataset = datasetName)
+                    failed.append([iteration, progress, sceneIDs])
+                    continue
+                numscenes += commitbatch(scenedict, sceneIDs, state, datasetName, startdate, enddate, iteration)
+            
+            # Batches that failed even after the session's own retries get one more attempt once the rest of the window is in, so they aren't lost
+            if len(failed) > 0:
+                print('Retrying {} failed metadata queries.'.format(len(failed)))
+                retries = [[iteration, progress, sceneIDs, executor.submit(querymetadata, datasetName, sceneIDs)] for iteration, progress, sceneIDs in failed]
+                for iteration, progress, sceneIDs, batchfuture in retries:
                     try:
-                        query = requests.post(QueryURL, data = {'jsonRequest':queryparams})
-        #                if endval == 99:
-                        
-                        if args.savequeries:
-                            now = datetime.datetime.now()
-                            outfile = os.path.join(ieo.ingestdir, 'query_{}_{}.txt'.format(datasetName, now.strftime('%Y%m%d-%H%M%S')))
-                            with open(outfile, 'w') as output:
-                                output.write(query.text)
-                        querydict = json.loads(query.text)
-                        if len(querydict['data']) > 0:
-                            
-                            for item in querydict['data']:
-                                if len(item['metadataFields']) > 0:
-                                    if item['metadataFields'][1]['fieldName'] == 'Landsat Scene Identifier':
-                                        sceneID = item['metadataFields'][1]['value']
-                                    else:
-                                        for subitem in item['metadataFields']:
-                                            if subitem['fieldName']  == 'Landsat Scene Identifier':
-                                                sceneID = subitem['value']
-                                                break
-                                    for subitem in item['metadataFields']:
-                                        fieldname = subitem['fieldName'].rstrip().lstrip().replace('L-1', 'L1')
-                                        if fieldname in queryfieldnames and not fieldname in scenedict[sceneID].keys() and fieldname != 'Landsat Scene Identifier':
-                                            value = subitem['value']
-                                            if value:
-                                                i = queryfieldnames.index(fieldname)
-                                                if fieldvaluelist[i][3] == ogr.OFTDate or fieldname.endswith('Date'):
-                                                    if 'Time' in fieldname:
-                                                        value = datetime.datetime.strptime(value[:-1], '%Y:%j:%H:%M:%S.%f')
-                                                    elif '/' in value:
-                                                        value = datetime.datetime.strptime(value, '%Y/%m/%d')
-                                                    else:
-                                                        value = datetime.datetime.strptime(value, '%Y-%m-%d')
-                                                elif fieldvaluelist[i][3] == ogr.OFTReal:
-                                                    value = float(value)
-                                                elif fieldvaluelist[i][3] == ogr.OFTInteger:
-                                                    try:
-                                                        value = int(value)
-                                                    except:
-                                                        print('Error: fieldname {} has a value of {}, changing to -9999.'.format(fieldname, value))
-                                                        value = -9999
-                                                elif fieldname == 'browseUrl':
-                                                    if value:
-                                                        if value.lower() != 'null':
-                                                            scenedict[sceneID]['browse'] = 'Y'
-                                                        else:
-                                                            scenedict[sceneID]['browse'] = 'N'
-                                                elif fieldname == 'Data Type Level-1':
-                                                    j = value.rfind('_') + 1
-                                                    value = value[j:]
-                                                scenedict[sceneID][fieldname] = value
-                                    if sceneID in badgeom or sceneID in updatemissing:
-                                        scenedict[sceneID]['updatemodifiedDate'] = True 
-                                    else: 
-                                        scenedict[sceneID]['updatemodifiedDate'] = False 
-                                    if sceneID in badgeom:
-                                        scenedict[sceneID]['updategeom'] = True
-                                    else: 
-                                        scenedict[sceneID]['updategeom'] = False
-                                    scenedict[sceneID]['coords'] = item['spatialFootprint']['coordinates'][0]
-                                    scenedict[sceneID]['modifiedDate'] = item['modifiedDate']
+                        with metrics.span('metadata', dataset = datasetName, scenes = len(sceneIDs), retry = True), profiler.phase('parse'):
+                            scenedict = parsemetadata(batchfuture.result(), scenedict, updatemissing, badgeom)
                     except Exception as e:
-                        print('ERROR: {e}')
-                        ieo.logerror(QueryURL, e)
+                        print('ERROR: metadata query {} ({}) for collection {} failed: {}'.format(iteration, progress, datasetName, e))
+                        metrics.count('metadata_failures', dataset = datasetName)
+                        ieo.logerror(QueryURL, e, errorfile = errorfile)
+                        complete = False
+                        continue
+                    numscenes += commitbatch(scenedict, sceneIDs, state, datasetName, startdate, enddate, iteration)
+            if complete:
+                state.windowdone(datasetName, startdate, enddate, len(querylist))
+            else: # left out of the checkpoint, so that --resume searches the window again for the scenes not yet fetched
+                print('Collection {} from {} through {} is incomplete, it will be searched again by --resume or the next run.'.format(datasetName, startdate, enddate))
+                state.windowfailed(datasetName, startdate, enddate)
+                errorsfound = True
+            recorddigests(chunkdigests, datasetName, startdate, enddate, yearhits, digestkeys, complete, state)
+            digestkeys = None
     
-                        # if not 'Spacecraft Identifier' in scenedict[sceneID].keys():
-                        #     scenedict[sceneID]['Spacecraft Identifier'] = 'LANDSAT_{}'.format(sceneID[2:3])
-                        # if 'Scan Gap Interpolation' in scenedict[sceneID].keys():
-                        #     if isinstance(scenedict[sceneID]['Scan Gap Interpolation'], float):
-                        #         scenedict[sceneID]['Scan Gap Interpolation'] = int(scenedict[sceneID]['Scan Gap Interpolation'])
-            datetuple = edatetuple + datetime.timedelta(days = 1)
+                # if not 'Spacecraft Identifier' in scenedict[sceneID].keys():
+                #     scenedict[sceneID]['Spacecraft Identifier'] = 'LANDSAT_{}'.format(sceneID[2:3])
+                # if 'Scan Gap Interpolation' in scenedict[sceneID].keys():
+                #     if isinstance(scenedict[sceneID]['Scan Gap Interpolation'], float):
+                #         scenedict[sceneID]['Scan Gap Interpolation'] = int(scenedict[sceneID]['Scan Gap Interpolation'])
+    return numscenes
+
+def repairscenes(sceneIDs, updatemissing, badgeom, state):
+    # This re-fetches metadata for existing features with missing modification dates or bad geometries directly by entity ID,
+    # in adaptively sized batches per collection, so that they can be repaired without searching the whole archive again. Failed
+    # batches are retried once, and if they fail again the run is left incomplete, so that they are repaired by --resume or the next run.
+    # Returns the number of scenes updated.
+    global errorsfound
+    QueryURL = '{}{}/metadata'.format(args.baseURL, args.version)
+    datasetprefixes = {'LC8' : 'landsat_ot_c2_l2', 'LO8' : 'landsat_ot_c2_l2', 'LT8' : 'landsat_ot_c2_l2', 'LC9' : 'landsat_ot_c2_l2',
+                    'LE7' : 'landsat_etm_c2_l2', 'LT5' : 'landsat_tm_c2_l2', 'LT4' : 'landsat_tm_c2_l2'}
+    fetched = state.fetchedscenes() # scenes already repaired earlier in a resumed sync
+    querylists = {}
+    for sceneID in sceneIDs:
+        if sceneID in fetched:
+            continue
+        if not sceneID[:3] in datasetprefixes:
+            print('Error: no collection is known for SceneID {}, it cannot be repaired.'.format(sceneID))
+            ieo.logerror(sceneID, 'Unknown collection, feature not repaired.', errorfile = errorfile)
+            continue
+        datasetName = datasetprefixes[sceneID[:3]]
+        if not datasetName in querylists:
+            querylists[datasetName] = []
+        querylists[datasetName].append(sceneID)
+    numscenes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(args.workers, 1)) as executor:
+        for datasetName in querylists.keys():
+            querylist = querylists[datasetName]
+            print('Requesting metadata for {} scenes from collection {} requiring repair.'.format(len(querylist), datasetName))
+            failed = []
+            pending = collections.deque()
+            nextval = 0
+            numbatches = 0
+            while len(pending) > 0 or nextval < len(querylist):
+                while nextval < len(querylist) and len(pending) < max(args.workers, 1):
+                    batchIDs = querylist[nextval: nextval + batchsizer.size()]
+                    nextval += len(batchIDs)
+                    numbatches += 1
+                    pending.append([numbatches, batchIDs, executor.submit(querymetadata, datasetName, batchIDs)])
+                iteration, batchIDs, batchfuture = pending.popleft()
+                scenedict = repairrecords(datasetName, batchIDs)
+                try:
+                    with profiler.phase('parse'):
+                        scenedict = parsemetadata(batchfuture.result(), scenedict, updatemissing, badgeom)
+                except Exception as e:
+                    print('ERROR: repair metadata query {} for collection {} failed, it will be retried: {}'.format(iteration, datasetName, e))
+                    metrics.count('metadata_failures', dataset = datasetName)
+                    failed.append([iteration, batchIDs])
+                    continue
+                numscenes += commitbatch(scenedict, batchIDs, state, datasetName, 'repair', 'repair', iteration)
+
+            # Batches that failed even after the session's own retries get one more attempt, as in scenesearch()
+            if len(failed) > 0:
+                print('Retrying {} failed repair metadata queries.'.format(len(failed)))
+                retries = [[iteration, batchIDs, executor.submit(querymetadata, datasetName, batchIDs)] for iteration, batchIDs in failed]
+                for iteration, batchIDs, batchfuture in retries:
+                    scenedict = repairrecords(datasetName, batchIDs)
+                    try:
+                        with profiler.phase('parse'):
+                            scenedict = parsemetadata(batchfuture.result(), scenedict, updatemissing, badgeom)
+                    except Exception as e:
+                        print('ERROR: repair metadata query {} for collection {} failed: {}'.format(iteration, datasetName, e))
+                        metrics.count('metadata_failures', dataset = datasetName)
+                        ieo.logerror(QueryURL, e, errorfile = errorfile)
+                        state.windowfailed(datasetName, 'repair', 'repair') # keeps the run open, so that the scenes are repaired by --resume
+                        errorsfound = True
+                        continue
+                    numscenes += commitbatch(scenedict, batchIDs, state, datasetName, 'repair', 'repair', iteration)
+    return numscenes
+
+def repairrecords(datasetName, sceneIDs):
+    # This returns a dict of new SceneRecords for a batch of scenes to be repaired from collection datasetName
+    scenedict = {}
+    for sceneID in sceneIDs:
+        scenedict[sceneID] = fieldcodec.newrecord(sceneID)
+        fieldcodec.setvalue(scenedict[sceneID], 'Dataset Identifier', datasetName)
     return scenedict
 
-def findlocalfiles(sceneID, fielddict, scenedict):
+def commitbatch(scenedict, sceneIDs, state, datasetName, startdate, enddate, iteration):
+    # This writes a parsed metadata batch to the geopackage layer, checkpoints it, and releases its scenes from scenedict
+    batchdict = {}
+    for sceneID in sceneIDs:
+        if sceneID in scenedict:
+            batchdict[sceneID] = scenedict.pop(sceneID)
+    with profiler.phase('write'):
+        writescenes(batchdict)
+    state.batchdone(datasetName, startdate, enddate, iteration, sceneIDs)
+    return len(batchdict)
+
+def findlocalfiles(sceneID, fielddict, scene):
+    # This finds the local tiles of each product derived from a scene, using the library index rather than globbing and reading headers
     tilebase = '{}_{}'.format(sceneID[:3], sceneID[9:16])
     for fieldname in fielddict:
-        tilelist = glob.glob(os.path.join(fielddict[fieldname]['dirname'], '{}*.dat'.format(tilebase)))
-        tiles = []
-        tilestr = None
-        if len(tilelist) > 0:
-            for f in tilelist:
-                parentrasters = ieo.readenvihdr(f.replace('.dat', '.hdr'))['parent rasters']
-                if sceneID in parentrasters:
-                    basename = os.path.basename(f)
-                    i = basename.rfind('_') + 1
-                    j = f.find('.')
-                    tiles.append(basename[i:j])
-            if len(tiles) > 0:
-                tilestr = tiles[0]
-                if len(tiles) > 1:
-                    for i in range(1, len(tiles)):
-                        tilestr += ',{}'.format(tiles[i])
-                scenedict[fieldname] = tilestr
-                if fieldname == 'Pixel_QA_tiles':
-                    scenedict['MaskType'] = 'Pixel_QA'
-                elif fieldname == 'Fmask_tiles':
-                    scenedict['MaskType'] = 'FMask'
+        tiles = library.findtiles(fieldname, tilebase, sceneID)
+        if len(tiles) > 0:
+            if scene.tiles is None:
+                scene.tiles = {}
+            scene.tiles[fieldname] = ','.join(tiles)
+            if fieldname == 'Pixel_QA_tiles':
+                scene.tiles['MaskType'] = 'Pixel_QA'
+            elif fieldname == 'Fmask_tiles':
+                scene.tiles['MaskType'] = 'FMask'
     
 #    srstr = feature.GetField('Surface_Reflectance_tiles')
 #    if isinstance(srstr, str):
@@ -366,7 +799,7 @@ def findlocalfiles(sceneID, fielddict, scenedict):
 #            scenedict['MaskType'] = 'Pixel_QA'
 #        elif isinstance(feature.GetField('Fmask_tiles'), str):
 #            scenedict['MaskType'] = 'FMask'
-    return scenedict
+    return scene
 
 ## Migration functions
     
@@ -482,76 +915,293 @@ def dlxmls(startdate, enddate, xmls, ingestdir, *args, **kwargs): # This downloa
 
 ## Other functions
 
-def dlthumb(dlurl, jpg, *args, **kwargs): # This downloads thumbnails from the USGS
-    global errorsfound
-    jpgdir, basename = os.path.split(jpg)
-    # f = os.path.join(jpgdir, basename)
-    r = requests.get(dlurl, allow_redirects=True)
-    open(jpg, 'wb').write(r.content)
-    # tries = 1
-    # downloaded = False
-    # print('Downloading {} to {}'.format(basename, jpgdir))
-    # while not downloaded and tries < 6:
-    #     print('Download attempt {} of 5.'.format(tries))
-    #     try:
-            
-    #         # url = urlopen(dlurl)
-    #         # urlretrieve(dlurl, filename = f)
-    #         # if url.length == os.stat(f).st_size:
-    #         #     downloaded = True
-    #         # else:
-    #         #     print('Error downloading, retrying.')
-    #         #     tries += 1
-    #     # except urllib.error.URLError as e:
-    #     except Exception as e:
-    #         print(e) # e.reason
-    #         ieo.logerror(dlurl, e, errorfile = errorfile) # e.reason
-    #         errorsfound = True
-    # if tries == 6:
-    #     ieo.logerror(f, 'Download error.', errorfile = errorfile)
-    #     print('Download failure: {}'.format(basename))
-    #     errorsfound = True
-    # else:
-    return 'Success!'
-
-def makeworldfile(jpg, geom): # This attempts to make a worldfile for thumbnails so they can be displayed in a GIS
-    img = Image.open(jpg)
-    basename = os.path.basename(jpg)
-    width, height = img.size
-    width = float(width)
-    height = float(height)
-    minX, maxX, minY, maxY = geom.GetEnvelope()
-    if basename[:3] == 'LE7':
-        wkt = geom.ExportToWkt()
-        start = wkt.find('(') + 2
-        end = wkt.find(')')
-        vals = wkt[start:end]
-        vals = vals.split(',')
-        corners = []
-        for val in vals:
-            val = val.split()
-            for v in val:
-                corners.append(float(v))
-        A = (maxX - corners[0]) / width
-        B = (corners[0] - minX) / height
-        C = corners[0]
-        D = (maxY - corners[3]) / width
-        E = (corners[3] - minY) / height
-        F = corners[1]
+def createlayer(data_source, layername):
+    # This creates a catalog layer with the fields of fieldvaluelist and those for local tiles and thumbnails
+    layer = data_source.CreateLayer(layername, target, ogr.wkbPolygon)
+    for element in fieldvaluelist:
+        field_name = ogr.FieldDefn(element[1], element[3])
+        if element[4] > 0:
+            field_name.SetWidth(element[4])
+        layer.CreateField(field_name)
+
+    layer.CreateField(ogr.FieldDefn('MaskType', ogr.OFTString)) # 'Fmask' or 'Pixel_QA'
+    layer.CreateField(ogr.FieldDefn('Thumbnail_filename', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('Surface_reflectance_tiles', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('Brightness_temperature_tiles', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('Fmask_tiles', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('Pixel_QA_tiles', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('NDVI_tiles', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('EVI_tiles', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('Tile_filename_base', ogr.OFTString))
+    return layer
+
+def addmissingfields(layer):
+    # This creates any fields of fieldvaluelist missing from an existing catalog layer
+    shpfnames = []
+    layerDefinition = layer.GetLayerDefn()
+    # Get list of field names
+    for i in range(layerDefinition.GetFieldCount()):
+        shpfnames.append(layerDefinition.GetFieldDefn(i).GetName())
+    # Find missing fields and create them
+    for fname in fnames:
+        if not fname in shpfnames:
+            i = fnames.index(fname)
+            field_name = ogr.FieldDefn(fnames[i], fieldvaluelist[i][3])
+            if fieldvaluelist[i][4] > 0:
+                field_name.SetWidth(fieldvaluelist[i][4])
+            layer.CreateField(field_name)
+
+def openaoi(name, aoipathrowstrs, gpkg):
+    # This opens, or creates, the catalog layer for an --aoi, and returns it as a landsatcatalog.AOILayer. Layers in the catalog
+    # geopackage share its data source. AOI layers are not validated or repaired, only added to.
+    if os.path.abspath(gpkg) == os.path.abspath(ieo.catgpkg):
+        aoisource = data_source
+    elif os.access(gpkg, os.F_OK):
+        aoisource = driver.Open(gpkg, 1)
     else:
-        A = (maxX - minX) / width
-        B = 0.0
-        C = minX
-        D = (maxY - minY) / height
-        E = 0.0
-        F = maxY
-    jpw = jpg.replace('.jpg', '.jpw')
-    if os.access(jpw, os.F_OK):
-        bak = jpw.replace('.jpw', '.jpw.{}.bak'.format(today.strftime('%Y%m%d-%H%M%S')))
-        shutil.move(jpw, bak)
-    with open(jpw, 'w') as file:
-        file.write('{}\n-{}\n-{}\n-{}\n{}\n{}\n'.format(A, D, B, E, C, F))
-    del img
+        aoisource = driver.CreateDataSource(gpkg)
+    if not aoisource:
+        raise IOError('Cannot open or create geopackage: {}'.format(gpkg))
+    aoilayer = aoisource.GetLayerByName(name)
+    created = not aoilayer
+    if created:
+        print('Creating layer {} in: {}'.format(name, gpkg))
+        aoilayer = createlayer(aoisource, name)
+    else:
+        addmissingfields(aoilayer)
+    codec = landsatcatalog.FieldCodec(fieldvaluelist)
+    codec.bind(aoilayer.GetLayerDefn())
+    landsatcatalog.createsceneidindex(aoisource, name)
+    aoiindex = landsatcatalog.loadsceneidindex(aoisource, aoilayer, name)
+    lastmodified = landsatcatalog.validatecatalog(aoisource, aoilayer, name, ['TM', 'ETM', 'OLI', 'TIRS', 'OLI_TIRS'])['lastmodified']
+    aoiwriter = landsatcatalog.CatalogWriter(aoisource, aoilayer, name, batchsize = args.writebatch, arrow = args.arrow, sceneidindex = aoiindex, verbose = args.verbose)
+    print('Area of interest {}: {} Path/Rows, {} scenes in layer, last modified {}.'.format(name, len(aoipathrowstrs), len(aoiindex), lastmodified))
+    return landsatcatalog.AOILayer(name, aoipathrowstrs, gpkg, aoisource, aoilayer, codec, aoiwriter, aoiindex, lastmodified = lastmodified, created = created)
+
+def updatescene(layer, sceneidindex, sceneID, scene, footprints):
+    # This updates the geometry and/ or modification date of an existing catalog feature, fetched directly by its FID
+    feature = landsatcatalog.getscenefeature(layer, sceneidindex, sceneID)
+    if not feature:
+        print('Error: SceneID {} could not be found in the geopackage layer, skipping update.'.format(sceneID))
+        ieo.logerror(sceneID, 'Feature missing from catalog layer during update.', errorfile = errorfile)
+        return
+    if scene.updategeom:
+        if sceneID in footprints:
+            print('Updating geometry for SceneID {}.'.format(sceneID))
+            feature.SetGeometry(footprints[sceneID])
+        else:
+            print('Error: no valid footprint was returned for SceneID {}, geometry not updated.'.format(sceneID))
+            ieo.logerror(sceneID, 'Bad/ missing footprint in metadata.', errorfile = errorfile)
+        
+    if scene.updatemodifiedDate:
+        print('Updating modification date for SceneID {}.'.format(sceneID))
+        feature.SetField('dateUpdated', fieldcodec.getvalue(scene, 'modifiedDate'))
+    layer.SetFeature(feature)
+    feature.Destroy()
+
+def setthumbnails(thumbnaillist, errors):
+    # This records thumbnails completed by the thumbnail pipeline on their catalog features, in one transaction, and logs any errors
+    global errorsfound
+    for sceneID, error in errors:
+        print('Error with thumbnail for SceneID {}, adding to error list: {}'.format(sceneID, error))
+        ieo.logerror(sceneID, error, errorfile = errorfile)
+        errorsfound = True
+    if len(thumbnaillist) == 0:
+        return
+    for thumblayer, thumbindex in [[layer, sceneidindex]] + [[aoi.layer, aoi.sceneidindex] for aoi in aois]:
+        thumblayer.StartTransaction()
+        for sceneID, jpg in thumbnaillist:
+            feature = landsatcatalog.getscenefeature(thumblayer, thumbindex, sceneID)
+            if feature:
+                feature.SetField('Thumbnail_filename', jpg)
+                thumblayer.SetFeature(feature)
+                feature.Destroy()
+        thumblayer.CommitTransaction()
+
+def newfeature(codec, layerDefinition, sceneID, scene, poly):
+    # This creates the catalog feature for a new scene, with its fields set through codec, which must be bound to layerDefinition
+    feature = ogr.Feature(layerDefinition)
+    # Add field attributes
+    feature.SetField('sceneID', sceneID)
+    for key, value in codec.items(scene):
+        if value:
+            try:
+                codec.setfield(feature, key, value)
+            except Exception as e:
+                if args.verbose:
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    print(exc_type, fname, exc_tb.tb_lineno)
+                    print('Error with SceneID {}, fieldname = {}, value = {}: {}'.format(sceneID, codec.get(key)[0], value, e))
+                ieo.logerror(key, e, errorfile = errorfile)
+    if scene.tiles: # local tiles found by findlocalfiles()
+        for key, value in scene.tiles.items():
+            if layerDefinition.GetFieldIndex(key) >= 0:
+                feature.SetField(key, value)
+    if poly is not None:
+        feature.SetGeometry(poly)
+    return feature
+
+def writescenes(scenedict):
+    # This adds the new scenes in scenedict, a dict of sceneID: SceneRecord, to the geopackage layer and to any --aoi layers whose
+    # Path/Rows include them, and updates existing ones, committing all of them before it returns. New scenes without footprint
+    # coordinates are not added. Returns the number of new scenes written, each counted once however many layers it was added to.
+    # The features written to each layer are counted separately in the features_written metric, labelled by layer.
+    global filenum, errorsfound
+    span = metrics.span('write', scenes = len(scenedict)).start()
+    updates = []
+    added = 0
+    written = dict((name, 0) for name in [layername] + [aoi.name for aoi in aois])
+    # Footprints for the whole batch are reprojected to the local projection together
+    footprints = landsatcatalog.buildfootprints(dict((sceneID, scene.coords) for sceneID, scene in scenedict.items() if scene.coords is not None), transform, target)
+    for sceneID, scene in scenedict.items():
+        print('Processing {}, scene number {}.'.format(sceneID, filenum))
+        if not (scene.updategeom or scene.updatemodifiedDate) and scene.coords is not None:
+            incatalog = sceneID[3:9] in catalogpathrowstrs and not sceneID in sceneidindex
+            targets = [aoi for aoi in aois if aoi.needs(sceneID)]
+            if not (incatalog or len(targets) > 0):
+                filenum += 1
+                continue
+            scene = findlocalfiles(sceneID, fielddict, scene)
+            # if scenedict[sceneID]['browseUrl'].endswith('.jpg'):
+            dlurl = fieldcodec.getvalue(scene, 'browseUrl')
+                # thumbnails.append(scenedict[sceneID]['browseUrl'])
+            poly = footprints.get(sceneID)
+            if poly is None:
+                print('Error: no valid footprint was returned for SceneID {}.'.format(sceneID))
+                ieo.logerror(sceneID, 'Bad/ missing footprint in metadata.', errorfile = errorfile)
+            if incatalog:
+                print('\nAdding {} to geopackage layer.'.format(sceneID))
+                writer.add(newfeature(fieldcodec, layerDefinition, sceneID, scene, poly))
+                written[layername] += 1
+            for aoi in targets:
+                print('Adding {} to geopackage layer {}.'.format(sceneID, aoi.name))
+                aoi.writer.add(newfeature(aoi.fieldcodec, aoi.layer.GetLayerDefn(), sceneID, scene, poly))
+                written[aoi.name] += 1
+            added += 1
+            if thumbs and poly is not None and dlurl and dlurl.lower() != 'null':
+                # print(dlurl)#os.path.basename(dlurl)
+                jpg = os.path.join(jpgdir, '{}.jpg'.format(fieldcodec.getvalue(scene, 'Landsat Product Identifier')))
+                thumbs.submit(sceneID, dlurl, jpg, poly) # Thumbnail_filename is set once the download is complete
+        elif scene.updategeom or scene.updatemodifiedDate:
+            updates.append(sceneID) # existing features are updated together once the batch's new scenes have been added
+        else:
+            print('Error: no footprint was returned for new SceneID {}, it has not been added.'.format(sceneID))
+            ieo.logerror(sceneID, 'Missing footprint in metadata, not added.', errorfile = errorfile)
+            errorsfound = True
+        filenum += 1
+    writer.flush()
+    for aoi in aois:
+        aoi.writer.flush()
+    if thumbs:
+        setthumbnails(*thumbs.completed())
+    if len(updates) > 0:
+        print('Updating {} existing features in geopackage layer.'.format(len(updates)))
+        layer.StartTransaction()
+        for sceneID in updates:
+            updatescene(layer, sceneidindex, sceneID, scenedict[sceneID], footprints)
+        layer.CommitTransaction()
+    for name in written.keys():
+        metrics.count('features_written', written[name], layer = name)
+    metrics.count('features_updated', len(updates))
+    span.stop()
+    return added
+
+def rundaemon(state):
+    # This polls the USGS every args.pollinterval minutes for scenes acquired since args.lookback days before the end date of the last
+    # completed sync, reusing the session, apiKey, open geopackage layer, sceneID and library indexes, and thumbnail pipeline of this
+    # run, so that each poll costs only a search per collection and metadata queries for the new scenes. Existing features were
+    # validated and repaired at startup, and features written since are already indexed. The search responses are not read from
+    # the response cache, so that each poll sees the current archive. A failed poll is logged and retried at the next interval.
+    # Stops after the current poll on SIGINT or SIGTERM, and returns the number of scenes written.
+    stopping = threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda signum, frame: stopping.set())
+    if cache:
+        cache.read = False
+    numscenes = 0
+    polls = 0
+    print('Polling for new scenes every {} minutes, stop with SIGINT or SIGTERM.'.format(args.pollinterval))
+    while not stopping.wait(args.pollinterval * 60):
+        polls += 1
+        cursor = state.lastenddate() or args.enddate
+        args.enddate = datetime.datetime.today().strftime('%Y-%m-%d')
+        startdate = (datetime.datetime.strptime(cursor, '%Y-%m-%d') - datetime.timedelta(days = args.lookback)).strftime('%Y-%m-%d')
+        print('Poll {}: searching for scenes from {} through {}.'.format(polls, startdate, args.enddate))
+        state.startrun(startdate, args.enddate)
+        try:
+            with metrics.span('poll', startdate = startdate, enddate = args.enddate) as span:
+                library.expire() # pick up tiles imported since the last poll
+                for fieldname in fielddict:
+                    library.refresh(fieldname, fielddict[fieldname]['dirname'])
+                found = scenesearch(sceneidindex, [], [], state)
+                if thumbs:
+                    setthumbnails(*thumbs.completed())
+                span.set(scenes = found)
+            if not state.finishrun():
+                print('Poll {} was incomplete, its failed windows will be searched again by the next poll.'.format(polls))
+        except Exception as e:
+            print('ERROR: poll {} failed, it will be retried in {} minutes: {}'.format(polls, args.pollinterval, e))
+            ieo.logerror('Poll {}'.format(polls), e, errorfile = errorfile)
+            metrics.count('polls', result = 'failed')
+            metrics.write()
+            continue
+        numscenes += found
+        print('Poll {} complete, {} scenes added or updated.'.format(polls, found))
+        metrics.count('polls', result = 'complete')
+        metrics.count('scenes_polled', found)
+        metrics.write()
+    print('Stopping after {} polls.'.format(polls))
+    return numscenes
+
+def bootstrap(filename):
+    # This adds the scenes in a USGS bulk metadata file to the geopackage layer in a single pass, without any USGS requests. Rows are
+    # streamed from the file, and only those within pathrowstrs, missing from a catalog layer, and whose footprints intersect the MBR
+    # are converted to SceneRecords and written, args.writebatch at a time. Rows without a valid footprint are skipped, and left for
+    # the sync to fetch from the USGS API. Returns the number of scenes written and the latest acquisition date found, or None.
+    print('Adding scenes from bulk metadata file: {}'.format(filename))
+    reader = landsatcatalog.BulkReader(filename, fieldcodec)
+    if not reader.corners:
+        print('Warning: no corner coordinates were found in {}, its scenes will be skipped and fetched from the USGS API by the sync.'.format(filename))
+    lowerlat, lowerlon, upperlat, upperlon = [float(x) for x in args.MBR]
+    scenedict = {}
+    numscenes = 0
+    outside = 0
+    nofootprint = 0
+    latest = None
+    keep = lambda sceneID: sceneID[3:9] in pathrowstrs and not catalogued(sceneID, sceneidindex) and not sceneID in scenedict
+    try:
+        for scene in reader.records(keep):
+            if not scene.coords:
+                nofootprint += 1
+                continue
+            lons = [point[0] for point in scene.coords]
+            lats = [point[1] for point in scene.coords]
+            if max(lons) < lowerlon or min(lons) > upperlon or max(lats) < lowerlat or min(lats) > upperlat:
+                outside += 1
+                continue
+            acquisitiondate = fieldcodec.getvalue(scene, 'Acquisition Date')
+            if acquisitiondate and (not latest or acquisitiondate > latest):
+                latest = acquisitiondate
+            if fieldcodec.getvalue(scene, 'modifiedDate') is None:
+                fieldcodec.setvalue(scene, 'modifiedDate', acquisitiondate)
+            if fieldcodec.getvalue(scene, 'Spacecraft Identifier') is None:
+                fieldcodec.setvalue(scene, 'Spacecraft Identifier', 'LANDSAT_{}'.format(scene.sceneID[2:3]))
+            scenedict[scene.sceneID] = scene
+            if len(scenedict) >= max(args.writebatch, 1):
+                with profiler.phase('write'):
+                    numscenes += writescenes(scenedict)
+                scenedict = {}
+        if len(scenedict) > 0:
+            with profiler.phase('write'):
+                numscenes += writescenes(scenedict)
+    finally:
+        reader.close()
+    print('{} rows read from {}, {} scenes written, {} scenes outside the MBR, {} scenes without a valid footprint skipped, {} values could not be converted.'.format(reader.rows, filename, numscenes, outside, nofootprint, reader.errors))
+    metrics.count('bulk_rows', reader.rows)
+    metrics.count('bulk_nofootprint', nofootprint)
+    metrics.count('bulk_errors', reader.errors)
+    return numscenes, latest
 
 def reporthook(blocknum, blocksize, totalsize):
     # This makes a progress bar. I did not originally write it, nor do I remember from where I found the code.
@@ -573,7 +1223,15 @@ if args.MBR: # define MBR for scene queries
         print('Error: Improper number of coordinates for --MBR set (must be four). Either remove this option (will use default values) or fix. Exiting.')
         sys.exit()
 else:
-    args.MBR = getMBR()
+    if wrs2:
+        args.MBR = wrs2.mbr(pathrowstrs) # from the scene centres of all Path/Rows, as returned by grid2ll, or None if any are missing
+    if args.MBR:
+        print('MBR from WRS-2 index: {}'.format(', '.join('{:0.4f}'.format(x) for x in args.MBR)))
+    else:
+        args.MBR = getMBR()
+
+# Digests are only reused by runs searching the same MBR and Path/Rows, including those of any --aoi layers
+digestscope = syncstate.digestscope(args.MBR, pathrowstrs)
 
 # This section borrowed from https://pcjericks.github.io/py-gdalogr-cookbook/projection.html
 # Lat/ Lon WGS-84 to local projection transformation
@@ -702,6 +1360,8 @@ for element in fieldvaluelist:
     fnames.append(element[1])
     queryfieldnames.append(element[2])
 
+fieldcodec = landsatcatalog.FieldCodec(fieldvaluelist) # USGS field name: (geopackage field name, OGR type, converter)
+
 if not os.access(ieo.catgpkg, os.F_OK):
     # Create geopackage
     data_source = driver.CreateDataSource(ieo.catgpkg)
@@ -714,23 +1374,7 @@ if layers > 0:
         if layername == data_source.GetLayer(i).GetName():
             layerpresent = True
 if not layerpresent:
-    layer = data_source.CreateLayer(layername, target, ogr.wkbPolygon)
-    for element in fieldvaluelist:
-        field_name = ogr.FieldDefn(element[1], element[3])
-        if element[4] > 0:
-            field_name.SetWidth(element[4])
-        layer.CreateField(field_name)
-
-    layer.CreateField(ogr.FieldDefn('MaskType', ogr.OFTString)) # 'Fmask' or 'Pixel_QA'
-    layer.CreateField(ogr.FieldDefn('Thumbnail_filename', ogr.OFTString))
-    layer.CreateField(ogr.FieldDefn('Surface_reflectance_tiles', ogr.OFTString))
-    layer.CreateField(ogr.FieldDefn('Brightness_temperature_tiles', ogr.OFTString))
-    layer.CreateField(ogr.FieldDefn('Fmask_tiles', ogr.OFTString))
-    layer.CreateField(ogr.FieldDefn('Pixel_QA_tiles', ogr.OFTString))
-    layer.CreateField(ogr.FieldDefn('NDVI_tiles', ogr.OFTString))
-    layer.CreateField(ogr.FieldDefn('EVI_tiles', ogr.OFTString))
-    layer.CreateField(ogr.FieldDefn('Tile_filename_base', ogr.OFTString))
-    
+    layer = createlayer(data_source, layername)
     args.migrate = True 
 
 if args.migrate and os.path.isfile(shapefilepath):
@@ -740,106 +1384,64 @@ if args.migrate and os.path.isfile(shapefilepath):
 #else:
 lastupdate = None
 lastmodifiedDate = None
-shpfnames = []
 updatemissing = []
 badgeom = []
 reimport = []
 # Open existing shapefile with write access
 data_source = driver.Open(ieo.catgpkg, 1)
 layer = data_source.GetLayer(shapefile)
+addmissingfields(layer)
 layerDefinition = layer.GetLayerDefn()
-# Get list of field names
-for i in range(layerDefinition.GetFieldCount()):
-    shpfnames.append(layerDefinition.GetFieldDefn(i).GetName())
-# Find missing fields and create them
-for fname in fnames:
-    if not fname in shpfnames:
-        i = fnames.index(fname)
-        field_name = ogr.FieldDefn(fnames[i], fieldvaluelist[i][3])
-        if fieldvaluelist[i][4] > 0:
-            field_name.SetWidth(fieldvaluelist[i][4])
-        layer.CreateField(field_name)
+fieldcodec.bind(layerDefinition)
 
-# Iterate through features and fetch sceneID values
+# Validate existing features with SQL run on the geopackage, rather than by reading each feature
 errors = {'total' : 0,
           'metadata' : 0,
           'date' : 0,
           'geometry' : 0}
 
-featureCount = layer.GetFeatureCount()
-if featureCount > 0:
+span = metrics.span('validate').start()
+validation = landsatcatalog.validatecatalog(data_source, layer, layername, ['TM', 'ETM', 'OLI', 'TIRS', 'OLI_TIRS'])
+if len(validation['invalid']) > 0:
     layer.StartTransaction()
-    layer.GetNextFeature()
-    while feature:
-        
-        datetuple = None
+    for fid, sceneID in validation['invalid']:
+        if args.verbose:
+            print('ERROR: missing metadata for SceneID {}. Feature will be deleted from shapefile and reimported.'.format(sceneID))
+        ieo.logerror(sceneID, 'Feature missing metadata, deleted, reimportation required.')
         try:
-            sceneID = feature.GetField("sceneID")
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            if args.verbose:
-                print(exc_type, fname, exc_tb.tb_lineno)
-                print('ERROR: bad feature, deleting.')
-            layer.DeleteFeature(feature.GetFID())
-            ieo.logerror('{}/{}'.format(ieo.catgpkg, shapefile), '{} {} {}'.format(exc_type, fname, exc_tb.tb_lineno), errorfile = errorfile)
-            feature = layer.GetNextFeature()
-            continue
-        scenelist.append(sceneID)
-        if not feature.GetField('SensorID') in ['TM', 'ETM', 'OLI', 'TIRS', 'OLI_TIRS']:
-            if args.verbose:
-                print('ERROR: missing metadata for SceneID {}. Feature will be deleted from shapefile and reimported.'.format(sceneID))
-            ieo.logerror(sceneID, 'Feature missing metadata, deleted, reimportation required.')
             reimport.append(datetime.datetime.strptime(sceneID[9:16], '%Y%j'))
-            layer.DeleteFeature(feature.GetFID())
-            errors['total'] += 1
-            errors['metadata'] += 1
-            
-        else:    
-            try:
-                mdate = feature.GetField('dateUpdated')
-                datetuple = datetime.datetime.strptime(mdate, '%Y/%m/%d')
-                if not lastupdate or datetuple > lastupdate:
-                    lastupdate = datetuple
-                    lastmodifiedDate = mdate
-            except Exception as e:
-                if args.verbose:
-                    exc_type, exc_obj, exc_tb = sys.exc_info()
-                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                    print(exc_type, fname, exc_tb.tb_lineno)
-                    print('ERROR: modifiedDate information missing for SceneID {}, adding to list.'.format(sceneID))
-                ieo.logerror(sceneID, 'Modification date missing.', errorfile = errorfile)
-                updatemissing.append(sceneID)
-                errors['total'] += 1
-                errors['date'] += 1
-            
-            
-            try:
-                geom = feature.GetGeometryRef()
-                env = geom.GetEnvelope()
-                if env[0] == env[1] or env[2] == env[3]:
-                    if args.verbose:
-                        print('Bad geometry identified for SceneID {}, adding to the list.'.format(sceneID))
-                    ieo.logerror(sceneID, 'Bad/ missing geometry.')
-                    badgeom.append(sceneID)
-            except Exception as e:
-                if args.verbose:
-                    exc_type, exc_obj, exc_tb = sys.exc_info()
-                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                    print(exc_type, fname, exc_tb.tb_lineno)
-                    print('Bad geometry identified for SceneID {}, adding to the list.'.format(sceneID), errorfile = errorfile)
-                ieo.logerror(sceneID, 'Bad/ missing geometry.')
-                badgeom.append(sceneID)
-                errors['total'] += 1
-                errors['geometry'] += 1
-        if errors['total'] > 0 and (errors['total'] % 100 == 0):
-            print('{} errors found in layer of types: metadata: {}, missing modification date: {}, missing/ bad geometry: {}.'.format(errors['total'], errors['metadata'], errors['date'], errors['geometry']))
-        feature = layer.GetNextFeature()
+        except (TypeError, ValueError):
+            ieo.logerror('{}/{}'.format(ieo.catgpkg, shapefile), 'Bad feature {} deleted.'.format(fid), errorfile = errorfile)
+        layer.DeleteFeature(fid)
+        errors['total'] += 1
+        errors['metadata'] += 1
     layer.CommitTransaction()
+if validation['lastmodified']:
+    lastmodifiedDate = validation['lastmodified']
+    lastupdate = datetime.datetime.strptime(lastmodifiedDate, '%Y-%m-%d')
+for sceneID in validation['updatemissing']:
+    if args.verbose:
+        print('ERROR: modifiedDate information missing for SceneID {}, adding to list.'.format(sceneID))
+    ieo.logerror(sceneID, 'Modification date missing.', errorfile = errorfile)
+    updatemissing.append(sceneID)
+    errors['total'] += 1
+    errors['date'] += 1
+for sceneID in validation['badgeom']:
+    if args.verbose:
+        print('Bad geometry identified for SceneID {}, adding to the list.'.format(sceneID))
+    ieo.logerror(sceneID, 'Bad/ missing geometry.')
+    badgeom.append(sceneID)
+    errors['total'] += 1
+    errors['geometry'] += 1
+if errors['total'] > 0:
+    print('{} errors found in layer of types: metadata: {}, missing modification date: {}, missing/ bad geometry: {}.'.format(errors['total'], errors['metadata'], errors['date'], errors['geometry']))
+for key in ['metadata', 'date', 'geometry']:
+    metrics.count('catalog_errors', errors[key], type = key)
+span.stop()
 
 if len(reimport) > 0 and lastupdate:
     if min(reimport) < lastupdate:
-        lastmodifiedDate = datetime.datetime.strftime('%Y-%m-%d', min(reimport))
+        lastmodifiedDate = min(reimport).strftime('%Y-%m-%d')
 
 fielddict = {'Brightness_temperature_tiles' : {'ext' : '_BT_{}.dat'.format(ieo.projacronym), 'dirname' : ieo.btdir},
             'CFmask_tiles' : {'ext' : '_cfmask.dat', 'dirname' : ieo.fmaskdir},
@@ -847,135 +1449,115 @@ fielddict = {'Brightness_temperature_tiles' : {'ext' : '_BT_{}.dat'.format(ieo.p
             'NDVI_tiles' : {'ext' : '_NDVI.dat', 'dirname' : ieo.ndvidir},
             'EVI_tiles' : {'ext' : '_EVI.dat', 'dirname' : ieo.evidir}}
 
+# Local tiles are looked up in the shared library index, which is first brought up to date for any new or changed headers
+library = libraryindex.LibraryIndex(args.libraryindex, ieo.readenvihdr, verbose = args.verbose)
+with metrics.span('libraryindex'):
+    for fieldname in fielddict:
+        metrics.count('headers_read', library.refresh(fieldname, fielddict[fieldname]['dirname']), product = fieldname)
+
 thumbnails = []
 scenes = []
 filenum = 1
 
-# get apiKey for USGS EarthExplorer query
-apiKey = getapiKey()
+# Index sceneIDs so that existing features can be fetched directly by FID rather than by scanning the layer
+landsatcatalog.createsceneidindex(data_source, layername)
+sceneidindex = landsatcatalog.loadsceneidindex(data_source, layer, layername)
+# Thumbnails are downloaded and georeferenced in the background while features are written
+thumbs = None
+if args.thumbnails:
+    if not os.path.isdir(jpgdir):
+        os.makedirs(jpgdir)
+    thumbs = thumbnails.ThumbnailPipeline(session, target.ExportToWkt(), workers = args.thumbworkers, verbose = args.verbose)
+writer = landsatcatalog.CatalogWriter(data_source, layer, layername, batchsize = args.writebatch, arrow = args.arrow, sceneidindex = sceneidindex, verbose = args.verbose)
 
-# run query
+# --aoi layers are opened or created, and synced from the earliest last modification date of all layers
+aois = []
+for name, aoipathrowstrs, gpkg in aoilist:
+    aois.append(openaoi(name, aoipathrowstrs, gpkg))
+if len(aois) > 0:
+    if lastmodifiedDate and all(aoi.lastmodified for aoi in aois):
+        lastmodifiedDate = min([lastmodifiedDate] + [aoi.lastmodified for aoi in aois])
+    else:
+        lastmodifiedDate = None
 
-scenedict = scenesearch(apiKey, scenelist, updatemissing, badgeom, lastmodifiedDate)
-sceneIDs = scenedict.keys()
-print('Total scenes to be added or updated to geopackage layer: {}'.format(len(sceneIDs)))
+# Scenes from bulk metadata files are written before the sync, which then only fetches scenes that are not yet in the catalog
+numscenes = 0
+if args.bootstrap:
+    latest = None
+    with metrics.span('bootstrap', files = len(args.bootstrap)) as span:
+        for filename in args.bootstrap:
+            try:
+                found, filelatest = bootstrap(filename)
+            except (OSError, ValueError) as e:
+                print('ERROR: bulk metadata file {} could not be read: {}'.format(filename, e))
+                ieo.logerror(filename, e, errorfile = errorfile)
+                errorsfound = True
+                continue
+            numscenes += found
+            if filelatest and (not latest or filelatest > latest):
+                latest = filelatest
+        span.set(scenes = numscenes)
+    metrics.count('scenes_bootstrapped', numscenes)
+    if latest and not lastmodifiedDate: # a new catalog is synced from shortly before the last acquisition in the bulk files
+        lastmodifiedDate = (latest - datetime.timedelta(days = args.lookback)).strftime('%Y-%m-%d')
+        print('Catalog bootstrapped through {}, syncing from {}.'.format(latest.strftime('%Y-%m-%d'), lastmodifiedDate))
 
-if len(sceneIDs) > 0:
-    for sceneID in sceneIDs:
-        print('Processing {}, scene number {} of {}.'.format(sceneID, filenum, len(sceneIDs)))
-        if not (scenedict[sceneID]['updategeom'] or scenedict[sceneID]['updatemodifiedDate']) and ('coords' in scenedict[sceneID].keys()):
-            scenedict = findlocalfiles(sceneID, fielddict, scenedict)
-            # if scenedict[sceneID]['browseUrl'].endswith('.jpg'):
-            dlurl = scenedict[sceneID]['browseUrl']
-                # thumbnails.append(scenedict[sceneID]['browseUrl'])
-    
-            print('\nAdding {} to geopackage layer.'.format(sceneID))
-            scenelist.append(sceneID)
-            # create the feature
-            feature = ogr.Feature(layer.GetLayerDefn())
-            # Add field attributes
-            feature.SetField('sceneID', sceneID)
-            for key in scenedict[sceneID].keys():
-                if (scenedict[sceneID][key]) and key in queryfieldnames:
-                    try:
-                        if fieldvaluelist[queryfieldnames.index(key)][3] == ogr.OFTDate:
-                            if isinstance(scenedict[sceneID][key], str):
-                                if '/' in scenedict[sceneID][key]:
-                                    scenedict[sceneID][key] = scenedict[sceneID][key].replace('/', '-')
-                                scenedict[sceneID][key] = datetime.datetime.strptime(scenedict[sceneID][key], '%Y-%m-%d')
-                            feature.SetField(fnames[queryfieldnames.index(key)], scenedict[sceneID][key].year, scenedict[sceneID][key].month, scenedict[sceneID][key].day, scenedict[sceneID][key].hour, scenedict[sceneID][key].minute, scenedict[sceneID][key].second, 100)
-                        else:
-                            feature.SetField(fnames[queryfieldnames.index(key)], scenedict[sceneID][key])
-                    except Exception as e:
-                        if args.verbose:
-                            exc_type, exc_obj, exc_tb = sys.exc_info()
-                            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                            print(exc_type, fname, exc_tb.tb_lineno)
-                            print('Error with SceneID {}, fieldname = {}, value = {}: {}'.format(sceneID, fnames[queryfieldnames.index(key)], scenedict[sceneID][key], e))
-                        ieo.logerror(key, e, errorfile = errorfile)
-            
-            coords = scenedict[sceneID]['coords']
-            print(coords)
-            # Create ring
-            ring = ogr.Geometry(ogr.wkbLinearRing)
-            for coord in coords:
-                ring.AddPoint(coord[1], coord[0])
-            if not coord[0] == coords[0][0] and coord[1] == coords[0][1]:
-                ring.AddPoint(coords[0][1], coords[0][0])
-            # Create polygon
-            
-            poly = ogr.Geometry(ogr.wkbPolygon)
-    
-            poly.AddGeometry(ring)
-            poly.Transform(transform)   # Convert to local projection
-            feature.SetGeometry(poly)
-            basename = '{}.jpg'.format(scenedict[sceneID]['Landsat Product Identifier'])
-            # print(dlurl)#os.path.basename(dlurl)
-            jpg = os.path.join(jpgdir, basename)
-            if not os.access(jpg, os.F_OK) and args.thumbnails:
-                try:
-                    response = dlthumb(dlurl, jpg)
-                    if response == 'Success!':
-                        geom = feature.GetGeometryRef()
-                        print('Creating world file.')
-                        makeworldfile(jpg, poly)
-                        print('Migrating world and projection files to new directory.')
-                        jpw = jpg.replace('.jpg', '.jpw')
-                        prj = jpg.replace('.jpg', '.prj')
-                    else:
-                        print('Error with sceneID or filename, adding to error list.')
-                        ieo.logerror(sceneID, response, errorfile = errorfile)
-                        errorsfound = True
-                    if os.access(jpg, os.F_OK):
-                        feature.SetField('Thumbnail_filename', jpg)
+# Progress is checkpointed after every metadata batch and search window, so that an interrupted sync can be continued with --resume
+state = syncstate.SyncState(args.checkpoint)
+if args.resume and state.resumerun():
+    print('Resuming catalog sync from {} through {}, {} search windows already completed.'.format(state.startdate, state.enddate, len(state.donewindows)))
+    args.enddate = state.enddate
+else:
+    if args.resume:
+        print('No interrupted catalog sync was found to resume, starting a new one.')
+    if lastmodifiedDate:
+        startdate = lastmodifiedDate
+    else:
+        startdate = args.startdate
+    state.startrun(startdate, args.enddate)
+# Windows including features deleted by validation, or all windows if a layer is new, must be searched again
+if not layerpresent or any(aoi.created for aoi in aois):
+    state.cleardigests()
+for date in sorted(set(reimport)):
+    state.cleardigests(date.strftime('%Y-%m-%d'))
+
+# The apiKey for USGS EarthExplorer queries is requested when first needed, and again before it expires
+apikey = usgsapi.APIKey(getapiKey, lifetime = args.keylifetime * 60)
+
+# run query, committing new and updated features to the geopackage layer as each metadata batch is parsed
+
+repairs = list(dict.fromkeys(updatemissing + badgeom))
+if len(repairs) > 0:
+    with metrics.span('repair', scenes = len(repairs)):
+        numscenes += repairscenes(repairs, updatemissing, badgeom, state)
+with metrics.span('sync'):
+    numscenes += scenesearch(sceneidindex, updatemissing, badgeom, state)
+if not state.finishrun():
+    print('Some search windows could not be completed, run again with --resume to fetch their remaining scenes.')
+if args.daemon:
+    writer.flush()
+    for aoi in aois:
+        aoi.writer.flush()
+    numscenes += rundaemon(state)
+with profiler.phase('write'):
+    writer.close()
+    for aoi in aois:
+        aoi.close()
+if thumbs:
+    with metrics.span('thumbnails'), profiler.phase('thumbnails'):
+        setthumbnails(*thumbs.close())
+    for key in thumbs.counts.keys():
+        metrics.count('thumbnails', thumbs.counts[key], result = key)
+state.close()
+if cache:
+    cache.report()
+library.close()
+print('Total scenes added or updated in geopackage layer: {}'.format(numscenes))
+metrics.count('scenes_added_or_updated', numscenes)
 
-                except Exception as e:
-                    exc_type, exc_obj, exc_tb = sys.exc_info()
-                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                    print(exc_type, fname, exc_tb.tb_lineno)
-                    ieo.logerror(os.path.basename(jpg), e, errorfile = errorfile)
-                    errorsfound = True
-            layer.CreateFeature(feature)
-            feature.Destroy()
-        else:
-            layer.ResetReading()
-            for feature in layer:
-                if feature.GetField('sceneID') == sceneID:
-                    if scenedict[sceneID]['updategeom']: 
-                        print('Updating geometry for SceneID {}.'.format(sceneID))
-                        coords = scenedict[sceneID]['coords']
-                        # Create ring
-                        ring = ogr.Geometry(ogr.wkbLinearRing)
-                        for coord in coords:
-                            ring.AddPoint(coord[0], coord[1])
-                        if not coord[0] == coords[0][0] and coord[1] == coords[0][1]:
-                            ring.AddPoint(coord[0][0], coord[0][1])
-                        # Create polygon
-                        
-                        poly = ogr.Geometry(ogr.wkbPolygon)
-                
-                        poly.AddGeometry(ring)
-                        poly.Transform(transform)   # Convert to local projection
-                        feature.SetGeometry(poly)
-                        
-                    if scenedict[sceneID]['updatemodifiedDate']:
-#                        try:
-                        print('Updating modification date for SceneID {}.'.format(sceneID))
-#                        if  isinstance(scenedict[sceneID]['modifiedDate'], str):
-#                            scenedict[sceneID]['modifiedDate'] = datetime.datetime.strptime(scenedict[sceneID]['modifiedDate'], '%Y-%m-%d')
-                        feature.SetField('dateUpdated', scenedict[sceneID]['modifiedDate'])
-#                        except Exception as e:
-#                            exc_type, exc_obj, exc_tb = sys.exc_info()
-#                            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-#                            print(exc_type, fname, exc_tb.tb_lineno)
-#                            print('ERROR: modifiedDate information ("{}") not set for SceneID {}, adding to list.'.format(scenedict[sceneID]['modifiedDate'], sceneID))
-#                            ieo.logerror(sceneID, 'Error setting "Updated" field.')
-                    layer.SetFeature(feature)
-                    feature.Destroy()
-#        print('\n')
-        filenum += 1
-    
 data_source = None
+metrics.finish()
+profiler.close()
 
 print('Processing complete.')
 
@@ -9,8 +9,9 @@
 # Changes:
 # 23 May 2018: XML functionality deprecated in favor of JSON queries, as the former is no longer available or efficient
 # 25 March 2019: This script will now read configuration data from ieo.ini
+# 16 October 2026: Metadata queries that still fail after the session's retries are retried once more, and logged if they fail again
 
-import os, sys, urllib.error, datetime, shutil, glob, argparse, json, getpass, requests, math #, ieo
+import os, sys, urllib.error, datetime, shutil, glob, argparse, json, getpass, math, usgsapi, ieoprofile #, ieo
 from osgeo import ogr, osr
 import xml.etree.ElementTree as ET
 from PIL import Image
@@ -61,8 +62,15 @@ parser.add_argument('-b', '--baseURL', type = str, default = 'https://earthexplo
 parser.add_argument('--maxResults', type = int, default = 50000, help = 'Maximum number of results to return (1 - 50000, default = 50000).')
 parser.add_argument('--overwrite', type = bool, default = False, help = 'Overwrite existing files.')
 parser.add_argument('--thumbnails', type = bool, default = True, help = 'Download thumbnails (default = True).')
+parser.add_argument('--retries', type = int, default = 5, help = 'Number of times a failed USGS request will be retried, with exponential backoff (default = 5).')
+parser.add_argument('--profile', type = str, nargs = '?', const = ieo.logdir, default = None, help = 'Profile this run per phase with cProfile and tracemalloc, writing the results to this directory (default = IEO log directory).')
 args = parser.parse_args()
 
+profiler = ieoprofile.Profiler('updateshp', args.profile) # does nothing unless --profile is set
+
+# All requests to the USGS/EROS servers share this session, so connections are reused and failed requests are retried
+session = usgsapi.USGSSession(retries = args.retries)
+
 if not (args.username and args.password):
     if not args.username:
         args.username = input('USGS/ERS username: ')
@@ -176,9 +184,7 @@ def getapiKey():
     # This function gets the apiKey used for all queries to the USGS/EROS servers
     URL = '{}{}/login'.format(args.baseURL, args.version)
     print('Logging in to: {}'.format(URL))
-    data = json.dumps({'username': args.username, 'password': args.password, 'catalog_ID': args.catalogID})
-    response = requests.post(URL, data = {'jsonRequest':data}) #
-    json_data = json.loads(response.text)
+    json_data = session.postjson(URL, {'username': args.username, 'password': args.password, 'catalog_ID': args.catalogID})
     apiKey = json_data['data']
     return apiKey
 
@@ -192,14 +198,68 @@ def getMBR():
         print('Requesting coordinates for WRS-2 Path {} Row {}.'.format(pr[0], pr[1]))
         jsonRequest = json.dumps({"gridType" : "WRS2", "responseShape" : "point", "path" : str(pr[0]), "row" : str(pr[1])}).replace(' ','')
         requestURL = '{}?jsonRequest={}'.format(URL, jsonRequest)
-        response = requests.post(requestURL) # URL, data = {'jsonRequest': jsonRequest}
+        response = session.post(requestURL) # URL, data = {'jsonRequest': jsonRequest}
         json_data = json.loads(response.text)
         Xcoords.append(float(json_data["data"]["coordinates"][0]["longitude"]))
         Ycoords.append(float(json_data["data"]["coordinates"][0]["latitude"]))
     return [min(Ycoords), min(Xcoords), max(Ycoords), max(Xcoords)]
 
+def parsemetadata(querydict, scenedict, js):
+    # This parses a metadata query response into scenedict
+    if len(querydict['data']) > 0:
+        for item in querydict['data']:
+            if len(item['metadataFields']) > 0:
+                for subitem in item['metadataFields']:
+                    fieldname = subitem['fieldName'].rstrip().lstrip().replace('L-1', 'L1')
+                    if fieldname == 'Landsat Scene Identifier':
+                        sceneID = subitem['value']
+                    elif fieldname in queryfieldnames and not fieldname in scenedict[sceneID].keys():
+                        value = subitem['value']
+                        if value:
+                            i = queryfieldnames.index(fieldname)
+                            if fieldvaluelist[i][3] == ogr.OFTDate or fieldname.endswith('Date'):
+                                if 'Time' in fieldname:
+                                    value = datetime.datetime.strptime(value[:-1], '%Y:%j:%H:%M:%S.%f')
+                                elif '/' in value:
+                                    value = datetime.datetime.strptime(value, '%Y/%m/%d')
+                                else:
+                                    value = datetime.datetime.strptime(value, '%Y-%m-%d')
+                            elif fieldvaluelist[i][3] == ogr.OFTReal:
+                                value = float(value)
+                            elif fieldvaluelist[i][3] == ogr.OFTInteger:
+                                try:
+                                    value = int(value)
+                                except:
+                                    print('Error: fieldname {} has a value of {}.'.format(fieldname, value))
+                                    sys.exit()
+                            elif fieldname == 'browseUrl':
+                                if value:
+                                    if value.lower() != 'null':
+                                        scenedict[sceneID]['browse'] = 'Y'
+                                    else:
+                                        scenedict[sceneID]['browse'] = 'N'
+                            elif fieldname == 'Data Type Level-1':
+                                j = value.rfind('_') + 1
+                                value = value[j:]
+                            scenedict[sceneID][fieldname] = value
+                    elif fieldname in polycoords:
+                        if 'Long' in fieldname:
+                            k = 1
+                        else:
+                            k = 0
+                        if fieldname.startswith('LL'): # Scene polygons start and end on lower left corner
+                            for l in [0, 4]:
+                                scenedict[sceneID]['coords'][js[fieldname[:2]] + l][k] = float(value)
+                        else:
+                            scenedict[sceneID]['coords'][js[fieldname[:2]]][k] = float(value)
+
+        if not 'Spacecraft Identifier' in scenedict[sceneID].keys():
+            scenedict[sceneID]['Spacecraft Identifier'] = 'LANDSAT_{}'.format(sceneID[2:3])
+    return scenedict
+
 def scenesearch(apiKey, scenelist):
     # This searches the USGS archive for scene metadata, and checks it against local metadata. New scenes will be queried for metadata.
+    global errorsfound
     RequestURL = '{}{}/search'.format(args.baseURL, args.version)
     QueryURL = '{}{}/metadata'.format(args.baseURL, args.version)
     datasetNames = ['LANDSAT_8_C1', 'LANDSAT_ETM_C1', 'LANDSAT_TM_C1']
@@ -207,7 +267,7 @@ def scenesearch(apiKey, scenelist):
     js = {'LL': 0, 'UL': 1, 'UR': 2, 'LR': 3}
     for datasetName in datasetNames:
         print('Querying collection: {}'.format(datasetName))
-        searchparams = json.dumps({"apiKey": apiKey,
+        searchparams = {"apiKey": apiKey,
                         "datasetName": datasetName,
                         "spatialFilter":{"filterType": "mbr",
                                          "lowerLeft":{"latitude": args.MBR[0],
@@ -219,9 +279,8 @@ def scenesearch(apiKey, scenelist):
                         "includeUnknownCloudCover":False,
                         "maxCloudCover": 100,
                         "maxResults": args.maxResults,
-                        "sortOrder": "ASC"})
-        response = requests.post(RequestURL, data = {'jsonRequest': searchparams})
-        json_data = json.loads(response.text)
+                        "sortOrder": "ASC"}
+        json_data = session.postjson(RequestURL, searchparams)
         querylist = []
         for i in range(len(json_data['data']['results'])):
             sceneID = json_data['data']['results'][i]['entityId']
@@ -243,6 +302,7 @@ def scenesearch(apiKey, scenelist):
             iterations = math.ceil(len(querylist) / 100) # break up queries into blocks of 100 or less scenes
             total = 0
             #iterations = 1 # temporary limitation
+            failed = []
             for iteration in range(iterations):
                 startval = iteration * 100
                 if iteration * 100 > len(querylist):
@@ -256,64 +316,32 @@ def scenesearch(apiKey, scenelist):
                 for sceneID in querylist[startval: endval]:
                     querystr += ',{}'.format(sceneID)
                 querystr = querystr[1:]
-                queryparams = json.dumps({"apiKey":apiKey,
+                queryparams = {"apiKey":apiKey,
                             "datasetName":datasetName,
-                            'entityIds': querystr})
-                query = requests.post(QueryURL, data = {'jsonRequest':queryparams})
-#                if endval == 99:
-#                    outfile = r'd:\data\ieo\firstquery.txt'
-#                    with open(outfile, 'w') as output:
-#                        output.write(query.text)
-                querydict = json.loads(query.text)
-                if len(querydict['data']) > 0:
-                    for item in querydict['data']:
-                        if len(item['metadataFields']) > 0:
-                            for subitem in item['metadataFields']:
-                                fieldname = subitem['fieldName'].rstrip().lstrip().replace('L-1', 'L1')
-                                if fieldname == 'Landsat Scene Identifier':
-                                    sceneID = subitem['value']
-                                elif fieldname in queryfieldnames and not fieldname in scenedict[sceneID].keys():
-                                    value = subitem['value']
-                                    if value:
-                                        i = queryfieldnames.index(fieldname)
-                                        if fieldvaluelist[i][3] == ogr.OFTDate or fieldname.endswith('Date'):
-                                            if 'Time' in fieldname:
-                                                value = datetime.datetime.strptime(value[:-1], '%Y:%j:%H:%M:%S.%f')
-                                            elif '/' in value:
-                                                value = datetime.datetime.strptime(value, '%Y/%m/%d')
-                                            else:
-                                                value = datetime.datetime.strptime(value, '%Y-%m-%d')
-                                        elif fieldvaluelist[i][3] == ogr.OFTReal:
-                                            value = float(value)
-                                        elif fieldvaluelist[i][3] == ogr.OFTInteger:
-                                            try:
-                                                value = int(value)
-                                            except:
-                                                print('Error: fieldname {} has a value of {}.'.format(fieldname, value))
-                                                sys.exit()
-                                        elif fieldname == 'browseUrl':
-                                            if value:
-                                                if value.lower() != 'null':
-                                                    scenedict[sceneID]['browse'] = 'Y'
-                                                else:
-                                                    scenedict[sceneID]['browse'] = 'N'
-                                        elif fieldname == 'Data Type Level-1':
-                                            j = value.rfind('_') + 1
-                                            value = value[j:]
-                                        scenedict[sceneID][fieldname] = value
-                                elif fieldname in polycoords:
-                                    if 'Long' in fieldname:
-                                        k = 1
-                                    else:
-                                        k = 0
-                                    if fieldname.startswith('LL'): # Scene polygons start and end on lower left corner
-                                        for l in [0, 4]:
-                                            scenedict[sceneID]['coords'][js[fieldname[:2]] + l][k] = float(value)
-                                    else:
-                                        scenedict[sceneID]['coords'][js[fieldname[:2]]][k] = float(value)
+                            'entityIds': querystr}
+                try:
+                    querydict = session.postjson(QueryURL, queryparams)
+                except Exception as e:
+                    print('ERROR: metadata query {}/{} for collection {} failed, it will be retried: {}'.format(iteration + 1, iterations, datasetName, e))
+                    failed.append([iteration, queryparams])
+                    continue
+                scenedict = parsemetadata(querydict, scenedict, js)
+
+            # Batches that failed even after the session's own retries get one more attempt once the rest of the collection is in, so they aren't lost
+            if len(failed) > 0:
+                print('Retrying {} failed metadata queries.'.format(len(failed)))
+            for iteration, queryparams in failed:
+                try:
+                    querydict = session.postjson(QueryURL, queryparams)
+                except Exception as e:
+                    print('ERROR: metadata query {}/{} for collection {} failed: {}'.format(iteration + 1, iterations, datasetName, e))
+                    ieo.logerror(QueryURL, 'Metadata query for {} scenes from {} failed: {}'.format(len(queryparams['entityIds'].split(',')), datasetName, e), errorfile = errorfile)
+                    errorsfound = True
+                    for sceneID in queryparams['entityIds'].split(','): # these are left out of the shapefile, so that the next run queries them again
+                        scenedict.pop(sceneID, None)
+                    continue
+                scenedict = parsemetadata(querydict, scenedict, js)
 
-                    if not 'Spacecraft Identifier' in scenedict[sceneID].keys():
-                        scenedict[sceneID]['Spacecraft Identifier'] = 'LANDSAT_{}'.format(sceneID[2:3])
     return scenedict
 
 def findlocalfiles(sceneID, fielddict, scenedict):
@@ -669,7 +697,8 @@ apiKey = getapiKey()
 
 # run query
 
-scenedict = scenesearch(apiKey, scenelist)
+with profiler.phase('search'):
+    scenedict = scenesearch(apiKey, scenelist)
 sceneIDs = scenedict.keys()
 print('Total scenes to be added to shapefile: {}'.format(len(sceneIDs)))
 
@@ -838,6 +867,7 @@ data_source = None
 if errorsfound:
     print('Errors were found during script execution. please see the error log file for details: {}'.format(errorfile))
 
+profiler.close()
 print('Processing complete.')
 
 '''
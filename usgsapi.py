@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module contains the shared HTTP client used by updatelandsat.py and updateshp.py for all queries to the USGS/EROS servers.
+# A single pooled session is kept open so that TCP and TLS connections are reused between calls, responses are requested
+# gzip-compressed, and failed calls are retried with exponential backoff and jitter, honouring any Retry-After header.
+# Search and metadata responses may also be kept in an on-disk cache, so that they can be reused without querying the USGS again.
+# API calls may be limited by a token bucket shared by all threads, and by all processes using the same state file.
+# Search results may be filtered as they are decoded, incrementally with ijson or in one pass with orjson if either is installed.
+# The apiKey may be kept by an APIKey, which logs in again before it expires, or once if the USGS reports it is no longer valid.
+
+import os, time, random, json, datetime, email.utils, hashlib, gzip, tempfile, threading, sqlite3, requests
+from requests.adapters import HTTPAdapter
+
+retrystatus = [429, 500, 502, 503, 504] # HTTP status codes that will be retried
+retrycodes = ['RATE_LIMIT', 'UNKNOWN'] # USGS JSON API error codes that will be retried
+
+class USGSError(Exception):
+    # This is raised when the USGS JSON API returns an error code in an otherwise successful response
+    def __init__(self, errorCode, error):
+        self.errorCode = errorCode
+        self.error = error
+        Exception.__init__(self, '{}: {}'.format(errorCode, error))
+
+def retryafter(response):
+    # This returns the number of seconds requested by a Retry-After header, or None if it is missing or malformed
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        then = email.utils.parsedate_to_datetime(value)
+        now = datetime.datetime.now(then.tzinfo)
+        return max((then - now).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def loadparsers(parser):
+    # This returns the (ijson, orjson) modules to be used for the requested JSON parser: 'auto' uses whichever are installed,
+    # 'ijson' or 'orjson' only that one, and 'json' neither, in which case the standard library json module is used
+    modules = []
+    for name in ['ijson', 'orjson']:
+        module = None
+        if parser in ['auto', name]:
+            try:
+                module = __import__(name)
+            except ImportError:
+                if parser == name:
+                    print('Warning: {} is not installed, JSON responses will be decoded with the json module.'.format(name))
+        modules.append(module)
+    return modules
+
+def filterresults(json_data, keep):
+    # This replaces the search results in a decoded response with keep(result) for each, dropping those for which it returns None.
+    # The number of results returned by the server is kept in data['returned'].
+    data = json_data.get('data')
+    if isinstance(data, dict) and isinstance(data.get('results'), list):
+        results = data['results']
+        data['returned'] = len(results)
+        data['results'] = [result for result in (keep(item) for item in results) if result is not None]
+    return json_data
+
+def streamresults(fileobj, keep, ijson):
+    # This decodes a search response incrementally as it is read from fileobj, building one result at a time and passing it to
+    # keep(), so that neither the whole response text nor the discarded results are held in memory. Other values in the response
+    # and its data are kept. Returns the same structure as filterresults().
+    json_data = {}
+    data = {}
+    results = []
+    returned = 0
+    builder = None
+    for prefix, event, value in ijson.parse(fileobj, use_float = True):
+        if prefix.startswith('data.results.item'):
+            if prefix == 'data.results.item' and event == 'start_map':
+                builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            if prefix == 'data.results.item' and event == 'end_map':
+                returned += 1
+                result = keep(builder.value)
+                if result is not None:
+                    results.append(result)
+                builder = None
+        elif event in ['string', 'number', 'boolean', 'null']:
+            if prefix.startswith('data.') and not '.' in prefix[5:]:
+                data[prefix[5:]] = value
+            elif prefix == 'data': # e.g. data is null in an error response
+                json_data['data'] = value
+            elif not '.' in prefix:
+                json_data[prefix] = value
+    if not 'data' in json_data:
+        data['results'] = results
+        data['returned'] = returned
+        json_data['data'] = data
+    return json_data
+
+class APIKey(object):
+    # This keeps the apiKey returned by login(), a function taking no arguments, for reuse by all threads. A new key is requested
+    # once the current one is within margin seconds of its lifetime, or has been rejected by the server.
+    def __init__(self, login, lifetime = 7200, margin = 600):
+        self.login = login
+        self.lifetime = lifetime
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.apiKey = None
+        self.obtained = None
+        self.logins = 0
+
+    def get(self):
+        with self.lock:
+            if self.apiKey is None or time.time() - self.obtained > self.lifetime - self.margin:
+                self.apiKey = self.login()
+                self.obtained = time.time()
+                self.logins += 1
+            return self.apiKey
+
+    def invalidate(self, apiKey):
+        # This discards apiKey, unless another thread has already replaced it
+        with self.lock:
+            if self.apiKey == apiKey:
+                self.apiKey = None
+
+class RateLimiter(object):
+    # This is a token bucket holding up to burst tokens, refilled at rate tokens per second, from which each API call takes one.
+    # If statefile is set, the bucket is kept in a SQLite file and updated in an immediate transaction, so that it is shared
+    # by concurrent runs of the scripts as well as by the threads of this one.
+    def __init__(self, rate, burst = None, statefile = None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.statefile = statefile
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.waited = 0.0
+        if statefile:
+            dirname = os.path.dirname(statefile)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            conn = self.connect()
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY CHECK (id = 0), tokens REAL, updated REAL)')
+            conn.execute('INSERT OR IGNORE INTO bucket VALUES (0, ?, ?)', (self.burst, time.time()))
+            conn.commit()
+            conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.statefile, timeout = 60, isolation_level = None)
+
+    def take(self, tokens, updated):
+        # This refills the bucket to now and takes a token if one is available. Returns (tokens, updated, seconds to wait).
+        now = time.time()
+        tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0.0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def acquire(self):
+        # This blocks until a token has been taken, and returns the number of seconds waited
+        waited = 0.0
+        while True:
+            with self.lock: # threads of this process queue here, so that only one at a time polls the state file
+                if self.statefile:
+                    conn = self.connect()
+                    try:
+                        conn.execute('BEGIN IMMEDIATE')
+                        tokens, updated = conn.execute('SELECT tokens, updated FROM bucket WHERE id = 0').fetchone()
+                        tokens, updated, wait = self.take(tokens, updated)
+                        conn.execute('UPDATE bucket SET tokens = ?, updated = ? WHERE id = 0', (tokens, updated))
+                        conn.execute('COMMIT')
+                    finally:
+                        conn.close()
+                else:
+                    self.tokens, self.updated, wait = self.take(self.tokens, self.updated)
+                if wait <= 0:
+                    self.waited += waited
+                    return waited
+                time.sleep(wait)
+                waited += wait
+
+class BatchSizer(object):
+    # This adapts the number of scenes per metadata request to the latency and errors observed by all workers. Requests that
+    # take less than half of target seconds grow the batch by a quarter, slower ones than target shrink it by a quarter, and
+    # failed requests halve it. The size is kept between minimum and maximum, the latter being the API's limit.
+    def __init__(self, initial = 100, minimum = 10, maximum = 1000, target = 10.0):
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.target = target
+        self.lock = threading.Lock()
+        self.batchsize = min(max(int(initial), self.minimum), self.maximum)
+
+    def size(self):
+        with self.lock:
+            return self.batchsize
+
+    def record(self, numscenes, seconds, ok = True):
+        # This adjusts the batch size after a request for numscenes scenes that took seconds, and returns the new size
+        with self.lock:
+            if not ok:
+                self.batchsize = max(self.batchsize // 2, self.minimum)
+            elif seconds > self.target:
+                self.batchsize = max(int(self.batchsize * 0.75), self.minimum)
+            elif seconds < self.target / 2 and numscenes >= self.batchsize: # only full batches show that a larger one would be fast enough
+                self.batchsize = min(int(self.batchsize * 1.25) + 1, self.maximum)
+            return self.batchsize
+
+class ResponseCache(object):
+    # This is a content-addressed cache of decoded USGS JSON API responses. Each response is stored gzip-compressed in a file named
+    # by the SHA-256 hash of its endpoint and request parameters (excluding the apiKey), i.e. of the dataset, temporal window, spatial
+    # filter, and entity IDs. Entries older than ttl seconds are ignored, and once the cache exceeds maxsize bytes the least recently
+    # used entries are deleted. If read is False, responses are only saved.
+    def __init__(self, cachedir, ttl = 7 * 24 * 3600, maxsize = 1024 ** 3, read = True, verbose = False):
+        self.cachedir = cachedir
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.read = read
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.size = sum(entry[2] for entry in self.entries())
+
+    def key(self, url, params):
+        params = dict((name, value) for name, value in params.items() if name != 'apiKey')
+        return hashlib.sha256('{}\n{}'.format(url.rstrip('/'), json.dumps(params, sort_keys = True)).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], '{}.json.gz'.format(key))
+
+    def entries(self):
+        # This returns [path, last access time, size] for every cache entry
+        entries = []
+        for subdir in os.scandir(self.cachedir):
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith('.json.gz'):
+                        stat = entry.stat()
+                        entries.append([entry.path, stat.st_atime, stat.st_size])
+        return entries
+
+    def get(self, url, params):
+        # This returns the cached response for a request, or None if there is no current entry
+        if not self.read:
+            return None
+        filename = self.path(self.key(url, params))
+        try:
+            stat = os.stat(filename)
+            if time.time() - stat.st_mtime > self.ttl:
+                self.misses += 1
+                return None
+            with gzip.open(filename, 'rt', encoding = 'utf-8') as infile:
+                json_data = json.load(infile)
+            os.utime(filename, (time.time(), stat.st_mtime)) # the access time orders entries for eviction, the modification time for expiry
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.verbose:
+            print('Using cached response {}.'.format(os.path.basename(filename)))
+        return json_data
+
+    def put(self, url, params, json_data):
+        # This saves a response, written to a temporary file and renamed into place so that concurrent readers never see a partial entry
+        filename = self.path(self.key(url, params))
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok = True)
+        fd, tmpname = tempfile.mkstemp(suffix = '.tmp', dir = dirname)
+        with os.fdopen(fd, 'wb') as output:
+            with gzip.GzipFile(fileobj = output, mode = 'wb') as gz:
+                gz.write(json.dumps(json_data).encode('utf-8'))
+        with self.lock:
+            if os.path.isfile(filename):
+                self.size -= os.path.getsize(filename)
+            os.replace(tmpname, filename)
+            self.size += os.path.getsize(filename)
+            if self.size > self.maxsize:
+                self.evict()
+
+    def evict(self):
+        # This deletes expired entries, then the least recently used ones, until the cache is back under 90% of maxsize
+        entries = self.entries()
+        now = time.time()
+        self.size = sum(entry[2] for entry in entries)
+        for entry in sorted(entries, key = lambda entry: (now - os.path.getmtime(entry[0]) <= self.ttl, entry[1])):
+            if self.size <= self.maxsize * 0.9:
+                break
+            try:
+                os.remove(entry[0])
+                self.size -= entry[2]
+            except OSError:
+                pass
+        if self.verbose:
+            print('Response cache reduced to {:0.1f} MB.'.format(self.size / 1024 ** 2))
+
+    def report(self):
+        print('Response cache: {} hits, {} misses, {:0.1f} MB in {}.'.format(self.hits, self.misses, self.size / 1024 ** 2, self.cachedir))
+
+class USGSSession(object):
+    # This wraps a requests.Session with a connection pool sized for concurrent workers, and retries failed requests.
+    # If a ResponseCache is supplied, postjson() calls with cached = True are looked up in it before being sent. If an
+    # ieometrics.Metrics is supplied, calls, latencies, and bytes received are recorded in it by endpoint and status. If a
+    # RateLimiter is supplied, every attempt at a postjson() call, including retries, first takes a token from it.
+    def __init__(self, poolsize = 10, retries = 5, backoff = 1.0, maxbackoff = 60.0, timeout = 300, verbose = False, cache = None, metrics = None, ratelimiter = None, parser = 'json'):
+        self.cache = cache
+        self.ijson, self.orjson = loadparsers(parser)
+        self.metrics = metrics
+        self.ratelimiter = ratelimiter
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.timeout = timeout
+        self.verbose = verbose
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = poolsize, pool_maxsize = poolsize, max_retries = 0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
+    def delay(self, attempt, response = None):
+        # Exponential backoff with full jitter, unless the server has told us how long to wait
+        wait = None
+        if response is not None:
+            wait = retryafter(response)
+        if wait is None:
+            wait = random.uniform(0, min(self.maxbackoff, self.backoff * 2 ** attempt))
+        return wait
+
+    def record(self, endpoint, status, seconds, response, stream = False):
+        # This records a request attempt in self.metrics. The size of streamed responses is taken from their Content-Length.
+        self.metrics.count('http_requests', endpoint = endpoint, status = status)
+        self.metrics.observe('http_request_seconds', seconds, endpoint = endpoint)
+        if response is not None:
+            if stream:
+                size = int(response.headers.get('Content-Length', 0) or 0)
+            else:
+                size = len(response.content)
+            self.metrics.count('http_bytes_received', size, endpoint = endpoint)
+
+    def request(self, method, url, endpoint = None, ratelimited = False, **kwargs):
+        # This sends a request, retrying connection errors, timeouts, and retryable HTTP status codes up to self.retries times.
+        # endpoint labels the request in self.metrics, and defaults to the method name. If ratelimited is True, each attempt
+        # waits for a token from self.ratelimiter.
+        kwargs.setdefault('timeout', self.timeout)
+        if not endpoint:
+            endpoint = method.lower()
+        attempt = 0
+        while True:
+            response = None
+            if ratelimited and self.ratelimiter:
+                waited = self.ratelimiter.acquire()
+                if self.metrics and waited > 0:
+                    self.metrics.count('ratelimit_wait_seconds', waited, endpoint = endpoint)
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if self.metrics:
+                    self.record(endpoint, response.status_code, time.perf_counter() - start, response, kwargs.get('stream', False))
+                if not response.status_code in retrystatus:
+                    response.raise_for_status()
+                    return response
+                error = 'HTTP {}'.format(response.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+                if self.metrics:
+                    self.record(endpoint, type(e).__name__, time.perf_counter() - start, None)
+            if attempt >= self.retries:
+                if response is not None:
+                    response.raise_for_status()
+                raise requests.exceptions.RetryError('Request to {} failed after {} attempts: {}'.format(url, attempt + 1, error))
+            wait = self.delay(attempt, response)
+            if self.verbose:
+                print('Request to {} failed ({}), retrying in {:0.1f} seconds.'.format(url, error, wait))
+            if self.metrics:
+                self.metrics.count('http_retries', endpoint = endpoint)
+            if response is not None:
+                response.close()
+            time.sleep(wait)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def decode(self, response, keep = None):
+        # This decodes a JSON API response, filtering its search results with keep() if it is set. Filtered responses are streamed
+        # through ijson if it is available, and responses are otherwise decoded from their bytes with orjson if it is available.
+        if keep and self.ijson:
+            response.raw.decode_content = True # let urllib3 undo the gzip content encoding as the body is read
+            try:
+                return streamresults(response.raw, keep, self.ijson)
+            finally:
+                response.close()
+        if self.orjson:
+            json_data = self.orjson.loads(response.content)
+        else:
+            json_data = json.loads(response.text)
+        if keep:
+            filterresults(json_data, keep)
+        return json_data
+
+    def postjson(self, url, params, cached = False, apikey = None, keep = None, **kwargs):
+        # This sends a USGS JSON API request and returns the decoded response. API errors that indicate a temporary
+        # problem on the server side are retried in the same manner as HTTP errors; all others raise USGSError.
+        # If cached is True, the response cache is consulted first, and successful responses are saved to it.
+        # If an APIKey is supplied, its current key is added to params, and a rejected key is replaced once.
+        # If keep is set, each search result is replaced by keep(result), or dropped if it returns None, as described in
+        # filterresults(). Responses are only streamed if they are not to be cached, as the cache holds whole responses.
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+        usecache = cached and self.cache
+        if usecache:
+            json_data = self.cache.get(url, params)
+            if self.metrics:
+                self.metrics.count('cache_lookups', endpoint = endpoint, result = 'miss' if json_data is None else 'hit')
+            if json_data is not None:
+                if keep:
+                    filterresults(json_data, keep)
+                return json_data
+        attempt = 0
+        relogged = False
+        while True:
+            if apikey:
+                params = dict(params, apiKey = apikey.get())
+            stream = bool(keep and self.ijson and not usecache)
+            response = self.post(url, endpoint = endpoint, ratelimited = True, stream = stream, data = {'jsonRequest': json.dumps(params)}, **kwargs)
+            json_data = self.decode(response, keep if stream else None)
+            errorCode = json_data.get('errorCode')
+            if not errorCode:
+                if usecache:
+                    self.cache.put(url, params, json_data)
+                if keep and not stream:
+                    filterresults(json_data, keep)
+                return json_data
+            if apikey and errorCode.startswith('AUTH') and not relogged: # e.g. AUTH_INVALID, the key has expired early
+                if self.verbose:
+                    print('USGS API key rejected by {} ({}), logging in again.'.format(url, errorCode))
+                apikey.invalidate(params['apiKey'])
+                relogged = True
+                continue
+            if not errorCode in retrycodes or attempt >= self.retries:
+                raise USGSError(errorCode, json_data.get('error'))
+            wait = self.delay(attempt, response)
+            if self.verbose:
+                print('USGS API error {} from {}, retrying in {:0.1f} seconds.'.format(errorCode, url, wait))
+            time.sleep(wait)
+            attempt += 1
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.0
+
+# This module keeps a local index of the WRS-2 Path/Row footprints in the ieo.WRS2 layer, so that scripts need neither scan the
+# layer on each run nor ask the USGS grid2ll service for scene centres. The paths, rows, footprint envelopes and centres, and
+# outer ring vertices of all footprints, in WGS-84 latitude and longitude, are stored as NumPy arrays in a .npz file stamped with
+# the geopackage's modification time and size, and are only read from the layer again once the geopackage has changed.
+
+import os, tempfile
+import numpy as np
+from osgeo import ogr, osr
+
+def readlayer(gpkg, layername):
+    # This reads the path, row, and outer ring of each footprint in the layer, transformed to WGS-84 longitude, latitude
+    data_source = ogr.Open(gpkg, 0)
+    if not data_source:
+        raise IOError('Cannot open geopackage: {}'.format(gpkg))
+    layer = data_source.GetLayer(layername)
+    if not layer:
+        raise IOError('Layer {} not found in geopackage: {}'.format(layername, gpkg))
+    transform = None
+    layersrs = layer.GetSpatialRef()
+    if layersrs:
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        for srs in [layersrs, wgs84]:
+            if hasattr(srs, 'SetAxisMappingStrategy'): # GDAL >= 3, keep x as longitude and y as latitude
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if not layersrs.IsSame(wgs84):
+            transform = osr.CoordinateTransformation(layersrs, wgs84)
+    paths = []
+    rows = []
+    rings = []
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Clone()
+        if transform:
+            geom.Transform(transform)
+        if geom.GetGeometryCount() == 0:
+            continue
+        while geom.GetGeometryType() != ogr.wkbLinearRing and geom.GetGeometryCount() > 0: # the first polygon's outer ring
+            geom = geom.GetGeometryRef(0)
+        ring = np.asarray(geom.GetPoints(), dtype = np.float64)
+        if ring.ndim != 2 or ring.shape[0] < 3:
+            continue
+        ring = ring[:, :2]
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        paths.append(feature.GetField('PATH'))
+        rows.append(feature.GetField('ROW'))
+        rings.append(ring)
+    data_source = None
+    return paths, rows, rings
+
+def stamp(gpkg, layername):
+    stat = os.stat(gpkg)
+    return '{}|{}|{}'.format(layername, stat.st_mtime, stat.st_size)
+
+class WRS2Index(object):
+    # Footprints are held in parallel arrays: paths and rows, envelopes as [minimum longitude, maximum longitude, minimum latitude,
+    # maximum latitude], centres as [latitude, longitude], and the vertices of all outer rings as [longitude, latitude], with the
+    # ring of footprint i in vertices[offsets[i]:offsets[i + 1]].
+    def __init__(self, paths, rows, vertices, offsets, envelopes, centres):
+        self.paths = paths
+        self.rows = rows
+        self.vertices = vertices
+        self.offsets = offsets
+        self.envelopes = envelopes
+        self.centres = centres
+        self.keys = np.array(['{:03d}{:03d}'.format(path, row) for path, row in zip(paths.tolist(), rows.tolist())])
+
+    @classmethod
+    def fromrings(cls, paths, rows, rings):
+        counts = [ring.shape[0] for ring in rings]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        vertices = np.concatenate(rings) if len(rings) > 0 else np.zeros((0, 2))
+        envelopes = np.array([[ring[:, 0].min(), ring[:, 0].max(), ring[:, 1].min(), ring[:, 1].max()] for ring in rings]).reshape(-1, 4)
+        centres = np.array([[ring[:-1, 1].mean(), ring[:-1, 0].mean()] for ring in rings]).reshape(-1, 2) # vertex means, the footprints being near-rectangular
+        return cls(np.asarray(paths, dtype = np.int16), np.asarray(rows, dtype = np.int16), vertices, offsets, envelopes, centres)
+
+    def save(self, cachefile, stampstr):
+        # This writes the arrays to a temporary file next to cachefile and renames it into place
+        dirname = os.path.dirname(os.path.abspath(cachefile))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(suffix = '.npz', dir = dirname)
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                np.savez(output, stamp = np.array(stampstr), paths = self.paths, rows = self.rows, vertices = self.vertices,
+                         offsets = self.offsets, envelopes = self.envelopes, centres = self.centres)
+            os.replace(tmpname, cachefile)
+        except:
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def pathrowstrs(self):
+        # This returns the set of Path/Row strings, e.g. '207023', as found in characters 3 to 9 of a Landsat sceneID
+        return set(self.keys.tolist())
+
+    def pathlist(self):
+        return sorted(set(self.paths.tolist()))
+
+    def rowlist(self):
+        return sorted(set(self.rows.tolist()))
+
+    def pathrowdict(self):
+        # This returns a dict of path: sorted list of rows
+        pathrowdict = {}
+        for path, row in zip(self.paths.tolist(), self.rows.tolist()):
+            pathrowdict.setdefault(path, set()).add(row)
+        return dict((path, sorted(rows)) for path, rows in pathrowdict.items())
+
+    def rowrange(self, path):
+        # This returns the [minimum, maximum] row of a path, or None if the path is not in the index
+        rows = self.rows[self.paths == path]
+        if rows.size == 0:
+            return None
+        return [int(rows.min()), int(rows.max())]
+
+    def select(self, pathrowstrs = None):
+        # This returns a boolean mask of the footprints in pathrowstrs, or of all of them, and whether all of pathrowstrs were found
+        if pathrowstrs is None:
+            return np.ones(self.keys.shape, dtype = bool), True
+        pathrowstrs = set(pathrowstrs)
+        mask = np.isin(self.keys, list(pathrowstrs))
+        return mask, len(set(self.keys[mask].tolist())) == len(pathrowstrs)
+
+    def mbr(self, pathrowstrs = None, envelopes = False):
+        # This returns the Minimum Bounding Rectangle [lower left latitude, lower left longitude, upper right latitude, upper right
+        # longitude] of the scene centres of pathrowstrs, as grid2ll would, or of their whole footprints if envelopes is True.
+        # Returns None if any of pathrowstrs is not in the index.
+        mask, complete = self.select(pathrowstrs)
+        if not complete or not mask.any():
+            return None
+        if envelopes:
+            selected = self.envelopes[mask]
+            return [float(selected[:, 2].min()), float(selected[:, 0].min()), float(selected[:, 3].max()), float(selected[:, 1].max())]
+        selected = self.centres[mask]
+        return [float(selected[:, 0].min()), float(selected[:, 1].min()), float(selected[:, 0].max()), float(selected[:, 1].max())]
+
+    def locate(self, latitude, longitude):
+        # This returns the [path, row] of every footprint containing a point, the one with the nearest centre first
+        candidates = np.nonzero((self.envelopes[:, 0] <= longitude) & (self.envelopes[:, 1] >= longitude) &
+                                (self.envelopes[:, 2] <= latitude) & (self.envelopes[:, 3] >= latitude))[0]
+        found = []
+        for i in candidates.tolist():
+            ring = self.vertices[self.offsets[i]:self.offsets[i + 1]]
+            x1, y1, x2, y2 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+            crosses = (y1 > latitude) != (y2 > latitude)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                xcross = x1 + (latitude - y1) * (x2 - x1) / (y2 - y1)
+            if np.count_nonzero(crosses & (longitude < xcross)) % 2 == 1: # ray casting
+                distance = (self.centres[i, 0] - latitude) ** 2 + (self.centres[i, 1] - longitude) ** 2
+                found.append([distance, int(self.paths[i]), int(self.rows[i])])
+        return [[path, row] for distance, path, row in sorted(found)]
+
+def load(gpkg, layername, cachefile, verbose = False):
+    # This returns the WRS2Index for a layer, from cachefile if it was built from the geopackage as it is now, or from the layer,
+    # in which case cachefile is rewritten
+    stampstr = stamp(gpkg, layername)
+    if os.path.isfile(cachefile):
+        try:
+            with np.load(cachefile) as cached:
+                if str(cached['stamp']) == stampstr:
+                    return WRS2Index(cached['paths'], cached['rows'], cached['vertices'], cached['offsets'], cached['envelopes'], cached['centres'])
+        except (OSError, KeyError, ValueError) as e:
+            print('Error reading WRS-2 index {}, it will be rebuilt: {}'.format(cachefile, e))
+    print('Building WRS-2 index from layer {} in: {}'.format(layername, gpkg))
+    index = WRS2Index.fromrings(*readlayer(gpkg, layername))
+    try:
+        index.save(cachefile, stampstr)
+        if verbose:
+            print('WRS-2 index of {} footprints written to: {}'.format(len(index.keys), cachefile))
+    except OSError as e:
+        print('Error writing WRS-2 index {}: {}'.format(cachefile, e))
+    return index